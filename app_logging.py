@@ -0,0 +1,145 @@
+# app_logging.py
+# server_app.py / client_gui.py 共通のログ出力。
+# ログはキューに積むだけで呼び出し元に戻り、書き込みはバックグラウンドのスレッドが行う。
+# 出力は1行1件のJSON (JSON Lines)。"text" を指定すると従来の print に近い1行テキストになる。
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVELS = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARNING": logging.WARNING, "ERROR": logging.ERROR}
+
+# logging.LogRecord が標準で持つ属性 (これ以外の extra= で渡された値を構造化フィールドとして出力する)
+_RESERVED_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None # 稼働中の QueueListener
+_listener_config = None # fork 後に子プロセスでリスナーを作り直すための設定
+_payload_last_logged = {} # debug_payload のキーごとの最終出力時刻
+_payload_lock = threading.Lock()
+_payload_interval = 10.0
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """1件のログを1行のJSONにする。extra= で渡した値はそのままキーとして出力する"""
+    def format(self, record):
+        entry = {
+            "ts": datetime_from_timestamp(record.created),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """print に近い1行テキスト。extra= の値は key=value で末尾に付ける"""
+    def format(self, record):
+        line = f"{datetime_from_timestamp(record.created)} {record.levelname:<7} {record.getMessage()}"
+        extras = [f"{key}={value}" for key, value in record.__dict__.items()
+                  if key not in _RESERVED_RECORD_ATTRS and not key.startswith("_")]
+        if extras:
+            line += " " + " ".join(extras)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """キューが一杯のときは待たずに捨てる (ログ出力でリクエストを止めない)。捨てた件数は dropped に数える"""
+    dropped = 0
+
+    def prepare(self, record):
+        # 書き込みスレッドで getMessage() し直さなくて済むように、ここで整形済みのメッセージにしておく
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def datetime_from_timestamp(created):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(created)) + f".{int(created % 1 * 1000):03d}"
+
+
+def setup_logging(name, level="INFO", log_format="json", log_file=None, queue_size=10000, debug_payload_interval=10.0):
+    """
+    ロガー name を設定して返す。ハンドラはキュー経由で、実際の書き込みは QueueListener のスレッドが行う。
+    log_file を指定しなければ標準出力へ書く。何度呼んでも設定し直すだけ (設定ファイルの再読み込み用)。
+    """
+    global _listener, _listener_config, _payload_interval
+    shutdown_logging()
+    _listener_config = (name, level, log_format, log_file, queue_size, debug_payload_interval)
+    _payload_interval = float(debug_payload_interval)
+
+    if log_file:
+        output_handler = logging.FileHandler(log_file, encoding="utf-8")
+    elif sys.stdout is not None:
+        output_handler = logging.StreamHandler(sys.stdout)
+    else: # コンソールなしの exe (PyInstaller --noconsole) では標準出力がない
+        output_handler = logging.NullHandler()
+    output_handler.setFormatter(TextFormatter() if log_format == "text" else JsonLinesFormatter())
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    logger = logging.getLogger(name)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    logger.setLevel(LOG_LEVELS.get(str(level).upper(), logging.INFO))
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, output_handler, respect_handler_level=False)
+    _listener.start()
+    return logger
+
+
+def shutdown_logging():
+    """キューに残っているログを書き出してからリスナーを止める"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def _restart_listener_after_fork():
+    # fork した子プロセスには書き込みスレッドが引き継がれないので作り直す
+    global _listener
+    if _listener_config is not None:
+        _listener = None # 親のスレッドは子には存在しないので stop() しない
+        setup_logging(*_listener_config)
+
+atexit.register(shutdown_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_listener_after_fork)
+
+
+def debug_payload(logger, key, message, payload):
+    """
+    大きなデータ (応答JSONなど) を DEBUG で出力する。同じ key は debug_payload_interval 秒に1回だけ出力し、
+    DEBUG が無効なときや間引かれたときは payload を直列化しない。
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    now = time.monotonic()
+    with _payload_lock:
+        last = _payload_last_logged.get(key)
+        if last is not None and now - last < _payload_interval:
+            return
+        _payload_last_logged[key] = now
+    logger.debug(message, extra={"payload": payload})
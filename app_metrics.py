@@ -0,0 +1,146 @@
+# app_metrics.py
+# Prometheus のテキスト形式で出力するカウンタ/ゲージ/ヒストグラム (外部ライブラリなし)。
+# 記録はロック1回と辞書の更新だけなので、本番でも常時有効にしておける。
+
+import bisect
+import threading
+import time
+
+# 既定のバケット (秒)。usbip コマンドや HTTP リクエストの所要時間向け
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """増えるだけの値。ラベルごとに別々に数える"""
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help_text, self.labelnames = name, help_text, tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for labelvalues, value in sorted(values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}"
+
+
+class Gauge(Counter):
+    """増減する値。callback を渡すと出力のたびに呼んで現在値を得る (記録側のコストなし)"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def set(self, value, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def samples(self):
+        if self.callback is not None:
+            self.set(self.callback())
+        yield from super().samples()
+
+
+class Histogram:
+    """所要時間などの分布。バケットごとの件数と合計を持つ"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help_text, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.values = {} # labelvalues -> [バケットごとの件数 (累積ではない), 合計, 件数]
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labelvalues)
+            if entry is None:
+                entry = self.values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *labelvalues):
+        """with ブロックの所要時間を記録する"""
+        return _Timer(self, labelvalues)
+
+    def samples(self):
+        with self.lock:
+            values = {labelvalues: (list(counts), total, count) for labelvalues, (counts, total, count) in self.values.items()}
+        for labelvalues, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labelnames, labelvalues, ("le", format_value(float(upper_bound))))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class _Timer:
+    def __init__(self, histogram, labelvalues):
+        self.histogram, self.labelvalues = histogram, labelvalues
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started_at, *self.labelvalues)
+        return False
+
+
+class MetricsRegistry:
+    """メトリクスをまとめて Prometheus のテキスト形式 (version 0.0.4) で出力する"""
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), callback=None):
+        return self.register(Gauge(name, help_text, labelnames, callback))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,182 @@
+# bench_asgi.py
+# スレッドの Flask サーバー (server_app.app を threaded=True で起動) と asyncio モード (server_asgi.py) を、
+# 同時接続数を増やしながら比較するベンチマーク。
+#   1. /events の購読者を --subscribers 本つないだままにする
+#   2. /device_status を --connections 本の接続から --duration 秒送り続け、req/s とレイテンシを測る (サーバーが接続を閉じたらつなぎ直す)
+#   3. サーバープロセスのスレッド数とメモリ (RSS) を記録する
+# 実際の usbip の代わりに bench_workers.py と同じ偽の usbip コマンドを使う。
+#
+# 使い方: python bench_asgi.py [--connections 50 200 500] [--subscribers 200] [--duration 10] [--modes flask asgi]
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_workers import find_free_port, wait_for_server, write_fake_usbip
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REQUEST_TIMEOUT = 30.0 # 1リクエストの応答を待つ上限 (秒)
+
+# スレッドの Flask サーバー (従来の起動方法から debug リローダーを除いたもの)
+FLASK_RUNNER = '''
+import sys
+sys.path.insert(0, {bench_dir!r})
+import server_app
+server_app.init_server()
+server_app.start_reconciler()
+server_app.app.run(host="127.0.0.1", port={port}, threaded=True)
+'''
+
+
+def start_server(mode, work_dir, bin_dir, port):
+    with open(os.path.join(work_dir, 'server_config.json'), 'w') as f:
+        json.dump({"host": "127.0.0.1", "port": port, "log_level": "WARNING", "inventory_cache_ttl": 1.0,
+                   "admission_control_enabled": False}, f) # 同時処理数の上限で断らずに、サーバー自体の処理能力を測る
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+    if mode == "flask":
+        command = [sys.executable, '-c', FLASK_RUNNER.format(bench_dir=BENCH_DIR, port=port)]
+    else:
+        command = [sys.executable, os.path.join(BENCH_DIR, 'server_asgi.py'), '--port', str(port)]
+    log = open(os.path.join(work_dir, f'server_{mode}.log'), 'w')
+    process = subprocess.Popen(command, cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    if not wait_for_server(port):
+        process.terminate()
+        raise RuntimeError(f"server did not start (see {log.name})")
+    return process
+
+def process_stats(pid):
+    """(スレッド数, RSS MB)。/proc が読めなければ (None, None)"""
+    threads = rss_kb = None
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Threads:'): threads = int(line.split()[1])
+                elif line.startswith('VmRSS:'): rss_kb = int(line.split()[1])
+    except OSError:
+        pass
+    return threads, (rss_kb / 1024 if rss_kb is not None else None)
+
+
+# --- 負荷生成 (asyncio。keep-alive の HTTP/1.1 を直接書く) ---
+async def read_response(reader):
+    """戻り値: (ステータスコード, 接続を使い続けられるか)。werkzeug の開発サーバーは1リクエストごとに接続を閉じる"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    length = None
+    keep_alive = True
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        name, value = name.strip().lower(), value.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'connection' and value == b'close':
+            keep_alive = False
+    if length is None:
+        await reader.read() # Content-Length がなければ接続が閉じるまでが本文
+        keep_alive = False
+    elif length:
+        await reader.readexactly(length)
+    return status, keep_alive
+
+async def status_client(port, path, deadline, latencies, counters):
+    request = f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode()
+    writer = None
+    try:
+        while time.monotonic() < deadline:
+            started_at = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request)
+            status, keep_alive = await asyncio.wait_for(read_response(reader), REQUEST_TIMEOUT)
+            latencies.append(time.perf_counter() - started_at)
+            counters["ok" if status < 400 else "errors"] += 1
+            if not keep_alive:
+                writer.close()
+                writer = None
+    except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+        counters["errors"] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+async def event_subscriber(port, stop, counters):
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b"GET /events HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n")
+        await reader.readuntil(b'\r\n\r\n')
+        counters["subscribed"] += 1
+        while not stop.is_set():
+            try:
+                if not await asyncio.wait_for(reader.read(4096), 0.5):
+                    break
+            except asyncio.TimeoutError:
+                continue
+        writer.close()
+    except (OSError, asyncio.IncompleteReadError):
+        counters["subscriber_errors"] += 1
+
+async def run_load(port, connections, subscribers, duration, pid):
+    counters = {"ok": 0, "errors": 0, "subscribed": 0, "subscriber_errors": 0}
+    stop = asyncio.Event()
+    subscriber_tasks = [asyncio.create_task(event_subscriber(port, stop, counters)) for _ in range(subscribers)]
+    await asyncio.sleep(1.0) # 購読者がつながるのを待つ
+    latencies = []
+    started_at = time.monotonic()
+    clients = [status_client(port, '/device_status', started_at + duration, latencies, counters) for _ in range(connections)]
+    clients_task = asyncio.gather(*clients)
+    await asyncio.sleep(duration / 2)
+    threads, rss_mb = process_stats(pid) # 負荷をかけている最中の値
+    await clients_task
+    elapsed = time.monotonic() - started_at
+    stop.set()
+    await asyncio.gather(*subscriber_tasks)
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else float('nan')
+    return {"rps": counters["ok"] / elapsed, "errors": counters["errors"], "p50": percentile(0.50), "p99": percentile(0.99),
+            "subscribed": counters["subscribed"], "threads": threads, "rss_mb": rss_mb}
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare threaded Flask and asyncio serving modes at high connection counts")
+    parser.add_argument('--modes', nargs='+', default=["flask", "asgi"], choices=["flask", "asgi"])
+    parser.add_argument('--connections', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--subscribers', type=int, default=200, help="idle /events subscribers kept open during the run")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per measurement")
+    parser.add_argument('--devices', type=int, default=20, help="devices reported by the fake usbip")
+    args = parser.parse_args()
+
+    rows = []
+    for mode in args.modes:
+        work_dir = tempfile.mkdtemp(prefix=f'usbip_bench_{mode}_')
+        bin_dir = os.path.join(work_dir, 'bin')
+        os.makedirs(bin_dir)
+        write_fake_usbip(bin_dir, args.devices)
+        port = find_free_port()
+        process = start_server(mode, work_dir, bin_dir, port)
+        try:
+            for connections in args.connections:
+                result = asyncio.run(run_load(port, connections, args.subscribers, args.duration, process.pid))
+                rows.append((mode, connections, result))
+                print(f"{mode} connections={connections}: {result['rps']:.0f} req/s, p50 {result['p50']:.1f} ms, "
+                      f"p99 {result['p99']:.1f} ms, {result['errors']} errors", flush=True)
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print()
+    print(f"{'mode':>5} | {'conns':>5} | {'subscribers':>11} | {'req/s':>7} | {'p50 ms':>7} | {'p99 ms':>8} | {'errors':>6} | {'threads':>7} | {'RSS MB':>6}")
+    print(f"{'-' * 5}-+-{'-' * 5}-+-{'-' * 11}-+-{'-' * 7}-+-{'-' * 7}-+-{'-' * 8}-+-{'-' * 6}-+-{'-' * 7}-+-{'-' * 6}")
+    for mode, connections, r in rows:
+        print(f"{mode:>5} | {connections:>5} | {r['subscribed']:>11} | {r['rps']:>7.0f} | {r['p50']:>7.1f} | {r['p99']:>8.1f} | "
+              f"{r['errors']:>6} | {r['threads'] if r['threads'] is not None else '-':>7} | "
+              f"{r['rss_mb'] if r['rss_mb'] is not None else float('nan'):>6.1f}")
+
+if __name__ == '__main__':
+    main()
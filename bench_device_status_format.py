@@ -0,0 +1,82 @@
+# bench_device_status_format.py
+# /device_status (v1) と /v2/device_status の応答サイズと直列化時間を比較する。
+# server_app.py の応答を組み立てる関数をそのまま使い、合成したデバイス一覧とアタッチ情報で測る (サーバーは起動しない)。
+#
+# 使い方: python bench_device_status_format.py [--devices 10 100 1000 10000] [--attached-ratio 0.3] [--repeat 20]
+
+import argparse
+import gzip
+import time
+import types
+
+import server_app
+
+
+def make_state(device_count, attached_ratio):
+    devices = []
+    attachments = {}
+    for i in range(device_count):
+        bus_id = f"{i // 1000 + 1}-{i % 1000 // 100 + 1}.{i % 100 + 1}"
+        devices.append({"bus_id": bus_id, "description": f"Vendor {i % 37} Inc. : Product {i} (rev {i % 7})",
+                        "vid": "1234", "pid": f"{i % 0x10000:04x}", "bound": True})
+        if i < device_count * attached_ratio:
+            attachments[bus_id] = {"client_ip": f"192.168.2.{i % 250 + 1}", "username": f"user{i % 50}",
+                                   "timestamp": "2026-10-17T09:00:00.000000"}
+    state = server_app.StateSnapshot(1, types.MappingProxyType({}), types.MappingProxyType(attachments))
+    return devices, state
+
+def best_of(repeat, func):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+def measure(devices, state, repeat, fields):
+    """(名前, バイト数, ミリ秒) のリストを返す。時間は組み立て + 直列化 (+ 圧縮)"""
+    results = []
+    elapsed, body = best_of(repeat, lambda: server_app.build_device_status_body(devices, state))
+    results.append(("v1 json", len(body), elapsed))
+    elapsed, compressed = best_of(repeat, lambda: gzip.compress(server_app.build_device_status_body(devices, state), compresslevel=5))
+    results.append(("v1 json+gzip", len(compressed), elapsed))
+
+    def build_v2(mimetype, use_gzip, selected):
+        rows, bus_ids = server_app.build_device_status_v2_rows(devices, state)
+        payload = server_app.build_device_status_v2_payload(rows, bus_ids, state.version, selected,
+                                                            len(rows) + 1, None, [])
+        return server_app.encode_device_status_v2(payload, mimetype, use_gzip)[0]
+
+    variants = [("v2 json", 'application/json', False), ("v2 json+gzip", 'application/json', True)]
+    if server_app.msgpack is not None:
+        variants += [("v2 msgpack", server_app.MSGPACK_MIMETYPE, False), ("v2 msgpack+gzip", server_app.MSGPACK_MIMETYPE, True)]
+    for name, mimetype, use_gzip in variants:
+        elapsed, body = best_of(repeat, lambda: build_v2(mimetype, use_gzip, list(server_app.DEVICE_STATUS_V2_FIELDS)))
+        results.append((name, len(body), elapsed))
+    elapsed, body = best_of(repeat, lambda: build_v2('application/json', False, fields))
+    results.append((f"v2 json fields={','.join(fields)}", len(body), elapsed))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare /device_status v1 and v2 payload size and serialization time")
+    parser.add_argument('--devices', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--attached-ratio', type=float, default=0.3, help="fraction of devices with an attachment")
+    parser.add_argument('--repeat', type=int, default=20, help="runs per measurement (best is reported)")
+    parser.add_argument('--fields', default="bus_id,attached,username", help="field selection for the last v2 row")
+    args = parser.parse_args()
+
+    if server_app.msgpack is None:
+        print("msgpack is not installed; MessagePack rows are skipped")
+    for device_count in args.devices:
+        devices, state = make_state(device_count, args.attached_ratio)
+        results = measure(devices, state, args.repeat, args.fields.split(","))
+        v1_size = results[0][1]
+        print()
+        print(f"{device_count} devices ({int(device_count * args.attached_ratio)} attached)")
+        print(f"  {'format':<40} | {'bytes':>10} | {'vs v1':>6} | {'ms':>8}")
+        for name, size, elapsed in results:
+            print(f"  {name:<40} | {size:>10} | {size / v1_size:>5.0%} | {elapsed * 1000:>8.3f}")
+
+if __name__ == '__main__':
+    main()
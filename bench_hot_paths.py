@@ -0,0 +1,129 @@
+# bench_hot_paths.py
+# よく呼ばれる関数のマイクロベンチマーク。10〜10,000 デバイスの合成データで、1回の呼び出しにかかる時間を測る:
+#   parse_usbip_list_l_output / parse_remote_list_output (usbip_output.py)
+#   merge_device_rows (device_rows.py。client_gui.py のデバイス一覧のマージ)
+#   build_device_status_body (server_app.py の /device_status の応答)
+# 結果は履歴ファイル (JSON Lines、1回の実行で1行) に追記する。同じマシン・同じ Python で記録した直近 --baseline-runs 回の
+# 中央値と比べ、--threshold を超えて遅くなった組み合わせがあれば終了コード 1 で終わる (遅くなった回は履歴に残さない)。
+#
+# 使い方: python bench_hot_paths.py [--sizes 10 100 1000 10000] [--repeat 30] [--history bench_history.jsonl] [--threshold 0.25]
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+
+import server_app
+from bench_device_status_format import make_state
+from device_rows import merge_device_rows
+from bench_usbip_parser import make_list_l_output, make_remote_list_output
+from usbip_output import parse_usbip_list_l_output, parse_remote_list_output
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RECHECKS = 2 # しきい値を超えたときに測り直す回数
+CLIENT_IP = "192.168.2.1" # make_state のアタッチ情報の1つ目と同じ (「自分がアタッチ中」の行もできる)
+
+
+def make_cases(size):
+    """関数名 -> 引数なしで呼べる測定対象"""
+    list_l_output = make_list_l_output(size)
+    remote_list_output = make_remote_list_output(size)
+    devices, state = make_state(size, 0.3)
+    server_data = json.loads(server_app.build_device_status_body(devices, state))
+    bound_bus_ids = {dev["bus_id"] for i, dev in enumerate(devices) if i % 2 == 0}
+    return {
+        "parse_usbip_list_l_output": lambda: parse_usbip_list_l_output(list_l_output),
+        "parse_remote_list_output": lambda: parse_remote_list_output(remote_list_output),
+        "merge_device_rows": lambda: merge_device_rows(server_data, bound_bus_ids, CLIENT_IP, "user0"),
+        "build_device_status_body": lambda: server_app.build_device_status_body(devices, state),
+    }
+
+def measure(func, repeat, sample_seconds=0.01):
+    """
+    1回の呼び出しの時間 (マイクロ秒)。約 sample_seconds 秒分ずつまとめて呼ぶ計測を repeat 回行い、最良値を使う
+    (長い計測を数回より、短い計測を何度も行って最小値を取るほうが、他のプロセスの影響によるぶれが小さい)
+    """
+    timer = timeit.Timer(func)
+    number = max(1, int(sample_seconds / max(timer.timeit(1), 1e-7)))
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- 履歴 ---
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def baseline_from_history(history, machine, runs):
+    """同じマシン・同じ Python の直近 runs 回の、関数とサイズごとの中央値"""
+    recent = [entry for entry in history if entry.get("machine") == machine][-runs:]
+    samples = {}
+    for entry in recent:
+        for name, by_size in entry["results"].items():
+            for size, micros in by_size.items():
+                samples.setdefault((name, size), []).append(micros)
+    return {key: statistics.median(values) for key, values in samples.items()}, len(recent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark the parsers, client merge and device_status builder")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=30, help="timing samples per measurement (best is reported)")
+    parser.add_argument('--only', nargs='+', help="benchmark only these functions")
+    parser.add_argument('--history', default=os.path.join(BENCH_DIR, 'bench_history.jsonl'))
+    parser.add_argument('--baseline-runs', type=int, default=5, help="compare against the median of this many previous runs")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown against the baseline (0.25 = 25%%)")
+    parser.add_argument('--no-save', action='store_true', help="do not append this run to the history")
+    args = parser.parse_args()
+
+    machine = {"host": platform.node(), "python": platform.python_version()}
+    baseline, baseline_count = baseline_from_history(load_history(args.history), machine, args.baseline_runs)
+    print(f"Baseline: median of {baseline_count} previous run(s) in {args.history}" if baseline_count
+          else f"No previous runs for this machine in {args.history}; recording a baseline")
+
+    results = {}
+    regressions = []
+    print(f"{'function':<26} | {'devices':>7} | {'us/call':>10} | {'baseline':>10} | {'change':>7}")
+    print(f"{'-' * 26}-+-{'-' * 7}-+-{'-' * 10}-+-{'-' * 10}-+-{'-' * 7}")
+    for size in args.sizes:
+        for name, func in make_cases(size).items():
+            if args.only and name not in args.only:
+                continue
+            micros = measure(func, args.repeat)
+            base = baseline.get((name, str(size)))
+            for _ in range(RECHECKS): # 遅くなったように見えたら測り直し、たまたまの遅れでは失敗にしない
+                if not base or micros <= base * (1 + args.threshold):
+                    break
+                micros = min(micros, measure(func, args.repeat))
+            results.setdefault(name, {})[str(size)] = round(micros, 3)
+            change = f"{micros / base - 1:+.0%}" if base else "-"
+            print(f"{name:<26} | {size:>7} | {micros:>10.1f} | {f'{base:.1f}' if base is not None else '-':>10} | {change:>7}", flush=True)
+            if base and micros > base * (1 + args.threshold):
+                regressions.append(f"{name} ({size} devices): {micros:.1f} us vs baseline {base:.1f} us")
+
+    if regressions:
+        print(f"Regressions beyond {args.threshold:.0%} (this run is not recorded):")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    if not args.no_save:
+        with open(args.history, 'a') as f:
+            f.write(json.dumps({"timestamp": datetime.datetime.now().isoformat(timespec="seconds"), "commit": current_commit(),
+                                "machine": machine, "repeat": args.repeat, "results": results}) + "\n")
+        print(f"Recorded this run in {args.history}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# bench_startup.py
+# server_app.py の起動時間 (init_server) を、保存済みのアタッチ情報の件数と startup_mode ("warm" / "cold") ごとに測る。
+# 一時ディレクトリにジャーナルと疑似 sysfs (usbip-host の usbip_status) を作り、半分をアタッチ中としておく。
+# 計測は件数ごとに別プロセスで行う (server_app のモジュール状態を持ち越さないため)。
+#
+# 使い方: python bench_startup.py [--entries 100 300 1000] [--modes warm cold] [--repeat 3]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_PREFIX = "BENCH_RESULT "
+
+
+def prepare(work_dir, entries):
+    """ジャーナル (attach を entries 件) と、偶数番目のデバイスだけアタッチ中の疑似 sysfs を作る"""
+    usbip_host_dir = os.path.join(work_dir, 'sys', 'bus', 'usb', 'drivers', 'usbip-host')
+    os.makedirs(usbip_host_dir)
+    with open(os.path.join(work_dir, 'server_state.journal'), 'w') as f:
+        for i in range(entries):
+            bus_id = f"{i // 100 + 1}-1.{i % 100 + 1}"
+            info = {"client_ip": f"192.168.2.{i % 250 + 1}", "username": f"user{i % 50}",
+                    "timestamp": json.dumps("2026-10-17 09:00:00.000000")}
+            f.write(json.dumps({"seq": i + 1, "op": "attach", "bus_id": bus_id, "info": info}) + "\n")
+            os.makedirs(os.path.join(usbip_host_dir, bus_id))
+            with open(os.path.join(usbip_host_dir, bus_id, 'usbip_status'), 'w') as status_file:
+                status_file.write("2\n" if i % 2 == 0 else "1\n")
+
+def run_child(work_dir, mode):
+    """init_server を1回実行して所要時間と残ったアタッチ情報の件数を出力する (子プロセス側)"""
+    os.chdir(work_dir)
+    sys.path.insert(0, BENCH_DIR)
+    import server_app
+    started_at = time.perf_counter()
+    server_app.init_server({"startup_mode": mode, "sysfs_root": os.path.join(work_dir, 'sys'),
+                            "reconcile_interval": 0, "log_level": "WARNING"})
+    elapsed = time.perf_counter() - started_at
+    # サーバーのログも標準出力に出るので、結果の行には目印を付ける
+    print(RESULT_PREFIX + json.dumps({"elapsed": elapsed, "attachments": len(server_app.get_state().attached_devices_log)}), flush=True)
+
+def measure(entries, mode, repeat):
+    results = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as work_dir:
+            prepare(work_dir, entries)
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', work_dir, mode],
+                                    capture_output=True, text=True, check=True).stdout
+            result_line = next(line for line in output.splitlines() if line.startswith(RESULT_PREFIX))
+            results.append(json.loads(result_line[len(RESULT_PREFIX):]))
+    return min(result["elapsed"] for result in results), results[-1]["attachments"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure server startup time with a persisted attachment log")
+    parser.add_argument('--entries', type=int, nargs='+', default=[100, 300, 1000])
+    parser.add_argument('--modes', nargs='+', default=["warm", "cold"], choices=["warm", "cold"])
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement (best is reported)")
+    parser.add_argument('--child', nargs=2, metavar=("WORK_DIR", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(*args.child)
+        return
+
+    print(f"{'entries':>8} | {'mode':>5} | {'init_server ms':>14} | {'attachments after':>17}")
+    print(f"{'-' * 8}-+-{'-' * 5}-+-{'-' * 14}-+-{'-' * 17}")
+    for entries in args.entries:
+        for mode in args.modes:
+            elapsed, attachments = measure(entries, mode, args.repeat)
+            print(f"{entries:>8} | {mode:>5} | {elapsed * 1000:>14.1f} | {attachments:>17}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# bench_usbip_parser.py
+# usbip_output.py のパーサーを、置き換え前のパーサー (この中に残してある) と比較する。
+#   1. 差分チェック: 合成した出力を両方のパーサーに通し、結果が一致することを確認する (不一致なら終了コード 1)
+#   2. ベンチマーク: 1k〜50k デバイス分の出力で、文字列からのパースと、パイプ (cat) から読みながらのパースの時間を測る
+#
+# 使い方: python bench_usbip_parser.py [--sizes 1000 5000 10000 50000] [--repeat 5]
+
+import argparse
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from usbip_output import parse_usbip_list_l_output, parse_remote_list_output
+
+
+# --- 置き換え前のパーサー (差分チェック用。server_app.py / client_gui.py にあったものと同じ) ---
+def legacy_parse_usbip_list_l_output(output_str):
+    devices = []
+    lines = output_str.strip().split('\n')
+    i = 0
+    while i < len(lines):
+        line1 = lines[i].strip(); i += 1
+        busid_match = re.match(r'-\s*busid\s+([\w\.-]+)\s*\((\w{4}:\w{4})\)', line1)
+        if busid_match:
+            busid = busid_match.group(1)
+            vid_pid_busid_line = busid_match.group(2)
+            vid_busid, pid_busid = vid_pid_busid_line.split(':')
+            description = f"Device {busid} (VID:{vid_busid} PID:{pid_busid})"
+            vid_desc_line, pid_desc_line = vid_busid, pid_busid
+            if i < len(lines):
+                line2 = lines[i].strip()
+                if line2:
+                    desc_vid_pid_match = re.search(r'\((\w{4}:\w{4})\)$', line2)
+                    if desc_vid_pid_match:
+                        vid_pid_from_desc = desc_vid_pid_match.group(1)
+                        vid_desc_line, pid_desc_line = vid_pid_from_desc.split(':')
+                        description_text_only = re.sub(r'\s*\(\w{4}:\w{4}\)$', '', line2).strip()
+                        if description_text_only: description = description_text_only
+                    else: description = line2
+                    i += 1
+            devices.append({"bus_id": busid, "description": description, "vid": vid_desc_line, "pid": pid_desc_line})
+        while i < len(lines) and not lines[i].strip(): i += 1
+    return devices
+
+def legacy_parse_remote_list_output(output_str):
+    bound_bus_ids = set()
+    lines = output_str.strip().split('\n')
+    parsing_devices = False
+    for line in lines:
+        stripped_line = line.strip()
+        if stripped_line.startswith("Exportable USB devices"):
+            parsing_devices = True
+            continue
+        if not parsing_devices or not stripped_line:
+            continue
+        match = re.match(r'([\w\.-]+)\s*:', stripped_line)
+        if match:
+            bound_bus_ids.add(match.group(1))
+    return bound_bus_ids
+
+
+# --- 合成データ ---
+def make_list_l_output(device_count, seed=0, newline='\n'):
+    """
+    `usbip list -l` 形式の出力を作る。両方のパーサーが同じ結果を返すはずの形のゆらぎを混ぜる
+    (説明行に ID がない、説明が空で ID だけ、説明行がない、前後の空白、CRLF)。
+    """
+    rng = random.Random(seed)
+    out = []
+    for i in range(device_count):
+        bus_id = f"{i // 1000 + 1}-{i % 1000 // 100 + 1}.{i % 100 + 1}"
+        vid, pid = f"{rng.randrange(0x10000):04x}", f"{rng.randrange(0x10000):04x}"
+        out.append(f" - busid {bus_id} ({vid}:{pid})")
+        kind = rng.random()
+        if kind < 0.85:
+            desc_vid, desc_pid = (vid, pid) if rng.random() < 0.9 else ("abcd", "0123")
+            out.append(f"   Vendor {i % 37} Inc. : Product {i} (rev {i % 7}) ({desc_vid}:{desc_pid})  ")
+        elif kind < 0.92:
+            out.append("   unknown vendor : unknown product")
+        elif kind < 0.96:
+            out.append(f"   ({vid}:{pid})")
+        # それ以外は説明行なし (空行のみ)
+        out.append("")
+    return newline.join(out) + newline
+
+def make_remote_list_output(device_count, host="192.168.2.123"):
+    out = ["Exportable USB devices", "======================", f" - {host}"]
+    for i in range(device_count):
+        bus_id = f"{i // 1000 + 1}-{i % 1000 // 100 + 1}.{i % 100 + 1}"
+        out.append(f"      {bus_id}: Vendor {i % 37} Inc. : Product {i} (1234:{i % 0x10000:04x})")
+        out.append(f"           : /sys/devices/platform/soc/3f980000.usb/usb1/{bus_id}")
+        out.append("           : (Defined at Interface level) (00/00/00)")
+        out.append("")
+    return "\n".join(out) + "\n"
+
+
+# --- 差分チェック ---
+def differential_check(sizes):
+    failures = 0
+    cases = []
+    for size in sizes:
+        for seed in range(3):
+            cases.append((f"list -l, {size} devices, seed {seed}", make_list_l_output(size, seed)))
+        cases.append((f"list -l, {size} devices, CRLF", make_list_l_output(size, 99, newline='\r\n')))
+    cases += [("list -l, empty", ""), ("list -l, header only", "usbip: error: no exportable devices found\n")]
+    for name, text in cases:
+        expected, actual = legacy_parse_usbip_list_l_output(text), parse_usbip_list_l_output(text)
+        if expected != actual:
+            failures += 1
+            mismatch = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+            print(f"MISMATCH {name}: first difference at record {mismatch}: "
+                  f"legacy={expected[mismatch:mismatch + 1]} new={actual[mismatch:mismatch + 1]}")
+        # 文字列を渡しても、行のイテラブル (パイプから読む場合) を渡しても同じ結果になること
+        elif parse_usbip_list_l_output(iter(text.splitlines(keepends=True))) != actual:
+            failures += 1
+            print(f"MISMATCH {name}: string input and line-iterator input differ")
+    for size in sizes:
+        text = make_remote_list_output(size)
+        if legacy_parse_remote_list_output(text) != parse_remote_list_output(text):
+            failures += 1
+            print(f"MISMATCH list -r, {size} devices")
+    print(f"differential check: {len(cases) + len(sizes) - failures}/{len(cases) + len(sizes)} cases match")
+
+    # 置き換え前のパーサーでは読めなかった形式
+    variants = ("busid 1-1.2 (0424:ec00)\n   SMSC : LAN9512 (0424:ec00)\n\n"
+                " - busid 1-1.3 (046d:c52b)\n - busid 1-1.4 (046d:c077)\n   Logitech : M105 (046d:c077)\n\n"
+                "busid=1-1.5#usbid=0781:5567#\n")
+    bus_ids = [dev["bus_id"] for dev in parse_usbip_list_l_output(variants)]
+    if bus_ids != ["1-1.2", "1-1.3", "1-1.4", "1-1.5"]:
+        failures += 1
+        print(f"MISMATCH format variants: {bus_ids}")
+    return failures
+
+
+# --- ベンチマーク ---
+def best_of(repeat, func):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def benchmark(sizes, repeat):
+    print()
+    print(f"{'devices':>8} | {'legacy ms':>10} | {'new ms':>8} | {'speedup':>7} | {'new via pipe ms':>15} | {'list -r legacy/new ms':>21}")
+    print(f"{'-' * 8}-+-{'-' * 10}-+-{'-' * 8}-+-{'-' * 7}-+-{'-' * 15}-+-{'-' * 21}")
+    for size in sizes:
+        text = make_list_l_output(size)
+        legacy = best_of(repeat, lambda: legacy_parse_usbip_list_l_output(text))
+        new = best_of(repeat, lambda: parse_usbip_list_l_output(text))
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            f.write(text)
+            f.flush()
+            def parse_from_pipe():
+                # サーバーと同じく、子プロセスの stdout を読みながらパースする (cat を usbip の代わりに使う)
+                process = subprocess.Popen(['cat', f.name], stdout=subprocess.PIPE, text=True)
+                parse_usbip_list_l_output(process.stdout)
+                process.wait()
+            piped = best_of(repeat, parse_from_pipe)
+        remote_text = make_remote_list_output(size)
+        remote_legacy = best_of(repeat, lambda: legacy_parse_remote_list_output(remote_text))
+        remote_new = best_of(repeat, lambda: parse_remote_list_output(remote_text))
+        print(f"{size:>8} | {legacy * 1000:>10.2f} | {new * 1000:>8.2f} | {legacy / new:>6.1f}x | {piped * 1000:>15.2f} | "
+              f"{remote_legacy * 1000:>9.2f} / {remote_new * 1000:>9.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare usbip output parsers (correctness and speed)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 10000, 50000])
+    parser.add_argument('--repeat', type=int, default=5, help="runs per measurement (best is reported)")
+    parser.add_argument('--check-only', action='store_true', help="run the differential check without timing")
+    args = parser.parse_args()
+
+    failures = differential_check(args.sizes)
+    if not args.check_only:
+        benchmark(args.sizes, args.repeat)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# bench_workers.py
+# server_app.py をワーカー数 1, 2, 4 で起動し、/device_status と /notify_attach の requests/sec を比較するベンチマーク。
+# 実際の usbip の代わりに、一時ディレクトリに置いた偽の usbip コマンドを PATH の先頭に追加して使う。
+#
+# 使い方: python bench_workers.py [--workers 1 2 4] [--duration 10] [--concurrency 16] [--devices 20]
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER_APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server_app.py')
+
+FAKE_USBIP_TEMPLATE = '''#!/bin/sh
+# ベンチマーク用の偽 usbip。list -l はデバイス一覧を出力し、それ以外は成功だけ返す。
+if [ "$1" = "list" ]; then
+    cat "{list_output_path}"
+fi
+exit 0
+'''
+
+def write_fake_usbip(bin_dir, device_count):
+    """`usbip list -l` 形式の出力を返す偽コマンドを作る"""
+    list_output_path = os.path.join(bin_dir, 'usbip_list_l.txt')
+    with open(list_output_path, 'w') as f:
+        for i in range(device_count):
+            f.write(f" - busid 1-1.{i + 1} (1234:{i:04x})\n")
+            f.write(f"   Bench Vendor : Bench Device {i} (1234:{i:04x})\n\n")
+    usbip_path = os.path.join(bin_dir, 'usbip')
+    with open(usbip_path, 'w') as f:
+        f.write(FAKE_USBIP_TEMPLATE.format(list_output_path=list_output_path))
+    os.chmod(usbip_path, 0o755)
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_server(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def start_server(work_dir, bin_dir, port, workers):
+    with open(os.path.join(work_dir, 'server_config.json'), 'w') as f:
+        json.dump({"state_backend": "sqlite", "host": "127.0.0.1"}, f)
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+    log = open(os.path.join(work_dir, f'server_{workers}.log'), 'w')
+    process = subprocess.Popen([sys.executable, SERVER_APP_PATH, '--workers', str(workers), '--port', str(port)],
+                               cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    if not wait_for_server(port):
+        process.terminate()
+        raise RuntimeError(f"server did not start (see {log.name})")
+    return process
+
+def load_worker(args):
+    """1つの負荷生成プロセス。keep-alive 接続でリクエストを送り続け、成功数を返す"""
+    port, endpoint, duration, worker_id = args
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    completed = errors = 0
+    deadline = time.monotonic() + duration
+    i = 0
+    while time.monotonic() < deadline:
+        i += 1
+        try:
+            if endpoint == '/notify_attach':
+                body = json.dumps({"client_ip": f"10.0.{worker_id}.1", "username": f"bench{worker_id}",
+                                   "attached_bus_id": f"1-1.{i % 20 + 1}"})
+                conn.request('POST', endpoint, body=body, headers={'Content-Type': 'application/json'})
+            else:
+                conn.request('GET', endpoint)
+            response = conn.getresponse()
+            response.read()
+            if response.status < 400: completed += 1
+            else: errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.close()
+    return completed, errors
+
+def run_load(port, endpoint, duration, concurrency):
+    with multiprocessing.Pool(concurrency) as pool:
+        started = time.monotonic()
+        results = pool.map(load_worker, [(port, endpoint, duration, i) for i in range(concurrency)])
+        elapsed = time.monotonic() - started
+    completed = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    return completed / elapsed, errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare server_app.py throughput across worker counts")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per endpoint")
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrent client processes")
+    parser.add_argument('--devices', type=int, default=20, help="devices reported by the fake usbip")
+    args = parser.parse_args()
+
+    results = []
+    for workers in args.workers:
+        work_dir = tempfile.mkdtemp(prefix=f'usbip_bench_{workers}_')
+        bin_dir = os.path.join(work_dir, 'bin')
+        os.makedirs(bin_dir)
+        write_fake_usbip(bin_dir, args.devices)
+        port = find_free_port()
+        process = start_server(work_dir, bin_dir, port, workers)
+        try:
+            status_rps, status_errors = run_load(port, '/device_status', args.duration, args.concurrency)
+            attach_rps, attach_errors = run_load(port, '/notify_attach', args.duration, args.concurrency)
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+            shutil.rmtree(work_dir, ignore_errors=True)
+        results.append((workers, status_rps, status_errors, attach_rps, attach_errors))
+        print(f"workers={workers}: /device_status {status_rps:.1f} req/s ({status_errors} errors), "
+              f"/notify_attach {attach_rps:.1f} req/s ({attach_errors} errors)")
+
+    print()
+    print(f"{'workers':>7} | {'/device_status req/s':>20} | {'/notify_attach req/s':>20}")
+    print(f"{'-' * 7}-+-{'-' * 20}-+-{'-' * 20}")
+    for workers, status_rps, _, attach_rps, _ in results:
+        print(f"{workers:>7} | {status_rps:>20.1f} | {attach_rps:>20.1f}")
+
+if __name__ == '__main__':
+    main()
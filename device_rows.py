@@ -0,0 +1,74 @@
+# device_rows.py
+# クライアントのデバイス一覧の行を作る処理。Tk を使わないので、client_gui.py の画面を作らずに呼べる (bench_hot_paths.py など)。
+
+def merge_device_rows(server_data, bound_bus_ids, client_ip, client_username):
+    """
+    サーバーの /device_status 応答とバインド済みバスIDをマージし、Treeviewの行を作る (不整合も考慮)。
+    ゲートウェイ (gateway_app.py) の応答では、bus_id の代わりに device_key ("<サーバー名>/<bus_id>") を行のキーにする
+    (bound_bus_ids も device_key の集合で渡す)。
+    戻り値: [(bus_id, values, tags), ...]  values = (bus_id, description, bind_status, attach_status)
+    """
+    rows = []
+    exported_devices = server_data.get("exported_devices_list", [])
+    app_attachments = server_data.get("app_managed_attachments", {})
+
+    for dev in exported_devices:
+        # ゲートウェイ経由なら複数のサーバーで同じバスIDがあっても区別できるキー (アタッチ情報のキーも同じ)
+        bus_id = dev.get("device_key") or dev.get("bus_id", "N/A")
+        description = dev.get("description", "N/A")
+        vid = dev.get("vid", "")
+        pid = dev.get("pid", "")
+        display_desc = f"{description} (VID:{vid} PID:{pid})"
+
+        # 1. まず、アタッチ状態をアプリのログから判断 (最優先)
+        attach_status_text = "Available"
+        is_used_by_me = False
+        is_used_by_other = False
+        
+        if bus_id in app_attachments:
+            attach_info = app_attachments[bus_id]
+            user_info_str = f"{attach_info.get('username') or 'Unknown'} ({attach_info.get('client_ip') or 'N/A'})"
+            
+            if attach_info.get('client_ip') == client_ip:
+                attach_status_text = f"Attached by: You ({client_username})"
+                is_used_by_me = True
+            else:
+                attach_status_text = f"In use by: {user_info_str}"
+                is_used_by_other = True
+
+        # 2. 次に、バインド状態を判断
+        is_technically_bound = bus_id in bound_bus_ids # 技術的なバインド状態
+        bind_status_text = "" # 表示用の文字列
+
+        # ★★★ ここからが修正の核 ★★★
+        inconsistency_detected = False
+        
+        if is_used_by_me or is_used_by_other:
+            # 誰かがアタッチしている場合、表示上のBind Statusは "Bound" とする
+            bind_status_text = "Bound"
+            # ただし、技術的にバインドされていない場合は不整合
+            if not is_technically_bound:
+                inconsistency_detected = True
+                # Attach Status に警告マークを追加
+                attach_status_text += " [!]"
+        else:
+            # 誰もアタッチしていない場合は、技術的なバインド状態をそのまま表示
+            bind_status_text = "Bound" if is_technically_bound else "Unbound"
+        
+        # --------------------------------------------------------
+
+        # タグ付け
+        tag_list = []
+        if is_used_by_me:
+            tag_list.append("used_by_me")
+        
+        if is_technically_bound: # タグは技術的な状態で付ける
+            tag_list.append("bound")
+        else:
+            tag_list.append("unbound")
+            
+        if inconsistency_detected:
+            tag_list.append("inconsistent")
+        
+        rows.append((bus_id, (bus_id, display_desc, bind_status_text, attach_status_text), tuple(tag_list)))
+    return rows
@@ -0,0 +1,325 @@
+# gateway_app.py
+# 複数の server_app.py (Raspberry Pi ごとに1台) をまとめるゲートウェイ。
+# 各サーバーの /device_status を並列に取得して1つの一覧にまとめ、アタッチ通知やバインド指示を該当するサーバーへ転送する。
+# デバイスは (サーバー名, bus_id) で区別し、一覧では "device_key": "<サーバー名>/<bus_id>" を付ける。
+# USB/IP の通信そのもの (usbip attach) はゲートウェイを通らないので、クライアントは各デバイスの server_host に接続する。
+# client_gui.py の接続先にゲートウェイを指定すると、一覧の行を device_key で区別し、usbip attach は server_host に対して実行する。
+
+from flask import Flask, request, jsonify, Response
+import requests
+import json
+import os
+import threading
+import time
+import hashlib
+import argparse
+import concurrent.futures
+from urllib.parse import urlparse
+import app_logging
+import app_metrics
+
+app = Flask(__name__)
+log = app_logging.setup_logging("usbip_gateway") # 設定ファイル読み込み後に log_* の設定で作り直す
+
+# --- 設定 ---
+GATEWAY_CONFIG_FILE = 'gateway_config.json'
+
+DEFAULT_GATEWAY_CONFIG = {
+    # まとめるサーバーの一覧。url は server_app.py のURL。name を省略するとホスト名を使う
+    "backends": [
+        # {"name": "pi01", "url": "http://192.168.2.101:5000"},
+    ],
+    "backend_timeout": 2.0, # 1サーバーあたりの /device_status の制限時間 (秒)。これを過ぎたら前回の結果を使う
+    "backend_cache_ttl": 5.0, # 取得した /device_status を使い回す秒数
+    "backend_stale_ttl": 300.0, # 取得に失敗し続けても前回の結果を表示し続ける秒数 (過ぎたら一覧から外す)
+    "forward_timeout": 30.0, # 転送したバインド/アンバインドなどの制限時間 (秒)
+    "max_workers": 16, # サーバーへの同時リクエスト数
+    "log_level": "INFO",
+    "log_format": "json",
+    "log_file": None,
+    "host": "0.0.0.0",
+    "port": 5100,
+}
+gateway_config = DEFAULT_GATEWAY_CONFIG.copy()
+
+# メトリクス (/metrics)
+metrics = app_metrics.MetricsRegistry()
+backend_fetch_duration = metrics.histogram("usbip_gateway_backend_fetch_duration_seconds",
+                                           "Duration of /device_status fetches per backend", ["backend", "outcome"])
+forward_duration = metrics.histogram("usbip_gateway_forward_duration_seconds",
+                                     "Duration of operations forwarded to backends", ["backend", "endpoint", "status"])
+
+backends = {} # name -> Backend
+fetch_executor = None # /device_status の取得に使うスレッドプール
+merged_body_cache = (None, None, None) # (各サーバーの世代のタプル, ETag, 直列化済みJSON)。参照ごと差し替える
+
+
+class Backend:
+    """1台のサーバー。最後に取得した /device_status と取得状況を持つ"""
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.host = urlparse(self.url).hostname # クライアントが usbip attach で接続するホスト
+        self.lock = threading.Lock()
+        self.data = None # 最後に取得できた /device_status の応答
+        self.etag = None
+        self.generation = 0 # data が変わるたびに増える (まとめた一覧の作り直し判定用)
+        self.fetched_at = 0.0 # 最後に取得 (または 304 で確認) できた時刻
+        self.last_error = None
+        self.invalidated = False # 操作を転送した後など、TTL内でも次の /device_status で取り直す
+        self.in_flight = None # 実行中の取得 (Future)。同じサーバーへの取得は同時に1つだけ
+
+    def fetch(self):
+        """/device_status を取得する (fetch_executor のスレッドで実行)"""
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        timeout = float(gateway_config.get("backend_timeout", 2.0))
+        started_at = time.perf_counter()
+        outcome = "error"
+        try:
+            response = requests.get(f"{self.url}/device_status", headers=headers, timeout=(timeout, timeout))
+            if response.status_code == 304:
+                outcome = "not_modified"
+                with self.lock:
+                    self.fetched_at, self.last_error, self.invalidated = time.monotonic(), None, False
+                return
+            response.raise_for_status()
+            data = response.json()
+            outcome = "ok"
+            with self.lock:
+                self.data, self.etag = data, response.headers.get("ETag")
+                self.generation += 1
+                self.fetched_at, self.last_error, self.invalidated = time.monotonic(), None, False
+        except (requests.exceptions.RequestException, ValueError) as e:
+            outcome = "timeout" if isinstance(e, requests.exceptions.Timeout) else "error"
+            with self.lock:
+                self.last_error = str(e)
+            log.warning("Failed to fetch backend device status", extra={"backend": self.name, "error": str(e)})
+        finally:
+            backend_fetch_duration.observe(time.perf_counter() - started_at, self.name, outcome)
+            with self.lock:
+                self.in_flight = None
+
+    def refresh_if_needed(self):
+        """キャッシュが古ければ取得を始め、その Future を返す (新しければ None)"""
+        with self.lock:
+            if self.in_flight is not None:
+                return self.in_flight # 実行中の取得に相乗り
+            if self.data is not None and not self.invalidated and time.monotonic() - self.fetched_at < float(gateway_config.get("backend_cache_ttl", 5.0)):
+                return None
+            self.in_flight = fetch_executor.submit(self.fetch)
+            return self.in_flight
+
+    def invalidate(self):
+        with self.lock:
+            self.invalidated = True
+
+    def snapshot(self):
+        """(data, generation, 状態) を返す。状態は ok / stale / unreachable"""
+        with self.lock:
+            age = time.monotonic() - self.fetched_at if self.data is not None else None
+            if self.data is None or age > float(gateway_config.get("backend_stale_ttl", 300.0)):
+                return None, self.generation, {"status": "unreachable", "error": self.last_error}
+            status = "ok" if self.last_error is None and age < float(gateway_config.get("backend_cache_ttl", 5.0)) * 2 else "stale"
+            return self.data, self.generation, {"status": status, "age": round(age, 1), "error": self.last_error}
+
+
+# --- ヘルパー関数 (設定) ---
+def load_gateway_config():
+    global gateway_config, log, fetch_executor
+    config = DEFAULT_GATEWAY_CONFIG.copy()
+    if os.path.exists(GATEWAY_CONFIG_FILE):
+        try:
+            with open(GATEWAY_CONFIG_FILE, 'r') as f:
+                loaded_settings = json.load(f)
+                if isinstance(loaded_settings, dict): config.update(loaded_settings)
+        except Exception as e: log.error(f"Error loading gateway config from {GATEWAY_CONFIG_FILE}: {e}. Using default settings.")
+    gateway_config = config
+    log = app_logging.setup_logging("usbip_gateway", level=gateway_config.get("log_level", "INFO"),
+                                    log_format=gateway_config.get("log_format", "json"), log_file=gateway_config.get("log_file"))
+    backends.clear()
+    for entry in gateway_config.get("backends", []):
+        url = entry.get("url") if isinstance(entry, dict) else str(entry)
+        name = (entry.get("name") if isinstance(entry, dict) else None) or urlparse(url).hostname
+        if name in backends or "/" in name:
+            log.error("Skipping backend with duplicate or invalid name", extra={"backend": name})
+            continue
+        backends[name] = Backend(name, url)
+    fetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(gateway_config.get("max_workers", 16)),
+                                                           thread_name_prefix="backend-fetch")
+    log.info("Loaded gateway config", extra={"backends": {name: backend.url for name, backend in backends.items()}})
+
+def split_device_key(device_key):
+    """"<サーバー名>/<bus_id>" を (Backend, bus_id) に分ける。該当するサーバーがなければ (None, None)"""
+    name, _, bus_id = str(device_key or "").partition("/")
+    return backends.get(name), bus_id or None
+
+def resolve_target(data, bus_id_field):
+    """
+    転送先のサーバーと bus_id を決める。リクエストに "server" があればそれを使い、
+    なければ bus_id を "<サーバー名>/<bus_id>" として解釈する。
+    """
+    if data.get("server"):
+        return backends.get(data["server"]), data.get(bus_id_field)
+    return split_device_key(data.get(bus_id_field))
+
+
+# --- ヘルパー関数 (一覧のまとめ) ---
+def refresh_backends():
+    """古くなったサーバーの取得を並列に始め、backend_timeout 秒まで待つ (間に合わないサーバーは前回の結果を使う)"""
+    futures = [future for future in (backend.refresh_if_needed() for backend in backends.values()) if future is not None]
+    if futures:
+        concurrent.futures.wait(futures, timeout=float(gateway_config.get("backend_timeout", 2.0)))
+
+def build_merged_body(snapshots):
+    """各サーバーの /device_status を1つにまとめる。デバイスには server / server_host / device_key を付ける"""
+    merged_devices = []
+    merged_attachments = []
+    app_managed_attachments = {}
+    backend_status = {}
+    for name, (data, _, status) in snapshots.items():
+        backend = backends[name]
+        backend_status[name] = dict(status, url=backend.url, devices=len(data.get("exported_devices_list", [])) if data else 0)
+        if data is None:
+            continue
+        for dev in data.get("exported_devices_list", []):
+            merged_devices.append(dict(dev, server=name, server_host=backend.host, device_key=f"{name}/{dev.get('bus_id')}"))
+        for attachment in data.get("current_attachments_managed_by_app", []):
+            merged_attachments.append(dict(attachment, server=name, device_key=f"{name}/{attachment.get('bus_id')}"))
+        for bus_id, info in data.get("app_managed_attachments", {}).items():
+            app_managed_attachments[f"{name}/{bus_id}"] = dict(info, server=name)
+    response_data = {
+        "exported_devices_list": merged_devices,
+        "current_attachments_managed_by_app": merged_attachments,
+        "app_managed_attachments": app_managed_attachments,
+        "backends": backend_status, # サーバーごとの取得状況 (ok / stale / unreachable)
+    }
+    return json.dumps(response_data).encode('utf-8')
+
+
+# --- API エンドポイント ---
+@app.route('/device_status', methods=['GET'])
+def device_status():
+    """全サーバーのデバイス一覧をまとめて返す。遅い/止まっているサーバーがあっても backend_timeout 秒で応答する"""
+    global merged_body_cache
+    refresh_backends()
+    snapshots = {name: backend.snapshot() for name, backend in backends.items()}
+    # 各サーバーの世代と状態が前回と同じなら、まとめ直さずに前回の応答を返す
+    cache_key = tuple((name, generation, status["status"]) for name, (_, generation, status) in snapshots.items())
+    cached_key, etag, body = merged_body_cache
+    if cached_key != cache_key:
+        body = build_merged_body(snapshots)
+        etag = hashlib.sha1(body).hexdigest()[:16]
+        merged_body_cache = (cache_key, etag, body)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def forward(backend, endpoint, payload):
+    """リクエストをサーバーへ転送し、(応答JSON, ステータスコード) を返す"""
+    started_at = time.perf_counter()
+    status = "error"
+    try:
+        response = requests.post(f"{backend.url}{endpoint}", json=payload, timeout=float(gateway_config.get("forward_timeout", 30.0)))
+        status = str(response.status_code)
+        try: body = response.json()
+        except ValueError: body = {"error": response.text}
+        return body, response.status_code
+    except requests.exceptions.RequestException as e:
+        log.warning("Failed to forward request", extra={"backend": backend.name, "endpoint": endpoint, "error": str(e)})
+        return {"error": f"Backend {backend.name} is unreachable: {e}"}, 502
+    finally:
+        forward_duration.observe(time.perf_counter() - started_at, backend.name, endpoint, status)
+        backend.invalidate() # 次の /device_status では取り直す
+
+def forward_single_device(endpoint, bus_id_field):
+    """1台のデバイスに対する操作を、そのデバイスのサーバーへ転送する"""
+    data = request.json or {}
+    backend, bus_id = resolve_target(data, bus_id_field)
+    if backend is None or not bus_id:
+        return jsonify({"error": f"Unknown server for {data.get(bus_id_field)}. Use '<server>/<bus_id>' or set 'server'."}), 400
+    payload = {key: value for key, value in data.items() if key != "server"}
+    payload[bus_id_field] = bus_id
+    body, status_code = forward(backend, endpoint, payload)
+    headers = {}
+    if status_code == 429 and isinstance(body, dict) and body.get("retry_after"):
+        headers['Retry-After'] = str(body["retry_after"]) # サーバーの混雑/レート制限をクライアントにそのまま伝える
+    return jsonify(dict(body, server=backend.name) if isinstance(body, dict) else body), status_code, headers
+
+@app.route('/notify_attach', methods=['POST'])
+def notify_attach():
+    return forward_single_device('/notify_attach', 'attached_bus_id')
+
+@app.route('/notify_detach', methods=['POST'])
+def notify_detach():
+    return forward_single_device('/notify_detach', 'detached_bus_id')
+
+@app.route('/manage_server_device_binding', methods=['POST'])
+def manage_server_device_binding():
+    return forward_single_device('/manage_server_device_binding', 'bus_id')
+
+def fan_out(targets):
+    """[(backend, endpoint, payload)] を並列に転送し、サーバー名 -> (応答JSON, ステータスコード) を返す"""
+    futures = {fetch_executor.submit(forward, backend, endpoint, payload): backend.name for backend, endpoint, payload in targets}
+    return {futures[future]: future.result() for future in concurrent.futures.as_completed(futures)}
+
+def multi_status_response(results):
+    """サーバーごとの結果をまとめる。全サーバーが 2xx なら 200、そうでなければ 207"""
+    all_ok = all(200 <= status_code < 300 for _, status_code in results.values())
+    return jsonify({"results": {name: {"status_code": status_code, "response": body} for name, (body, status_code) in results.items()}}), \
+        200 if all_ok else 207
+
+@app.route('/manage_server_device_binding_batch', methods=['POST'])
+def manage_server_device_binding_batch():
+    """操作をサーバーごとに分けて、各サーバーの一括エンドポイントへ並列に転送する"""
+    operations = (request.json or {}).get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "Missing or invalid operations list"}), 400
+    per_backend = {}
+    for op in operations:
+        backend, bus_id = resolve_target(op if isinstance(op, dict) else {}, 'bus_id')
+        if backend is None or not bus_id:
+            return jsonify({"error": f"Unknown server in operation: {op}"}), 400
+        per_backend.setdefault(backend.name, []).append({"action": op.get("action"), "bus_id": bus_id})
+    return multi_status_response(fan_out([(backends[name], '/manage_server_device_binding_batch', {"operations": ops})
+                                          for name, ops in per_backend.items()]))
+
+@app.route('/force_detach_all_server_devices', methods=['POST'])
+def force_detach_all_server_devices():
+    """"server" を指定すればそのサーバーだけ、省略すれば全サーバーで強制デタッチする"""
+    server = (request.json or {}).get("server")
+    if server and server not in backends:
+        return jsonify({"error": f"Unknown server: {server}"}), 400
+    targets = [backends[server]] if server else list(backends.values())
+    return multi_status_response(fan_out([(backend, '/force_detach_all_server_devices', {}) for backend in targets]))
+
+@app.route('/register_client_user', methods=['POST'])
+def register_client_user():
+    """ユーザー情報は全サーバーに登録する"""
+    data = request.json or {}
+    return multi_status_response(fan_out([(backend, '/register_client_user', data) for backend in backends.values()]))
+
+@app.route('/gateway_status', methods=['GET'])
+def gateway_status():
+    """サーバーごとの取得状況 (ok / stale / unreachable、前回取得からの秒数、エラー)"""
+    return jsonify({name: dict(backend.snapshot()[2], url=backend.url) for name, backend in backends.items()})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype=app_metrics.MetricsRegistry.CONTENT_TYPE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Gateway aggregating several USB/IP device sharing servers")
+    parser.add_argument('--port', type=int, help="listen port (overrides gateway_config.json)")
+    args = parser.parse_args()
+
+    load_gateway_config()
+    if not backends:
+        log.warning(f"No backends configured. Add them to {GATEWAY_CONFIG_FILE}.")
+    host, port = gateway_config.get("host", "0.0.0.0"), args.port or int(gateway_config.get("port", 5100))
+    app.run(host=host, port=port, threaded=True)
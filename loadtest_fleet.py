@@ -0,0 +1,379 @@
+# loadtest_fleet.py
+# 1台のサーバーに研究室全体のクライアントがつながったときの負荷を再現する負荷試験。
+#   - server_app.py (または server_asgi.py) を、偽の usbip コマンド (遅延・失敗率・デバイス数を指定できる) で起動する
+#   - N 個の模擬クライアントが client_gui.py と同じ順番でリクエストを送る (Tk は使わない):
+#       リフレッシュ: GET /device_status (If-None-Match 付き)
+#       アタッチ:     POST /register_client_user → (usbip attach の待ち) → POST /notify_attach → リフレッシュ
+#       デタッチ:     (usbip detach の待ち) → POST /notify_detach → リフレッシュ
+#     各クライアントは /events も購読し、inventory / resync を受け取ったらリフレッシュする。
+#     429 が返ったら client_gui.py と同じく Retry-After だけ待って送り直す。
+#     クライアントごとに 127.1.x.y の別の送信元アドレスを使う (サーバーのレート制限はクライアントごとにかかる)
+#   - エンドポイントごとのスループットと p50 / p95 / p99 を表示し、結果を JSON に書き出す
+#   - --baseline を渡すと前回の結果と比べ、--max-regression を超えて悪化していれば終了コード 1 で終わる (CI 用)
+#
+# 偽の usbip は呼ばれるたびに作業ディレクトリの usbip_fake.conf を読むので、実行中に書き換えて遅延や失敗率を変えられる。
+#
+# 使い方: python loadtest_fleet.py [--clients 50] [--duration 30] [--devices 40] [--latency 0.02 0.1] [--failure-rate 0]
+#                                  [--mode workers|asgi] [--output loadtest_results.json] [--baseline baseline.json]
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_workers import find_free_port, wait_for_server
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RETRY_AFTER_MAX_WAIT = 30 # client_gui.py と同じ
+REQUEST_TIMEOUT = 30
+
+FAKE_USBIP = '''#!/bin/sh
+# 負荷試験用の偽 usbip。設定 (LATENCY_MIN / LATENCY_MAX / FAILURE_RATE) は呼ばれるたびに読み直す
+. "{conf_path}"
+delay_and_fail=$(awk -v seed="$$$(date +%N)" -v lo="$LATENCY_MIN" -v hi="$LATENCY_MAX" -v rate="$FAILURE_RATE" \\
+    'BEGIN {{ srand(seed); printf "%.3f %d", lo + rand() * (hi - lo), rand() < rate }}')
+sleep "${{delay_and_fail% *}}"
+if [ "${{delay_and_fail#* }}" = "1" ]; then
+    echo "usbip: error: simulated failure" >&2
+    exit 1
+fi
+case "$1" in
+    list) cat "{list_output_path}" ;;
+    bind|unbind) echo "usbip: info: $1 device on busid $3: complete" ;;
+esac
+exit 0
+'''
+
+
+def write_fake_usbip(work_dir, device_count, latency, failure_rate):
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    list_output_path = os.path.join(bin_dir, 'usbip_list_l.txt')
+    with open(list_output_path, 'w') as f:
+        for i in range(device_count):
+            f.write(f" - busid {i // 100 + 1}-1.{i % 100 + 1} (1234:{i:04x})\n")
+            f.write(f"   Load Vendor : Load Device {i} (1234:{i:04x})\n\n")
+    conf_path = os.path.join(work_dir, 'usbip_fake.conf')
+    write_fake_usbip_conf(conf_path, latency, failure_rate)
+    usbip_path = os.path.join(bin_dir, 'usbip')
+    with open(usbip_path, 'w') as f:
+        f.write(FAKE_USBIP.format(conf_path=conf_path, list_output_path=list_output_path))
+    os.chmod(usbip_path, 0o755)
+    return bin_dir
+
+def write_fake_usbip_conf(conf_path, latency, failure_rate):
+    with open(conf_path + '.tmp', 'w') as f:
+        f.write(f"LATENCY_MIN={latency[0]}\nLATENCY_MAX={latency[1]}\nFAILURE_RATE={failure_rate}\n")
+    os.replace(conf_path + '.tmp', conf_path)
+
+def start_server(mode, work_dir, bin_dir, port, workers, config):
+    with open(os.path.join(work_dir, 'server_config.json'), 'w') as f:
+        json.dump(dict({"host": "0.0.0.0", "log_level": "WARNING", "reconcile_interval": 0, "startup_mode": "cold"}, **config), f)
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+    if mode == "asgi":
+        command = [sys.executable, os.path.join(BENCH_DIR, 'server_asgi.py'), '--port', str(port)]
+    else:
+        command = [sys.executable, os.path.join(BENCH_DIR, 'server_app.py'), '--workers', str(workers), '--port', str(port)]
+    log = open(os.path.join(work_dir, 'server.log'), 'w')
+    process = subprocess.Popen(command, cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    if not wait_for_server(port):
+        process.terminate()
+        raise RuntimeError(f"server did not start (see {log.name})")
+    return process
+
+
+# --- 集計 ---
+class EndpointStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {} # endpoint -> [秒] (成功と 304 のみ)
+        self.counts = {} # endpoint -> {"ok": n, "rejected": n (429), "errors": n (4xx/5xx/接続エラー)}
+
+    def record(self, endpoint, elapsed, status):
+        with self.lock:
+            counts = self.counts.setdefault(endpoint, {"ok": 0, "rejected": 0, "errors": 0})
+            if status == 429:
+                counts["rejected"] += 1
+            elif isinstance(status, int) and status < 400:
+                counts["ok"] += 1
+                self.latencies.setdefault(endpoint, []).append(elapsed)
+            else:
+                counts["errors"] += 1
+
+    def summary(self, elapsed):
+        results = {}
+        with self.lock:
+            for endpoint, counts in sorted(self.counts.items()):
+                latencies = sorted(self.latencies.get(endpoint, []))
+                def percentile(p):
+                    return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else None
+                results[endpoint] = dict(counts, rps=round(counts["ok"] / elapsed, 2),
+                                         p50_ms=percentile(0.50), p95_ms=percentile(0.95), p99_ms=percentile(0.99))
+        return results
+
+
+# --- 模擬クライアント ---
+class SimulatedClient:
+    """client_gui.py と同じ順番でリクエストを送る1クライアント (Tk なし)"""
+    def __init__(self, index, port, source_ip, stats, args, stop):
+        self.port = port
+        self.source_ip = source_ip
+        self.stats = stats
+        self.args = args
+        self.stop = stop
+        self.rng = random.Random(index)
+        self.client_ip = source_ip or f"10.1.{index // 250}.{index % 250 + 1}"
+        self.username = f"loaduser{index}"
+        self.conn = None
+        self.etag = None
+        self.devices = []
+        self.attached = set()
+        self.needs_refresh = threading.Event()
+
+    def connect(self):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=REQUEST_TIMEOUT,
+                                          source_address=(self.source_ip, 0) if self.source_ip else None)
+
+    def request(self, method, path, payload=None, headers=None):
+        """1リクエスト送る。戻り値: (ステータス, ETag, 本文)。接続エラーなら (None, None, None)"""
+        waited = 0.0
+        while True:
+            started_at = time.perf_counter()
+            try:
+                if self.conn is None:
+                    self.conn = self.connect()
+                request_headers = dict(headers or {})
+                body = None
+                if payload is not None:
+                    body = json.dumps(payload)
+                    request_headers['Content-Type'] = 'application/json'
+                self.conn.request(method, path, body=body, headers=request_headers)
+                response = self.conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                self.stats.record(path, time.perf_counter() - started_at, None)
+                self.close()
+                return None, None, None
+            self.stats.record(path, time.perf_counter() - started_at, response.status)
+            if response.will_close: # werkzeug の開発サーバーは HTTP/1.0 で1リクエストごとに接続を閉じる
+                self.close()
+            if response.status != 429:
+                return response.status, response.getheader('ETag'), data
+            # client_gui.server_request と同じく Retry-After だけ待って送り直す
+            try:
+                retry_after = max(0.0, float(response.getheader('Retry-After', 1)))
+            except ValueError:
+                retry_after = 1.0
+            if waited + retry_after > RETRY_AFTER_MAX_WAIT or self.stop.is_set():
+                return response.status, None, data
+            self.stop.wait(retry_after)
+            waited += retry_after
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def refresh(self):
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        status, etag, data = self.request('GET', '/device_status', headers=headers)
+        if status == 200:
+            self.etag = etag
+            self.devices = json.loads(data).get("exported_devices_list", [])
+
+    def attach(self):
+        available = [dev["bus_id"] for dev in self.devices if dev.get("status") == "Available"]
+        if not available:
+            return self.refresh()
+        bus_id = self.rng.choice(available)
+        status, _, _ = self.request('POST', '/register_client_user', {"ip_address": self.client_ip, "username": self.username})
+        if status != 200:
+            return
+        self.stop.wait(self.args.usbip_client_delay) # usbip attach (クライアント側)
+        status, _, _ = self.request('POST', '/notify_attach',
+                                    {"client_ip": self.client_ip, "username": self.username, "attached_bus_id": bus_id})
+        if status == 200:
+            self.attached.add(bus_id)
+        self.refresh()
+
+    def detach(self):
+        if not self.attached:
+            return self.refresh()
+        bus_id = self.rng.choice(sorted(self.attached))
+        self.stop.wait(self.args.usbip_client_delay) # usbip detach (クライアント側)
+        status, _, _ = self.request('POST', '/notify_detach',
+                                    {"client_ip": self.client_ip, "username": self.username, "detached_bus_id": bus_id})
+        if status == 200:
+            self.attached.discard(bus_id)
+        self.refresh()
+
+    def run(self):
+        actions = {"refresh": self.refresh, "attach": self.attach, "detach": self.detach}
+        names, weights = zip(*self.args.mix.items())
+        self.stop.wait(self.rng.uniform(0, self.args.think_time)) # 一斉に始めない
+        self.refresh()
+        while not self.stop.is_set():
+            if self.needs_refresh.is_set():
+                self.needs_refresh.clear()
+                self.refresh()
+            else:
+                actions[self.rng.choices(names, weights)[0]]()
+            self.stop.wait(self.rng.expovariate(1.0 / self.args.think_time) if self.args.think_time > 0 else 0)
+        self.close()
+
+    def subscribe_events(self, counters):
+        """/events を購読し続ける。inventory / resync でリフレッシュを予約する (client_gui.apply_server_event と同じ)"""
+        while not self.stop.is_set():
+            try:
+                sock = socket.create_connection(('127.0.0.1', self.port), timeout=1.0,
+                                                source_address=(self.source_ip, 0) if self.source_ip else None)
+            except OSError:
+                self.stop.wait(1.0)
+                continue
+            try:
+                sock.sendall(b"GET /events HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: text/event-stream\r\n\r\n")
+                buffer = b""
+                while not self.stop.is_set():
+                    try:
+                        chunk = sock.recv(65536)
+                    except socket.timeout:
+                        continue
+                    if not chunk:
+                        break
+                    buffer += chunk
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        if line.startswith(b"event:"):
+                            counters["events"] += 1
+                            if line[6:].strip() in (b"inventory", b"resync"):
+                                self.needs_refresh.set()
+                        elif line.startswith(b"HTTP/1.1 429"):
+                            counters["rejected"] += 1
+            except OSError:
+                pass
+            finally:
+                sock.close()
+            self.stop.wait(1.0)
+
+
+# --- ベースラインとの比較 ---
+def compare_with_baseline(results, baseline, max_regression):
+    """悪化したエンドポイントの説明のリスト。p95 が max_regression 倍より遅い、またはスループットが同じ割合より落ちたもの"""
+    regressions = []
+    for endpoint, base in baseline["endpoints"].items():
+        current = results["endpoints"].get(endpoint)
+        if current is None:
+            regressions.append(f"{endpoint}: missing from this run")
+            continue
+        if base.get("p95_ms") and current.get("p95_ms") and current["p95_ms"] > base["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{endpoint}: p95 {current['p95_ms']} ms vs baseline {base['p95_ms']} ms")
+        if base.get("rps") and current["rps"] < base["rps"] * (1 - max_regression):
+            regressions.append(f"{endpoint}: {current['rps']} req/s vs baseline {base['rps']} req/s")
+    return regressions
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ("refresh", "attach", "detach"):
+            raise argparse.ArgumentTypeError(f"unknown action in mix: {name}")
+        mix[name] = float(weight)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the server with simulated clients and a fake usbip")
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of load after all clients start")
+    parser.add_argument('--think-time', type=float, default=1.0, help="mean seconds between a client's actions")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix("refresh=70,attach=15,detach=15"),
+                        help="action weights, e.g. refresh=70,attach=15,detach=15")
+    parser.add_argument('--no-events', action='store_true', help="do not subscribe clients to /events")
+    parser.add_argument('--shared-ip', action='store_true', help="send every client from 127.0.0.1 (exempt from rate limits)")
+    parser.add_argument('--usbip-client-delay', type=float, default=0.2, help="simulated client-side usbip attach/detach time")
+    parser.add_argument('--devices', type=int, default=40, help="devices reported by the fake usbip")
+    parser.add_argument('--latency', type=float, nargs=2, default=[0.02, 0.1], metavar=("MIN", "MAX"),
+                        help="fake usbip latency range (seconds)")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of fake usbip calls that fail")
+    parser.add_argument('--mode', choices=["workers", "asgi"], default="workers",
+                        help="server_app.py --workers N, or server_asgi.py")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--server-config', default="{}", help="extra server_config.json settings as JSON")
+    parser.add_argument('--output', default="loadtest_results.json")
+    parser.add_argument('--baseline', help="results file of a previous run to compare against")
+    parser.add_argument('--max-regression', type=float, default=0.2, help="allowed relative regression (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='usbip_loadtest_')
+    bin_dir = write_fake_usbip(work_dir, args.devices, args.latency, args.failure_rate)
+    port = find_free_port()
+    process = start_server(args.mode, work_dir, bin_dir, port, args.workers, json.loads(args.server_config))
+    print(f"Server ({args.mode}) on port {port}, fake usbip config: {os.path.join(work_dir, 'usbip_fake.conf')}", flush=True)
+
+    stats = EndpointStats()
+    stop = threading.Event()
+    event_counters = {"events": 0, "rejected": 0}
+    clients = [SimulatedClient(i, port, None if args.shared_ip else f"127.1.{i // 250}.{i % 250 + 1}", stats, args, stop)
+               for i in range(args.clients)]
+    threads = [threading.Thread(target=client.run, daemon=True) for client in clients]
+    if not args.no_events:
+        threads += [threading.Thread(target=client.subscribe_events, args=(event_counters,), daemon=True) for client in clients]
+    try:
+        for thread in threads:
+            thread.start()
+        started_at = time.monotonic()
+        stop.wait(args.duration)
+        stop.set()
+        elapsed = time.monotonic() - started_at
+        for thread in threads:
+            thread.join(timeout=REQUEST_TIMEOUT)
+    finally:
+        stop.set()
+        process.terminate()
+        process.wait(timeout=10)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        "config": {"clients": args.clients, "duration": args.duration, "think_time": args.think_time, "mix": args.mix,
+                   "events": not args.no_events, "shared_ip": args.shared_ip, "devices": args.devices,
+                   "latency": args.latency, "failure_rate": args.failure_rate, "mode": args.mode, "workers": args.workers},
+        "elapsed": round(elapsed, 2),
+        "endpoints": stats.summary(elapsed),
+        "events_received": event_counters["events"],
+        "event_subscriptions_rejected": event_counters["rejected"],
+    }
+    print()
+    print(f"{'endpoint':<24} | {'ok':>7} | {'429':>5} | {'errors':>6} | {'req/s':>7} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8}")
+    print(f"{'-' * 24}-+-{'-' * 7}-+-{'-' * 5}-+-{'-' * 6}-+-{'-' * 7}-+-{'-' * 8}-+-{'-' * 8}-+-{'-' * 8}")
+    for endpoint, r in results["endpoints"].items():
+        print(f"{endpoint:<24} | {r['ok']:>7} | {r['rejected']:>5} | {r['errors']:>6} | {r['rps']:>7.1f} | "
+              f"{r['p50_ms'] if r['p50_ms'] is not None else '-':>8} | {r['p95_ms'] if r['p95_ms'] is not None else '-':>8} | "
+              f"{r['p99_ms'] if r['p99_ms'] is not None else '-':>8}")
+    print(f"events received: {results['events_received']}")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print(f"Warning: {args.baseline} was recorded with different settings: {baseline.get('config')}")
+        regressions = compare_with_baseline(results, baseline, args.max_regression)
+        if regressions:
+            print(f"Regressions against {args.baseline} (more than {args.max_regression:.0%}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+if __name__ == '__main__':
+    main()
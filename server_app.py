@@ -1,351 +1,2504 @@
-# server_app.py
-
-from flask import Flask, request, jsonify
-import subprocess
-import re
-import json
-import os
-import threading
-# import traceback # デバッグ用
-
-app = Flask(__name__)
-
-# --- 設定 ---
-CLIENT_USER_INFO_FILE = 'client_user_data.json' # ユーザー名とIPのマッピング用
-ATTACHED_DEVICES_LOG_FILE = 'attached_devices_log.json' # 現在アタッチ中のデバイス情報
-file_lock_user = threading.Lock()
-file_lock_attach = threading.Lock()
-
-# --- グローバル変数 ---
-client_user_info = {} # { "ip_address": "username" }
-attached_devices_log = {} # { "server_bus_id": {"client_ip": "...", "username": "...", "timestamp": "..."} }
-
-# --- ヘルパー関数 (ユーザー情報管理) ---
-def load_client_user_info():
-    global client_user_info
-    with file_lock_user:
-        if os.path.exists(CLIENT_USER_INFO_FILE):
-            try:
-                with open(CLIENT_USER_INFO_FILE, 'r') as f:
-                    data = json.load(f)
-                    if isinstance(data, dict): client_user_info = data
-                    else: client_user_info = {}
-            except Exception: client_user_info = {}
-        else: client_user_info = {}
-    print(f"Loaded client user info: {client_user_info}")
-
-def save_client_user_info():
-    with file_lock_user:
-        try:
-            with open(CLIENT_USER_INFO_FILE, 'w') as f:
-                json.dump(client_user_info, f, indent=4)
-        except Exception as e: print(f"Error saving client user info: {e}")
-    print(f"Saved client user info: {client_user_info}")
-
-# --- ヘルパー関数 (アタッチ情報管理) ---
-def load_attached_devices_log():
-    global attached_devices_log
-    with file_lock_attach:
-        if os.path.exists(ATTACHED_DEVICES_LOG_FILE):
-            try:
-                with open(ATTACHED_DEVICES_LOG_FILE, 'r') as f:
-                    data = json.load(f)
-                    if isinstance(data, dict): attached_devices_log = data
-                    else: attached_devices_log = {}
-            except Exception: attached_devices_log = {}
-        else: attached_devices_log = {}
-    print(f"Loaded attached devices log: {attached_devices_log}")
-
-def save_attached_devices_log():
-    with file_lock_attach:
-        try:
-            with open(ATTACHED_DEVICES_LOG_FILE, 'w') as f:
-                json.dump(attached_devices_log, f, indent=4)
-        except Exception as e: print(f"Error saving attached devices log: {e}")
-    print(f"Saved attached devices log: {attached_devices_log}")
-
-
-# `usbip list -l` の出力をパースする関数 (前回と同じ、またはご提示の形式に合わせたもの)
-def parse_usbip_list_l_output(output_str): # server_app_v3.py の parse_specific_usbip_list_l_output を流用
-    devices = []
-    lines = output_str.strip().split('\n')
-    i = 0
-    while i < len(lines):
-        line1 = lines[i].strip(); i += 1
-        busid_match = re.match(r'-\s*busid\s+([\w\.-]+)\s*\((\w{4}:\w{4})\)', line1)
-        if busid_match:
-            busid = busid_match.group(1)
-            vid_pid_busid_line = busid_match.group(2)
-            vid_busid, pid_busid = vid_pid_busid_line.split(':')
-            description = f"Device {busid} (VID:{vid_busid} PID:{pid_busid})"
-            vid_desc_line, pid_desc_line = vid_busid, pid_busid
-            if i < len(lines):
-                line2 = lines[i].strip()
-                if line2:
-                    desc_vid_pid_match = re.search(r'\((\w{4}:\w{4})\)$', line2)
-                    if desc_vid_pid_match:
-                        vid_pid_from_desc = desc_vid_pid_match.group(1)
-                        vid_desc_line, pid_desc_line = vid_pid_from_desc.split(':')
-                        description_text_only = re.sub(r'\s*\(\w{4}:\w{4}\)$', '', line2).strip()
-                        if description_text_only: description = description_text_only
-                    else: description = line2
-                    i += 1
-            devices.append({"bus_id": busid, "description": description, "vid": vid_desc_line, "pid": pid_desc_line})
-        while i < len(lines) and not lines[i].strip(): i += 1
-    return devices
-
-
-# --- API エンドポイント ---
-@app.route('/register_client_user', methods=['POST']) # ユーザー情報登録用 (旧register_client)
-def register_client_user():
-    global client_user_info
-    data = request.json
-    ip_address = data.get('ip_address')
-    username = data.get('username')
-    if ip_address and username:
-        client_user_info[ip_address] = username
-        save_client_user_info()
-        print(f"Client user registered/updated: {ip_address} as {username}")
-        return jsonify({"message": "Client user info registered/updated"}), 200
-    return jsonify({"error": "Missing IP or username"}), 400
-
-# 旧 unregister_client は、ユーザー情報からは削除しない方針に変更も可
-# (ユーザー名は保持し、アタッチ情報だけクリアする)
-# もしユーザー情報自体を消すならこのままでも良いが、今回はアタッチ情報で制御
-
-@app.route('/notify_attach', methods=['POST'])
-def notify_attach():
-    global attached_devices_log
-    data = request.json
-    client_ip = data.get('client_ip')
-    username = data.get('username') # クライアントから申告されたユーザー名
-    attached_bus_id = data.get('attached_bus_id')
-    
-    if not (client_ip and username and attached_bus_id):
-        return jsonify({"error": "Missing client_ip, username, or attached_bus_id"}), 400
-
-    # 念のため、ユーザー情報を更新/確認
-    if client_ip not in client_user_info or client_user_info[client_ip] != username:
-        client_user_info[client_ip] = username
-        save_client_user_info() # ユーザー情報を更新
-
-    attached_devices_log[attached_bus_id] = {
-        "client_ip": client_ip,
-        "username": username,
-        "timestamp": json.dumps(str(datetime.datetime.now())) # datetimeをインポートする必要あり
-    }
-    save_attached_devices_log()
-    print(f"Device attached: {attached_bus_id} by {username} ({client_ip})")
-    return jsonify({"message": f"Attachment of {attached_bus_id} by {username} logged"}), 200
-
-
-@app.route('/notify_detach', methods=['POST'])
-def notify_detach():
-    global attached_devices_log
-    data = request.json
-    # client_ip = data.get('client_ip') # 通知元確認用
-    detached_bus_id = data.get('detached_bus_id')
-
-    if not detached_bus_id:
-        return jsonify({"error": "Missing detached_bus_id"}), 400
-
-    if detached_bus_id in attached_devices_log:
-        detached_info = attached_devices_log.pop(detached_bus_id) # popで削除しつつ情報を取得
-        save_attached_devices_log()
-        print(f"Device detached: {detached_bus_id} (was used by {detached_info.get('username')})")
-        return jsonify({"message": f"Detachment of {detached_bus_id} logged"}), 200
-    else:
-        print(f"Detachment notification for non-logged bus_id: {detached_bus_id}")
-        return jsonify({"message": f"Detachment of {detached_bus_id} (not found in log) noted"}), 200
-
-
-@app.route('/device_status', methods=['GET'])
-def device_status():
-    print("[device_status] Request received.")
-    exported_devices_list_from_cmd = []
-    try:
-        # usbip list -l の実行 (sudoers設定が前提)
-        cmd_list_local = ['usbip', 'list', '-l'] # ご提示の出力形式に合わせたコマンド
-        result_list_cmd = subprocess.run(cmd_list_local, capture_output=True, text=True, check=False)
-        if result_list_cmd.returncode == 0:
-            parsed_cmd_devices = parse_usbip_list_l_output(result_list_cmd.stdout)
-
-            
-            filtered_devices = []
-            exclusion_keyword = "Microchip Technology" # 除外したいキーワード
-            
-            for dev in parsed_cmd_devices:
-                # description を小文字に変換してキーワードが含まれるかチェック (大文字小文字を区別しないため)
-                if exclusion_keyword.lower() in dev.get("description", "").lower():
-                    print(f"  Excluding device (matches '{exclusion_keyword}'): {dev.get('bus_id')} - {dev.get('description')}")
-                    continue # このデバイスはスキップして次のデバイスへ
-                
-                # 除外されなかったデバイスをリストに追加
-                filtered_devices.append(dev)
-            
-            exported_devices_list_from_cmd = filtered_devices
-
-            # exported_devices_list_from_cmd = parsed_cmd_devices
-        else:
-            print(f"Error executing '{' '.join(cmd_list_local)}': {result_list_cmd.stderr or result_list_cmd.stdout}")
-    except Exception as e:
-        print(f"Exception executing usbip list -l: {e}")
-
-    # 現在アタッチされているデバイスのログをロード (念のため最新化)
-    load_attached_devices_log() # 最新のattached_devices_logを読み込む
-
-    final_device_list = []
-    for dev_from_cmd in exported_devices_list_from_cmd:
-        bus_id = dev_from_cmd["bus_id"]
-        status_text = "Available"
-        user_info_str = "" # 誰が使っているかの文字列
-
-        if bus_id in attached_devices_log:
-            attach_info = attached_devices_log[bus_id]
-            user_info_str = f"{attach_info.get('username', 'Unknown')} ({attach_info.get('client_ip', 'N/A')})"
-            status_text = f"In use by: {user_info_str}"
-        
-        final_device_list.append({
-            "bus_id": bus_id,
-            "description": dev_from_cmd["description"],
-            "vid": dev_from_cmd["vid"],
-            "pid": dev_from_cmd["pid"],
-            "status": status_text, # サーバーが判断したステータス
-            "user_info_if_attached": user_info_str if bus_id in attached_devices_log else None
-        })
-    
-    # attached_devices_detailed は、このアプリケーションが管理するアタッチ情報そのもの
-    # サーバーのusbip portに依存しない
-    current_attachments_for_client_api = []
-    for bus_id, info in attached_devices_log.items():
-        current_attachments_for_client_api.append({
-            "bus_id": bus_id,
-            "client_ip": info.get("client_ip"),
-            "username": info.get("username"),
-            "timestamp": info.get("timestamp")
-            # description は exported_devices_list_from_cmd から引く必要がある
-        })
-
-
-    response_data = {
-        "exported_devices_list": final_device_list, # これがメインのリスト
-        # "attached_devices_log_for_debug": attached_devices_log # デバッグ用に生のログを返すこともできる
-        "current_attachments_managed_by_app": current_attachments_for_client_api, # アプリ管理のアタッチ情報
-        "app_managed_attachments": attached_devices_log   # アプリが管理するアタッチ情報
-    }
-    print(f"[device_status] Sending response: {json.dumps(response_data, indent=2)}")
-    return jsonify(response_data)
-
-@app.route('/manage_server_device_binding', methods=['POST'])
-def manage_server_device_binding():
-    global attached_devices_log # アンバインド時にアタッチ情報をクリアするため
-    data = request.json
-    action = data.get('action') # "bind" or "unbind"
-    bus_id = data.get('bus_id')
-
-    if not action or not bus_id or action not in ["bind", "unbind"]:
-        return jsonify({"error": "Missing or invalid action or bus_id"}), 400
-
-    cmd = []
-    if action == "bind":
-        cmd = ['usbip', 'bind', '-b', bus_id]
-    elif action == "unbind":
-        cmd = ['usbip', 'unbind', '-b', bus_id]
-
-    try:
-        print(f"Executing server command: {' '.join(cmd)}")
-        # sudoers設定が前提
-        result = subprocess.run(cmd, capture_output=True, text=True, check=False)
-        
-        if result.returncode == 0:
-            message = f"Device {bus_id} {action} successful."
-            if action == "unbind":
-                # アンバインド成功時、もしこのデバイスがアタッチログにあれば削除
-                if bus_id in attached_devices_log:
-                    detached_info = attached_devices_log.pop(bus_id)
-                    save_attached_devices_log()
-                    message += f" Cleared attachment log for {bus_id} (was used by {detached_info.get('username')})."
-                    print(f"Unbind cleared attachment log for {bus_id}")
-            print(message)
-            return jsonify({"message": message, "stdout": result.stdout, "stderr": result.stderr}), 200
-        else:
-            error_message = f"Failed to {action} device {bus_id}."
-            print(f"{error_message} RC: {result.returncode}, Error: {result.stderr or result.stdout}")
-            return jsonify({"error": error_message, "stdout": result.stdout, "stderr": result.stderr}), 500
-    except Exception as e:
-        error_message = f"Exception during server device {action} for {bus_id}: {e}"
-        print(error_message)
-        import traceback; traceback.print_exc()
-        return jsonify({"error": error_message}), 500
-
-
-@app.route('/force_detach_all_server_devices', methods=['POST'])
-def force_detach_all_server_devices():
-    global attached_devices_log
-    print("Received request to force detach all server devices.")
-    
-    detached_count = 0
-    errors = []
-    
-    # attached_devices_log のキーのリストのコピーに対してイテレートする（ループ中に辞書を変更するため）
-    bus_ids_to_detach = list(attached_devices_log.keys())
-
-    if not bus_ids_to_detach:
-        return jsonify({"message": "No devices were attached according to the log. Nothing to detach."}), 200
-
-    for bus_id in bus_ids_to_detach:
-        cmd = ['usbip', 'unbind', '-b', bus_id] # アンバインドで強制的に切断
-        try:
-            print(f"  Attempting to unbind (force detach) device: {bus_id}")
-            # sudoers設定が前提
-            result = subprocess.run(cmd, capture_output=True, text=True, check=False)
-            if result.returncode == 0:
-                print(f"    Successfully unbound {bus_id}.")
-                if bus_id in attached_devices_log: # 再確認（他リクエストで変更されてる可能性も微小ながらある）
-                    detached_info = attached_devices_log.pop(bus_id) # ログから削除
-                    print(f"    Cleared attachment log for {bus_id} (was used by {detached_info.get('username')}).")
-                detached_count += 1
-            else:
-                error_msg = f"Failed to unbind {bus_id}: {result.stderr or result.stdout}"
-                print(f"    {error_msg}")
-                errors.append({bus_id: error_msg})
-        except Exception as e:
-            error_msg = f"Exception unbinding {bus_id}: {e}"
-            print(f"    {error_msg}")
-            errors.append({bus_id: error_msg})
-            import traceback; traceback.print_exc()
-
-    save_attached_devices_log() # 変更を保存
-
-    if not errors:
-        return jsonify({"message": f"Successfully forced detach for {detached_count} device(s)."}), 200
-    else:
-        return jsonify({
-            "message": f"Forced detach attempted. Success: {detached_count}. Errors occurred for some devices.",
-            "errors": errors
-        }), 207 # Multi-Status
-
-# --- アプリケーション起動時の処理 ---
-if __name__ == '__main__':
-    import datetime # notify_attach で使うのでここでインポート
-    import os       # ファイル削除のためにインポート
-
-    # --- 起動時にアタッチ情報ログをクリアする処理 ---
-    attach_log_path = ATTACHED_DEVICES_LOG_FILE # グローバルで定義したファイル名
-    if os.path.exists(attach_log_path):
-        try:
-            print(f"Clearing previous attachment log: {attach_log_path}")
-            os.remove(attach_log_path)
-            print("Attachment log cleared successfully.")
-        except OSError as e:
-            print(f"Error clearing attachment log file: {e}")
-            # ファイルがロックされているなどの理由で削除に失敗した場合でも、
-            # アプリの起動は続行する。ただし、ログにはエラーを残す。
-    else:
-        print("No previous attachment log found. Starting fresh.")
-    
-    load_client_user_info()
-    load_attached_devices_log()
-    if os.geteuid() != 0: # rootチェック
-        print("Warning: Server not running as root. 'usbip' commands might require sudo privileges.")
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+# server_app.py
+
+from flask import Flask, request, jsonify, Response, g
+import subprocess
+import json
+import os
+import threading
+import collections
+import itertools
+import time
+import datetime
+import uuid
+import types
+import sqlite3
+import contextlib
+import socket
+import signal
+import argparse
+import re
+import concurrent.futures
+import logging
+import math
+import bisect
+import gzip
+import base64
+import app_logging
+import app_metrics
+import usage_history
+import usb_ids
+from usbip_output import parse_usbip_list_l_output # usbip list -l の出力のパーサー (client_gui.py と共通)
+# import traceback # デバッグ用
+try:
+    import msgpack # /v2/device_status の MessagePack 応答用 (なければ JSON のみ)
+except ImportError:
+    msgpack = None
+
+app = Flask(__name__)
+log = app_logging.setup_logging("usbip_server") # 設定ファイル読み込み後に log_* の設定で作り直す
+
+# --- 設定 ---
+SERVER_CONFIG_FILE = 'server_config.json' # サーバー設定 (存在しなければデフォルト値を使用)
+CLIENT_USER_INFO_FILE = 'client_user_data.json' # 旧形式のユーザー情報 (初回起動時にジャーナルへ取り込む)
+ATTACHED_DEVICES_LOG_FILE = 'attached_devices_log.json' # 旧形式のアタッチ情報 (起動時に取り込んでから削除)
+STATE_JOURNAL_FILE = 'server_state.journal' # ユーザー情報/アタッチ情報の変更履歴 (1行1レコードの追記型)
+STATE_SNAPSHOT_FILE = 'server_state_snapshot.json' # ジャーナルを圧縮したスナップショット
+USAGE_HISTORY_FILE = 'usage_history.bin' # デバイスを使っていた区間の履歴 (追記型のバイナリ)
+USAGE_ROLLUP_FILE = 'usage_rollups.json' # 利用履歴の1時間/1日単位の集計のスナップショット
+EVENT_POLL_INTERVAL = 0.5 # sqlite バックエンドで /events が他ワーカーのイベントを確認する間隔 (秒)
+
+DEFAULT_SERVER_CONFIG = {
+    "inventory_cache_ttl": 5.0, # `usbip list -l` の結果をキャッシュする秒数 (0でキャッシュ無効)
+    "inventory_backend": "usbip", # デバイス一覧の取得方法: "usbip" (usbip list -l) または "sysfs" (/sys を直接読む)
+    "sysfs_root": "/sys", # sysfs バックエンドが参照するルート (テスト用の疑似ツリーも指定可)
+    "usb_ids_path": None, # 名前を解決できなかったデバイスの名前を引く usb.ids (None なら /usr/share/hwdata/usb.ids などから探す)
+    "usb_ids_index_path": "usb_ids.idx", # usb.ids から作るバイナリ索引 (usb.ids が変わったら作り直す)
+    "event_backlog_size": 1000, # /events の再接続時に再送できるイベント数
+    "event_heartbeat_interval": 15.0, # /events で何も起きないときにキープアライブを送る間隔 (秒)
+    "journal_commit_interval": 0.005, # ジャーナルの追記をまとめて fsync するまでの待ち時間 (秒)
+    "journal_compact_every": 1000, # この件数ごとにジャーナルをスナップショットへ圧縮
+    "state_backend": "journal", # 状態の保存先: "journal" (単一プロセス) または "sqlite" (複数ワーカーで共有)
+    "sqlite_path": "server_state.sqlite3", # sqlite バックエンドのデータベースファイル
+    "force_detach_max_workers": 8, # 全デバイス強制デタッチで同時に実行する usbip unbind の数
+    "force_detach_device_timeout": 10.0, # 1デバイスの usbip unbind の制限時間 (秒。超えたらプロセスを終了)
+    "force_detach_overall_timeout": 20.0, # 全デバイス強制デタッチ全体の制限時間 (秒。クライアントのタイムアウトより短く)
+    "binding_batch_max_workers": 4, # 一括バインド/アンバインドで同時に実行する usbip コマンドの数
+    "binding_batch_max_operations": 100, # 一括バインド/アンバインド1回で受け付ける操作の上限
+    "binding_command_timeout": 10.0, # 一括バインド/アンバインドの usbip コマンド1回の制限時間 (秒)
+    "device_lock_timeout": 20.0, # 同じデバイスへの別の操作が終わるのを待つ上限 (秒。超えたら 409)
+    # デバイス一覧のフィルタ。ルールごとに action ("include"/"exclude") と、次のどれか1つの条件を書く:
+    #   vid_pid (例 "0424:ec00" またはそのリスト) / bus_id_prefix / description_contains (大文字小文字を区別しない) / description_regex
+    # exclude に一致したデバイスは除外。include ルールが1つでもあれば、どれかに一致したデバイスだけを残す
+    "device_filters": [
+        {"name": "exclude-microchip", "action": "exclude", "description_contains": "Microchip Technology"},
+    ],
+    "usbip_max_concurrent": 4, # 同時に実行する usbip コマンドの上限 (バインド/アンバインドを一覧取得より優先)
+    "usbip_list_timeout": 10.0, # usbip list -l の制限時間 (秒。超えたらプロセスを終了)
+    "usbip_bind_timeout": 15.0, # /manage_server_device_binding の usbip bind/unbind の制限時間 (秒)
+    "usbip_breaker_failure_threshold": 3, # usbip list -l がこの回数続けて失敗したら実行を止め、最後の一覧を返す
+    "usbip_breaker_cooldown": 30.0, # 実行を止めてから再試行するまでの秒数
+    # 受付制御 (1つのクライアントがループで叩いても他の利用者が使えるように)
+    "admission_control_enabled": True, # False でレート制限と同時処理数の上限を無効にする
+    # クライアントIPとエンドポイントの種類ごとのトークンバケット。rate は1秒あたりの補充数、burst はバケットの大きさ
+    #   read: /device_status などの取得、stream: /events への接続、interactive: アタッチ/デタッチ通知・バインド/アンバインド、
+    #   expensive: 全デバイス強制デタッチ・一括バインド・突き合わせ・フィルタの再読み込み
+    "rate_limits": {
+        "read": {"rate": 5.0, "burst": 20},
+        "stream": {"rate": 0.5, "burst": 5},
+        "interactive": {"rate": 5.0, "burst": 20},
+        "expensive": {"rate": 0.2, "burst": 2},
+    },
+    "rate_limit_exempt_ips": ["127.0.0.1", "::1"], # レート制限をかけないクライアント (同じマシンのゲートウェイなど)
+    "rate_limit_max_clients": 1024, # 覚えておくバケットの数 (超えたら使われていないものから捨てる)
+    "max_concurrent_requests": 32, # 同時に処理するリクエストの上限 (/events と /metrics は数えない)
+    "max_concurrent_expensive": 1, # expensive の同時実行数の上限 (超えた分はすぐに 429)
+    "interactive_queue_size": 8, # 上限に達しているとき interactive / expensive が空きを待つ待ち行列の長さ (read は待たずに 429)
+    "interactive_queue_timeout": 5.0, # 待ち行列で待つ上限 (秒)
+    "overload_retry_after": 2, # 混雑で断るときの Retry-After (秒)
+    "log_level": "INFO", # ログレベル: DEBUG / INFO / WARNING / ERROR
+    "log_format": "json", # ログの形式: "json" (1行1件のJSON) または "text"
+    "log_file": None, # ログの出力先ファイル (None なら標準出力)
+    "debug_payload_interval": 10.0, # DEBUG 時に応答JSONなどの大きなデータを出力する間隔 (秒。種類ごとに間引く)
+    # アタッチ情報とカーネルの状態の突き合わせ (デタッチ通知なしで切断したクライアントのアタッチ情報を消す)
+    "reconcile_interval": 30.0, # 突き合わせの間隔 (秒。0で無効)
+    "reconcile_source": "auto", # "sysfs" (usbip-host の usbip_status)、"connections" (3240番ポートの接続)、"auto" (sysfs が読めればsysfs)
+    "reconcile_confirmations": 2, # この回数続けて食い違ったアタッチ情報だけを消す (アタッチ直後の通知との競合対策)
+    "reconcile_max_clears_per_pass": 20, # 1回の突き合わせで消すアタッチ情報の上限 (残りは次回)
+    "proc_root": "/proc", # connections で参照する /proc/net/tcp のルート (テスト用の疑似ツリーも指定可)
+    # 起動時のアタッチ情報の扱い: "warm" (カーネルの状態と一致するものだけ残し、記録のないアタッチ中のデバイスを復元)
+    # または "cold" (すべて消す。カーネルの状態が読めない場合も cold と同じ)
+    "startup_mode": "warm",
+    # 利用履歴 (どのデバイスがどれだけ使われているか。/usage で参照)
+    "usage_history_enabled": True,
+    "usage_hourly_retention_days": 14, # 1時間単位の集計を残す日数
+    "usage_daily_retention_days": 400, # 1日単位の集計を残す日数
+    "usage_snapshot_every": 500, # この件数の区間を追記するごとに集計をスナップショットへ保存
+    "host": "0.0.0.0",
+    "port": 5000,
+    "workers": 1, # 2以上でワーカープロセスを複数起動する (sqlite バックエンドが必要)
+    "asgi_wsgi_threads": 8, # server_asgi.py で Flask 側のエンドポイントを処理するスレッド数
+}
+server_config = DEFAULT_SERVER_CONFIG.copy()
+
+# --- グローバル変数 ---
+# ユーザー情報とアタッチ情報は不変スナップショットとして公開する (コピーオンライト)。
+# 書き込み側は state_lock の下で新しい辞書を作って current_state を差し替え、
+# 読み取り側は current_state の参照を1回読むだけ (ロックもディスクI/Oも不要)。
+#   client_user_info: { "ip_address": "username" }
+#   attached_devices_log: { "server_bus_id": {"client_ip": "...", "username": "...", "timestamp": "..."} }
+StateSnapshot = collections.namedtuple('StateSnapshot', ['version', 'client_user_info', 'attached_devices_log'])
+state_lock = threading.Lock()
+current_state = StateSnapshot(0, types.MappingProxyType({}), types.MappingProxyType({}))
+
+# デバイス一覧 (usbip list -l) のキャッシュ
+inventory_cache_lock = threading.Lock()
+inventory_cache = {"devices": None, "fetched_at": 0.0, "generation": 0}
+inventory_refresh_in_flight = None # 実行中のリフレッシュ {"event": threading.Event, "devices": [...]}
+inventory_cache_stats = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0}
+
+# 状態バージョン (current_state.version。アタッチ/デタッチ/バインド/アンバインド/デバイス一覧の変化で増加) と /device_status の応答キャッシュ
+SERVER_INSTANCE_ID = uuid.uuid4().hex[:8] # 再起動でバージョンが巻き戻ってもETagが衝突しないように付与
+device_status_body_cache = (None, None) # (version, 直列化済みJSON)。参照ごと差し替えるのでロック不要
+
+# /v2/device_status: デバイス1台を1行 (DEVICE_STATUS_V2_FIELDS の順の値のリスト) で表す正規化した一覧
+DEVICE_STATUS_V2_FIELDS = ("bus_id", "description", "vid", "pid", "bound", "attached", "username", "client_ip", "attached_at")
+DEVICE_STATUS_V2_DEFAULT_LIMIT = 500 # limit を省略したときの1ページの件数
+DEVICE_STATUS_V2_MAX_LIMIT = 5000
+DEVICE_STATUS_V2_GZIP_MIN_SIZE = 1024 # これより小さい応答は圧縮しない
+MSGPACK_MIMETYPE = 'application/msgpack'
+device_status_v2_rows_cache = (None, None, None) # (version, bus_id でソートした行, bus_id のリスト)
+device_status_v2_body_cache = (None, {}) # (version, {(クエリ, 形式, gzip): 応答本文})。バージョンが変わったら丸ごと捨てる
+
+# メトリクス (/metrics で Prometheus のテキスト形式で出力)。複数ワーカー時はプロセスごとの値
+metrics = app_metrics.MetricsRegistry()
+http_request_duration = metrics.histogram("usbip_server_http_request_duration_seconds",
+                                          "HTTP request latency by endpoint", ["endpoint", "method", "status"])
+http_requests_in_flight = metrics.gauge("usbip_server_http_requests_in_flight", "HTTP requests currently being handled")
+usbip_command_duration = metrics.histogram("usbip_server_usbip_command_duration_seconds",
+                                           "Duration of usbip subprocess calls", ["command"])
+usbip_command_exits = metrics.counter("usbip_server_usbip_command_exit_total",
+                                      "usbip subprocess calls by exit code (\"timeout\" / \"error\" if it did not exit)", ["command", "code"])
+state_persistence_duration = metrics.histogram("usbip_server_state_persistence_duration_seconds",
+                                               "Duration of state save/load operations", ["operation"])
+usbip_queue_wait_duration = metrics.histogram("usbip_server_usbip_queue_wait_seconds",
+                                             "Time usbip calls waited for an execution slot", ["lane"])
+metrics.gauge("usbip_server_device_locks_held", "Devices with an operation in progress",
+              callback=lambda: device_locks.status()["held"])
+metrics.gauge("usbip_server_attached_devices", "Devices currently attached according to the attachment log",
+              callback=lambda: len(get_state().attached_devices_log))
+http_requests_rejected = metrics.counter("usbip_server_http_requests_rejected_total",
+                                        "Requests answered with 429 by admission control", ["endpoint_class", "reason"])
+reconcile_drift = metrics.gauge("usbip_server_reconcile_drift", "Attachment log entries that disagreed with kernel state in the last pass", ["kind"])
+reconcile_cleared = metrics.counter("usbip_server_reconcile_cleared_total", "Stale attachment log entries cleared by the reconciler")
+
+# アタッチ情報とカーネルの状態の突き合わせ (reconcile_loop) の結果
+USBIP_PORT = 3240
+USBIP_STATUS_USED = "2" # usbip-host の usbip_status: 1=未使用, 2=アタッチ中, 3=エラー
+reconcile_lock = threading.Lock()
+reconcile_stats = {"passes": 0, "last_reconcile_at": None, "last_duration": None, "source": None,
+                   "drift_count": 0, "stale": [], "unmanaged": [], "pending": {}, "cleared_total": 0, "last_error": None}
+reconciler_pid = None # 突き合わせのスレッドを起動したプロセス (fork 後の子プロセスでは起動し直す)
+
+# 状態変化イベント (/events で配信)。IDは連番で、再接続時は Last-Event-ID 以降を再送する
+event_condition = threading.Condition()
+event_backlog = collections.deque(maxlen=DEFAULT_SERVER_CONFIG["event_backlog_size"])
+last_event_id = 0
+event_listeners = [] # publish_event のたびに呼ぶ関数 (別スレッドから呼ばれる。server_asgi.py がイベントループを起こすのに使う)
+
+# --- ヘルパー関数 (サーバー設定) ---
+def load_server_config():
+    global server_config, event_backlog, log
+    config = DEFAULT_SERVER_CONFIG.copy()
+    if os.path.exists(SERVER_CONFIG_FILE):
+        try:
+            with open(SERVER_CONFIG_FILE, 'r') as f:
+                loaded_settings = json.load(f)
+                if isinstance(loaded_settings, dict): config.update(loaded_settings)
+        except Exception as e: log.error(f"Error loading server config from {SERVER_CONFIG_FILE}: {e}. Using default settings.")
+    server_config = config
+    with event_condition:
+        event_backlog = collections.deque(event_backlog, maxlen=int(server_config.get("event_backlog_size", 1000)))
+    usbip_executor.configure(server_config.get("usbip_max_concurrent", 4), server_config.get("usbip_breaker_failure_threshold", 3),
+                             server_config.get("usbip_breaker_cooldown", 30.0))
+    rate_limiter.configure(server_config.get("rate_limits", DEFAULT_SERVER_CONFIG["rate_limits"]),
+                           server_config.get("rate_limit_max_clients", 1024))
+    admission.configure(server_config.get("max_concurrent_requests", 32), server_config.get("max_concurrent_expensive", 1),
+                        server_config.get("interactive_queue_size", 8), server_config.get("interactive_queue_timeout", 5.0),
+                        server_config.get("overload_retry_after", 2))
+    log = app_logging.setup_logging("usbip_server", level=server_config.get("log_level", "INFO"),
+                                    log_format=server_config.get("log_format", "json"), log_file=server_config.get("log_file"),
+                                    debug_payload_interval=server_config.get("debug_payload_interval", 10.0))
+    log.info("Loaded server config", extra={"config": server_config})
+
+# --- 永続化 (追記型ジャーナル + スナップショット) ---
+class StateJournal:
+    """
+    ユーザー情報/アタッチ情報の変更を1件1行のJSONで追記するジャーナル。
+    同時に届いた追記はまとめて1回の fsync で永続化し (グループコミット)、
+    一定件数ごとにスナップショットへ圧縮してジャーナルを切り詰める。
+    """
+    def __init__(self, journal_path, snapshot_path, commit_interval=0.005, compact_every=1000):
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.commit_interval = commit_interval
+        self.compact_every = compact_every
+        # 永続化済みの状態 (スナップショット作成用。書き込みスレッドだけが更新する)
+        self.state = {"client_user_info": {}, "attached_devices_log": {}}
+        self.cond = threading.Condition()
+        self.pending = []
+        self.last_seq = 0
+        self.durable_seq = 0
+        self.records_since_snapshot = 0
+        self.journal_file = None
+
+    def apply(self, record):
+        op = record.get("op")
+        if op == "set_user":
+            self.state["client_user_info"][record["ip_address"]] = record["username"]
+        elif op == "attach":
+            self.state["attached_devices_log"][record["bus_id"]] = record["info"]
+        elif op == "detach":
+            self.state["attached_devices_log"].pop(record["bus_id"], None)
+        elif op == "clear_attachments":
+            self.state["attached_devices_log"].clear()
+
+    def replay(self):
+        """スナップショットとジャーナルから状態を復元する。戻り値: (client_user_info, attached_devices_log)"""
+        with state_persistence_duration.time("journal_replay"):
+            return self._replay()
+
+    def _replay(self):
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    snapshot = json.load(f)
+                self.state["client_user_info"] = dict(snapshot.get("client_user_info", {}))
+                self.state["attached_devices_log"] = dict(snapshot.get("attached_devices_log", {}))
+                snapshot_seq = int(snapshot.get("seq", 0))
+            except Exception as e: log.error(f"Error loading state snapshot {self.snapshot_path}: {e}")
+
+        seq = snapshot_seq
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            valid_size = 0
+            with open(self.journal_path, 'rb') as f:
+                for raw_line in f:
+                    if not raw_line.endswith(b'\n'): break # 書き込み途中で落ちた末尾
+                    try: record = json.loads(raw_line)
+                    except ValueError: break
+                    valid_size += len(raw_line)
+                    if record.get("seq", 0) <= snapshot_seq: continue # スナップショットに反映済み
+                    self.apply(record)
+                    seq = record["seq"]
+                    replayed += 1
+            if valid_size != os.path.getsize(self.journal_path):
+                log.warning(f"Truncating torn tail of state journal at byte {valid_size}")
+                with open(self.journal_path, 'r+b') as f: f.truncate(valid_size)
+
+        self.last_seq = self.durable_seq = seq
+        self.records_since_snapshot = replayed
+        log.info(f"Replayed state journal: snapshot seq {snapshot_seq}, {replayed} record(s) after it")
+        return dict(self.state["client_user_info"]), dict(self.state["attached_devices_log"])
+
+    def start(self):
+        self.journal_file = open(self.journal_path, 'ab')
+        self.start_writer()
+
+    def start_writer(self):
+        """書き込みスレッドを起動する。fork した子プロセスにはスレッドが引き継がれないので、子プロセスでも呼ぶ"""
+        threading.Thread(target=self.flush_loop, name="state-journal", daemon=True).start()
+
+    def append(self, record, wait=True):
+        """レコードを追記する。wait=True なら fsync 完了まで待つ。戻り値: シーケンス番号"""
+        with self.cond:
+            self.last_seq += 1
+            seq = self.last_seq
+            self.pending.append(dict(record, seq=seq))
+            self.cond.notify_all()
+            while wait and self.durable_seq < seq:
+                self.cond.wait()
+        return seq
+
+    def wait_for(self, seq):
+        """指定したシーケンス番号までのレコードが永続化されるまで待つ"""
+        with self.cond:
+            while self.durable_seq < seq:
+                self.cond.wait()
+
+    def sync(self):
+        """ここまでに追記したレコードがすべて永続化されるまで待つ"""
+        with self.cond:
+            target_seq = self.last_seq
+        self.wait_for(target_seq)
+
+    def flush_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            if self.commit_interval > 0:
+                time.sleep(self.commit_interval) # 後続の追記を待って1回の fsync にまとめる
+            with self.cond:
+                batch, self.pending = self.pending, []
+            try:
+                with state_persistence_duration.time("journal_flush"):
+                    self.journal_file.write(''.join(json.dumps(r) + '\n' for r in batch).encode('utf-8'))
+                    self.journal_file.flush()
+                    os.fsync(self.journal_file.fileno())
+            except Exception as e: log.error(f"Error writing state journal: {e}")
+            for record in batch:
+                self.apply(record)
+            with self.cond:
+                self.durable_seq = batch[-1]["seq"]
+                self.records_since_snapshot += len(batch)
+                self.cond.notify_all()
+            if self.records_since_snapshot >= self.compact_every:
+                self.compact()
+
+    def compact(self):
+        """現在の永続化済み状態をスナップショットに書き出し、ジャーナルを空にする"""
+        snapshot = {"seq": self.durable_seq, **self.state}
+        tmp_path = self.snapshot_path + '.tmp'
+        try:
+            with state_persistence_duration.time("snapshot_write"), open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path) # 置き換えはアトミック
+            if self.journal_file:
+                self.journal_file.close()
+            self.journal_file = open(self.journal_path, 'wb') # スナップショットに含まれたので切り詰める
+            self.records_since_snapshot = 0
+            log.info(f"Compacted state journal into snapshot (seq {snapshot['seq']})")
+        except Exception as e: log.error(f"Error compacting state journal: {e}")
+
+state_journal = None
+
+def load_legacy_json_dict(path):
+    """旧形式 (丸ごと書き換えていたJSONファイル) を読み込む"""
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+                if isinstance(data, dict): return data
+        except Exception as e: log.error(f"Error loading {path}: {e}")
+    return {}
+
+def load_persisted_state():
+    """ジャーナル (または sqlite ストア) から状態を復元し、書き込みスレッドを開始する"""
+    global state_journal, current_state
+    is_first_run = not (os.path.exists(STATE_JOURNAL_FILE) or os.path.exists(STATE_SNAPSHOT_FILE))
+    if server_config.get("state_backend", "journal") == "sqlite":
+        open_sqlite_state_store()
+        return
+    state_journal = StateJournal(STATE_JOURNAL_FILE, STATE_SNAPSHOT_FILE,
+                                 commit_interval=float(server_config.get("journal_commit_interval", 0.005)),
+                                 compact_every=int(server_config.get("journal_compact_every", 1000)))
+    client_user_info, attached_devices_log = state_journal.replay()
+    if is_first_run:
+        # 旧バージョンのユーザー情報ファイルがあれば取り込む
+        for ip_address, name in load_legacy_json_dict(CLIENT_USER_INFO_FILE).items():
+            client_user_info[ip_address] = name
+            state_journal.apply({"op": "set_user", "ip_address": ip_address, "username": name})
+        state_journal.compact()
+    state_journal.start()
+    with state_lock:
+        current_state = StateSnapshot(current_state.version, types.MappingProxyType(client_user_info),
+                                      types.MappingProxyType(attached_devices_log))
+    log.info("Loaded persisted state", extra={"users": len(client_user_info), "attachments": len(attached_devices_log)})
+    app_logging.debug_payload(log, "loaded_state", "Loaded persisted state (contents)",
+                              {"client_user_info": client_user_info, "attached_devices_log": attached_devices_log})
+
+# --- 永続化 (複数ワーカー用の SQLite ストア) ---
+class SqliteStateStore:
+    """
+    複数のワーカープロセスで共有する状態ストア (SQLite, WALモード)。
+    各ワーカーは current_state をキャッシュとして持ち、変更カウンタ (change_seq) が進んでいたら読み直す。
+    書き込みは BEGIN IMMEDIATE でプロセス間でも直列化し、イベントも同じトランザクションで events テーブルに記録する。
+    """
+    def __init__(self, path, event_backlog_size=1000):
+        self.path = path
+        self.event_backlog_size = event_backlog_size
+        self.local = threading.local() # 接続はスレッドごと
+        self.change_seq = None # 手元の current_state が反映している change_seq
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def reset_after_fork(self):
+        """fork 後の子プロセスでは親の接続を使わない"""
+        self.local = threading.local()
+        self.change_seq = None
+
+    def initialize(self):
+        """テーブルを作成し、インスタンスIDを返す (マスタープロセスで1回呼ぶ)"""
+        conn = self.connection()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS client_users (ip_address TEXT PRIMARY KEY, username TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS attachments (bus_id TEXT PRIMARY KEY, info TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT NOT NULL, data TEXT NOT NULL);
+        ''')
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('instance_id', ?)", (uuid.uuid4().hex[:8],))
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', '0')")
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('change_seq', '0')")
+        return conn.execute("SELECT value FROM meta WHERE key = 'instance_id'").fetchone()[0]
+
+    def read_change_seq(self, conn):
+        return int(conn.execute("SELECT value FROM meta WHERE key = 'change_seq'").fetchone()[0])
+
+    def load(self, conn):
+        """戻り値: (change_seq, version, client_user_info, attached_devices_log)"""
+        meta = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('version', 'change_seq')").fetchall())
+        client_user_info = dict(conn.execute("SELECT ip_address, username FROM client_users").fetchall())
+        attached_devices_log = {bus_id: json.loads(info) for bus_id, info in conn.execute("SELECT bus_id, info FROM attachments")}
+        return int(meta["change_seq"]), int(meta["version"]), client_user_info, attached_devices_log
+
+    def write(self, conn, journal_records, events, version):
+        """トランザクション内で呼ぶ。ジャーナルと同じ形式のレコードを反映し、イベントを記録する。戻り値: イベントIDのリスト"""
+        for record in journal_records:
+            op = record.get("op")
+            if op == "set_user":
+                conn.execute("INSERT INTO client_users (ip_address, username) VALUES (?, ?) "
+                             "ON CONFLICT(ip_address) DO UPDATE SET username = excluded.username",
+                             (record["ip_address"], record["username"]))
+            elif op == "attach":
+                conn.execute("INSERT INTO attachments (bus_id, info) VALUES (?, ?) "
+                             "ON CONFLICT(bus_id) DO UPDATE SET info = excluded.info",
+                             (record["bus_id"], json.dumps(record["info"])))
+            elif op == "detach":
+                conn.execute("DELETE FROM attachments WHERE bus_id = ?", (record["bus_id"],))
+            elif op == "clear_attachments":
+                conn.execute("DELETE FROM attachments")
+        event_ids = []
+        for event_type, data in events:
+            cursor = conn.execute("INSERT INTO events (type, data) VALUES (?, ?)", (event_type, json.dumps(data)))
+            event_ids.append(cursor.lastrowid)
+        if event_ids:
+            conn.execute("DELETE FROM events WHERE id <= ?", (event_ids[-1] - self.event_backlog_size,))
+        self.change_seq = self.read_change_seq(conn) + 1
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'change_seq'", (str(self.change_seq),))
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'version'", (str(version),))
+        return event_ids
+
+    def event_id_range(self):
+        """戻り値: (最古のイベントID, 最新のイベントID)。イベントがなければ (None, 0)"""
+        oldest_id, latest_id = self.connection().execute("SELECT MIN(id), MAX(id) FROM events").fetchone()
+        if latest_id is None:
+            latest_id = self.connection().execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+            return None, latest_id[0] if latest_id else 0
+        return oldest_id, latest_id
+
+    def events_after(self, cursor, limit=500):
+        rows = self.connection().execute("SELECT id, type, data FROM events WHERE id > ? ORDER BY id LIMIT ?", (cursor, limit))
+        return [{"id": event_id, "type": event_type, "data": json.loads(data)} for event_id, event_type, data in rows]
+
+state_store = None # sqlite バックエンド使用時の SqliteStateStore
+
+def open_sqlite_state_store():
+    """sqlite バックエンドを初期化して状態を読み込む"""
+    global state_store, SERVER_INSTANCE_ID
+    path = server_config.get("sqlite_path", "server_state.sqlite3")
+    is_first_run = not os.path.exists(path)
+    state_store = SqliteStateStore(path, event_backlog_size=int(server_config.get("event_backlog_size", 1000)))
+    # 全ワーカーで同じIDを使う (ETag とイベントIDがどのワーカーでも通用するように)
+    SERVER_INSTANCE_ID = state_store.initialize()
+    if is_first_run and (os.path.exists(STATE_JOURNAL_FILE) or os.path.exists(STATE_SNAPSHOT_FILE)):
+        # journal バックエンドで保存していたユーザー情報を取り込む
+        client_user_info, _ = StateJournal(STATE_JOURNAL_FILE, STATE_SNAPSHOT_FILE).replay()
+        with state_transaction():
+            commit_state(client_user_info=client_user_info,
+                         journal_records=[{"op": "set_user", "ip_address": ip_address, "username": name}
+                                          for ip_address, name in client_user_info.items()])
+    os.register_at_fork(after_in_child=state_store.reset_after_fork)
+    state = get_state()
+    log.info(f"Opened shared state store {path} (instance {SERVER_INSTANCE_ID}, version {state.version})")
+    log.info("Loaded persisted state", extra={"users": len(state.client_user_info), "attachments": len(state.attached_devices_log)})
+    app_logging.debug_payload(log, "loaded_state", "Loaded persisted state (contents)",
+                              {"client_user_info": dict(state.client_user_info), "attached_devices_log": dict(state.attached_devices_log)})
+
+# --- ヘルパー関数 (状態の参照と更新) ---
+def reload_state_from_store(conn):
+    """state_lock を保持して呼ぶ。他のワーカーの変更でデータベースが進んでいれば current_state を読み直す"""
+    global current_state
+    with state_persistence_duration.time("sqlite_load"):
+        change_seq, version, client_user_info, attached_devices_log = state_store.load(conn)
+    if state_store.change_seq is None or change_seq > state_store.change_seq:
+        current_state = StateSnapshot(version, types.MappingProxyType(client_user_info),
+                                      types.MappingProxyType(attached_devices_log))
+        state_store.change_seq = change_seq
+
+def get_state():
+    """現在の状態スナップショットを返す。中身は変更しないこと (journal バックエンドではロック不要)"""
+    if state_store is not None:
+        conn = state_store.connection()
+        conn.execute('BEGIN') # 読み取りを1つのスナップショットにそろえる
+        try:
+            if state_store.read_change_seq(conn) != state_store.change_seq:
+                with state_lock:
+                    reload_state_from_store(conn)
+        finally:
+            conn.execute('COMMIT')
+    return current_state
+
+@contextlib.contextmanager
+def state_transaction():
+    """
+    状態を更新する排他区間 (この中で commit_state を呼ぶ)。
+    sqlite バックエンドではプロセス間でも排他し、開始時に最新の状態を読み直す。
+    """
+    with state_lock:
+        if state_store is None:
+            yield
+            return
+        conn = state_store.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            reload_state_from_store(conn)
+            yield
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            state_store.change_seq = None # 手元のスナップショットは次回読み直す
+            raise
+    if state_store is not None:
+        with event_condition:
+            event_condition.notify_all() # 同じプロセスの /events 購読者を起こす
+
+def get_state_version():
+    return get_state().version
+
+def commit_state(client_user_info=None, attached_devices_log=None, journal_records=(), events=()):
+    """
+    state_transaction() の中で呼ぶ。新しい辞書を次のスナップショットとして公開し、
+    ジャーナル (または SQLite) への書き込み (永続化は待たない) とイベント配信を同じ順序で行う。
+    events があればバージョンを1つ進める。戻り値: 最後に追記したジャーナルのシーケンス番号 (なければ None)
+    """
+    global current_state
+    old_state = current_state
+    version = old_state.version + 1 if events else old_state.version
+    current_state = StateSnapshot(
+        version,
+        types.MappingProxyType(client_user_info) if client_user_info is not None else old_state.client_user_info,
+        types.MappingProxyType(attached_devices_log) if attached_devices_log is not None else old_state.attached_devices_log)
+    seq = None
+    events = [(event_type, dict(data, version=version)) for event_type, data in events]
+    if state_store is not None:
+        # 他のワーカーにも見えるようにイベントもデータベースに記録 (コミットは state_transaction の終わり)
+        with state_persistence_duration.time("sqlite_write"):
+            state_store.write(state_store.connection(), journal_records, events, version)
+    else:
+        if state_journal:
+            for record in journal_records:
+                seq = state_journal.append(record, wait=False)
+        for event_type, data in events:
+            publish_event(event_type, data)
+    if events:
+        if log.isEnabledFor(logging.DEBUG):
+            changes = ", ".join(f"{event_type} {data.get('bus_id', '')}".strip() for event_type, data in events)
+            log.debug("State version changed", extra={"version": version, "changes": changes})
+    return seq
+
+def wait_for_durability(seq):
+    """commit_state で追記したレコードが永続化されるまで待つ (state_lock の外で呼ぶ)"""
+    if seq is not None and state_journal:
+        state_journal.wait_for(seq)
+
+def publish_state_change(event_type, data):
+    """ユーザー/アタッチ情報以外の変化 (バインド/アンバインド/デバイス一覧) でバージョンを進めてイベントを配信する"""
+    with state_transaction():
+        commit_state(events=[(event_type, data)])
+
+def set_client_user(ip_address, name):
+    """ユーザー名を登録/更新する"""
+    with state_transaction():
+        state = current_state
+        if state.client_user_info.get(ip_address) == name:
+            return
+        client_user_info = dict(state.client_user_info)
+        client_user_info[ip_address] = name
+        seq = commit_state(client_user_info=client_user_info,
+                           journal_records=[{"op": "set_user", "ip_address": ip_address, "username": name}])
+    wait_for_durability(seq)
+
+def add_attachment(bus_id, client_ip, name):
+    """アタッチ情報を記録する (ユーザー名が変わっていれば同じコミットで更新)。戻り値: 記録した情報"""
+    info = {
+        "client_ip": client_ip,
+        "username": name,
+        "timestamp": json.dumps(str(datetime.datetime.now()))
+    }
+    with state_transaction():
+        state = current_state
+        journal_records = []
+        client_user_info = None
+        if state.client_user_info.get(client_ip) != name: # 念のため、ユーザー情報を更新/確認
+            client_user_info = dict(state.client_user_info)
+            client_user_info[client_ip] = name
+            journal_records.append({"op": "set_user", "ip_address": client_ip, "username": name})
+        replaced = state.attached_devices_log.get(bus_id) # 別のクライアントのアタッチを上書きした場合はそこで終わったとみなす
+        attached_devices_log = dict(state.attached_devices_log)
+        attached_devices_log[bus_id] = info
+        journal_records.append({"op": "attach", "bus_id": bus_id, "info": info})
+        seq = commit_state(client_user_info, attached_devices_log, journal_records,
+                           events=[("attach", {"bus_id": bus_id, **info})])
+    wait_for_durability(seq)
+    if replaced:
+        record_usage({bus_id: replaced})
+    return info
+
+def remove_attachments(bus_ids, reason="detach"):
+    """
+    指定したバスIDのアタッチ情報をまとめて削除し、1回のコミットで永続化する。
+    削除したものごとに detach イベントを配信する。戻り値: { bus_id: 削除した情報 }
+    """
+    with state_transaction():
+        state = current_state
+        removed = {bus_id: state.attached_devices_log[bus_id] for bus_id in bus_ids if bus_id in state.attached_devices_log}
+        if not removed:
+            return {}
+        attached_devices_log = {bus_id: info for bus_id, info in state.attached_devices_log.items() if bus_id not in removed}
+        seq = commit_state(attached_devices_log=attached_devices_log,
+                           journal_records=[{"op": "detach", "bus_id": bus_id} for bus_id in removed],
+                           events=[("detach", {"bus_id": bus_id, "username": info.get('username'), "reason": reason})
+                                   for bus_id, info in removed.items()])
+    wait_for_durability(seq)
+    if reason != "startup": # 起動時に消すものは、停止中のいつ外れたのか分からないので記録しない
+        record_usage(removed)
+    return removed
+
+
+# --- 利用履歴 (アタッチしていた区間の記録と集計。usage_history.py) ---
+usage_store = None # usage_history_enabled のときの UsageHistory
+
+def open_usage_history():
+    global usage_store
+    usage_store = None
+    if not server_config.get("usage_history_enabled", True):
+        return
+    store = usage_history.UsageHistory(USAGE_HISTORY_FILE, USAGE_ROLLUP_FILE,
+                                       hourly_retention_days=float(server_config.get("usage_hourly_retention_days", 14)),
+                                       daily_retention_days=float(server_config.get("usage_daily_retention_days", 400)),
+                                       snapshot_every=int(server_config.get("usage_snapshot_every", 500)))
+    try:
+        store.load()
+    except OSError as e:
+        log.error(f"Error loading usage history: {e}. Usage history is disabled.")
+        return
+    usage_store = store
+
+def attachment_started_at(info):
+    """アタッチ情報の timestamp (json.dumps(str(datetime)) の形式) を UNIX 秒にする。読めなければ None"""
+    try:
+        return datetime.datetime.fromisoformat(json.loads(info["timestamp"])).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def record_usage(ended_attachments):
+    """終わったアタッチ { bus_id: アタッチ情報 } を利用履歴に追記する (state_lock の外で呼ぶ)"""
+    if usage_store is None:
+        return
+    ended_at = time.time()
+    for bus_id, info in ended_attachments.items():
+        started_at = attachment_started_at(info)
+        if started_at is None:
+            continue
+        try:
+            usage_store.record(bus_id, info.get("username"), started_at, ended_at)
+        except OSError as e:
+            log.error(f"Error recording usage history for {bus_id}: {e}")
+
+
+# --- デバイスごとの操作ロック ---
+class DeviceLockTable:
+    """
+    bus_id ごとの操作ロック。同じデバイスへの操作 (バインド/アンバインド、アタッチ/デタッチ通知、強制デタッチ) は1つずつ、
+    別のデバイスへの操作は並列に実行する。
+    ロックは使用中 (保持しているか待っている操作がある) の bus_id の分だけ持ち、使われなくなったら捨てる。
+    複数のデバイスを操作するときは必ず acquire でまとめて取る (bus_id の昇順に取るので、どの組み合わせでもデッドロックしない)。
+    """
+    def __init__(self):
+        self.guard = threading.Lock()
+        self.entries = {} # bus_id -> [threading.Lock, 使用中の操作の数]
+        self.contended = 0 # 他の操作が終わるのを待った回数
+
+    def checkout(self, bus_id):
+        with self.guard:
+            entry = self.entries.get(bus_id)
+            if entry is None:
+                entry = self.entries[bus_id] = [threading.Lock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def checkin(self, bus_id):
+        with self.guard:
+            entry = self.entries[bus_id]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.entries[bus_id]
+
+    def acquire(self, bus_ids, timeout=None, skip_busy=False):
+        """
+        bus_ids のロックを昇順に取り、取った bus_id のリストを返す (release に渡す)。全体で timeout 秒まで待つ。
+        取れないものがあれば、取った分を返して TimeoutError。skip_busy なら取れなかったものを飛ばして続ける
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        acquired = []
+        try:
+            for bus_id in sorted(set(bus_ids)):
+                lock = self.checkout(bus_id)
+                if not lock.acquire(blocking=False):
+                    if timeout != 0:
+                        with self.guard:
+                            self.contended += 1
+                    remaining = -1 if deadline is None else max(0.0, deadline - time.monotonic())
+                    if not lock.acquire(timeout=remaining):
+                        self.checkin(bus_id)
+                        if skip_busy:
+                            continue
+                        raise TimeoutError(f"Device {bus_id} is busy with another operation")
+                acquired.append(bus_id)
+        except BaseException:
+            self.release(acquired)
+            raise
+        return acquired
+
+    def release(self, bus_ids):
+        for bus_id in reversed(bus_ids):
+            with self.guard:
+                lock = self.entries[bus_id][0]
+            lock.release()
+            self.checkin(bus_id)
+
+    @contextlib.contextmanager
+    def hold(self, bus_ids, timeout=None):
+        acquired = self.acquire(bus_ids, timeout)
+        try:
+            yield acquired
+        finally:
+            self.release(acquired)
+
+    def status(self):
+        with self.guard:
+            return {"active": len(self.entries), "held": sum(1 for lock, _ in self.entries.values() if lock.locked()),
+                    "contended_total": self.contended}
+
+device_locks = DeviceLockTable()
+
+
+# --- ヘルパー関数 (デバイス一覧の取得) ---
+class DeviceFilter:
+    """
+    device_filters のルールをコンパイルしたもの。
+    VID:PID は辞書、bus_id の前方一致はタプルの startswith、説明文の部分一致と正規表現は1つの正規表現にまとめて、
+    デバイス1台あたり辞書引き1回と正規表現の照合1回で判定する。
+    結果は前回の入力と同じデバイス一覧なら使い回す (ルールの評価はデバイス一覧が変わったときだけ)。
+    """
+    MATCH_KEYS = ("vid_pid", "bus_id_prefix", "description_contains", "description_regex")
+
+    def __init__(self, rules):
+        self.rules = []
+        self.groups = {"include": self.empty_group(), "exclude": self.empty_group()}
+        for index, rule in enumerate(rules or []):
+            if not isinstance(rule, dict):
+                raise ValueError(f"device_filters[{index}] must be an object")
+            name = str(rule.get("name") or f"rule{index}")
+            action = rule.get("action", "exclude")
+            keys = [key for key in self.MATCH_KEYS if key in rule]
+            if action not in self.groups or len(keys) != 1:
+                raise ValueError(f"device_filters[{index}] ({name}) needs action include/exclude and exactly one of {', '.join(self.MATCH_KEYS)}")
+            values = rule[keys[0]] if isinstance(rule[keys[0]], list) else [rule[keys[0]]]
+            self.add_rule(self.groups[action], len(self.rules), keys[0], [str(value) for value in values])
+            self.rules.append({"name": name, "action": action, "match": keys[0], "values": values})
+        for group in self.groups.values():
+            patterns = group.pop("patterns")
+            group["text_matcher"] = re.compile("|".join(patterns)) if patterns else None
+            group["bus_id_prefixes"] = tuple(prefix for prefix, _ in group["prefix_rules"])
+        self.hits = [0] * len(self.rules) # このルールで採否が決まったデバイスの延べ数
+        self.current_matches = [0] * len(self.rules) # 最新のデバイス一覧で一致したデバイス数
+        self.cache = (None, None) # (入力のデバイス一覧, フィルタ後の一覧)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def empty_group():
+        return {"vid_pid": {}, "prefix_rules": [], "patterns": []}
+
+    @staticmethod
+    def add_rule(group, rule_index, key, values):
+        for value in values:
+            if key == "vid_pid":
+                group["vid_pid"].setdefault(value.lower(), rule_index)
+            elif key == "bus_id_prefix":
+                group["prefix_rules"].append((value, rule_index))
+            else:
+                pattern = f"(?i:{re.escape(value)})" if key == "description_contains" else f"(?:{value})"
+                try: re.compile(pattern)
+                except re.error as e: raise ValueError(f"invalid description_regex {value!r}: {e}")
+                group["patterns"].append(f"(?P<r{rule_index}_{len(group['patterns'])}>{pattern})")
+
+    @staticmethod
+    def match_group(group, dev):
+        """一致したルールの番号を返す (なければ None)"""
+        rule_index = group["vid_pid"].get(f"{dev.get('vid', '')}:{dev.get('pid', '')}".lower())
+        if rule_index is not None:
+            return rule_index
+        bus_id = dev.get("bus_id", "")
+        if group["bus_id_prefixes"] and bus_id.startswith(group["bus_id_prefixes"]):
+            return next(index for prefix, index in group["prefix_rules"] if bus_id.startswith(prefix))
+        if group["text_matcher"] is not None:
+            match = group["text_matcher"].search(dev.get("description", ""))
+            if match:
+                return int(match.lastgroup[1:].split("_")[0])
+        return None
+
+    def apply(self, devices):
+        """フィルタ後のデバイス一覧を返す"""
+        with self.lock:
+            cached_input, cached_output = self.cache
+            if cached_input == devices:
+                return list(cached_output)
+            has_include_rules = any(rule["action"] == "include" for rule in self.rules)
+            current_matches = [0] * len(self.rules)
+            filtered_devices = []
+            for dev in devices:
+                rule_index = self.match_group(self.groups["exclude"], dev)
+                if rule_index is None and has_include_rules:
+                    rule_index = self.match_group(self.groups["include"], dev)
+                    if rule_index is None:
+                        continue # どの include ルールにも一致しない
+                    filtered_devices.append(dev)
+                elif rule_index is None:
+                    filtered_devices.append(dev)
+                    continue
+                current_matches[rule_index] += 1
+                self.hits[rule_index] += 1
+                if self.rules[rule_index]["action"] == "exclude":
+                    log.debug("Excluding device", extra={"rule": self.rules[rule_index]["name"], "bus_id": dev.get('bus_id')})
+            self.current_matches = current_matches
+            self.cache = (list(devices), filtered_devices)
+            return list(filtered_devices)
+
+    def stats(self):
+        with self.lock:
+            return [dict(rule, hits=hits, current_matches=current)
+                    for rule, hits, current in zip(self.rules, self.hits, self.current_matches)]
+
+device_filter = DeviceFilter(DEFAULT_SERVER_CONFIG["device_filters"])
+device_filter_config_mtime = None # device_filters を読み込んだときの server_config.json の更新時刻
+
+def reload_device_filters(force=False):
+    """
+    server_config.json の device_filters を読み直してコンパイルし直す (再起動不要)。
+    force=False なら server_config.json が更新されたときだけ読み直す。戻り値: 読み直したら True。
+    ルールが不正な場合は ValueError を送出し、今のルールのまま動き続ける。
+    """
+    global device_filter, device_filter_config_mtime
+    try: mtime = os.stat(SERVER_CONFIG_FILE).st_mtime
+    except OSError: mtime = None
+    if not force and mtime == device_filter_config_mtime:
+        return False
+    rules = server_config.get("device_filters", [])
+    if mtime is not None:
+        try:
+            with open(SERVER_CONFIG_FILE, 'r') as f:
+                loaded_settings = json.load(f)
+            if isinstance(loaded_settings, dict) and "device_filters" in loaded_settings:
+                rules = loaded_settings["device_filters"]
+        except Exception as e:
+            device_filter_config_mtime = mtime # 同じ内容で何度もエラーを出さない
+            raise ValueError(f"Error loading device_filters from {SERVER_CONFIG_FILE}: {e}")
+    device_filter_config_mtime = mtime
+    new_filter = DeviceFilter(rules)
+    server_config["device_filters"] = rules
+    device_filter = new_filter
+    log.info("Loaded device filters", extra={"rules": [rule["name"] for rule in new_filter.rules]})
+    return True
+
+# --- usbip コマンドの実行 ---
+PRIORITY_INTERACTIVE = 0 # バインド/アンバインドなど、ユーザーが待っている操作
+PRIORITY_BACKGROUND = 1 # デバイス一覧の取得など
+
+class CircuitOpenError(Exception):
+    """usbip コマンドが続けて失敗しているため、実行せずに諦めた"""
+
+class UsbipExecutor:
+    """
+    usbip コマンドを実行する唯一の窓口。
+    同時実行数に上限を設け、空きを待つ間はバインド/アンバインド (INTERACTIVE) を一覧取得 (BACKGROUND) より先に通す。
+    一覧取得は最後の1枠を使わないので、一覧取得が詰まってもバインド/アンバインドは待たされない。
+    制限時間を超えたコマンドはプロセスグループごと kill する。
+    BACKGROUND のコマンドが続けて失敗したらサーキットブレーカーを開き、クールダウンの間は実行しない。
+    """
+    def __init__(self, max_concurrent=4, breaker_failure_threshold=3, breaker_cooldown=30.0):
+        self.cond = threading.Condition()
+        self.running = 0
+        self.waiting = [] # 枠を待っている (priority, 受付順)。小さいほど先
+        self.ticket_counter = itertools.count()
+        self.breakers = {} # command -> {"failures": 連続失敗数, "opened_at": 開いた時刻 (閉じていれば None)}
+        self.configure(max_concurrent, breaker_failure_threshold, breaker_cooldown)
+
+    def configure(self, max_concurrent, breaker_failure_threshold, breaker_cooldown):
+        with self.cond:
+            self.max_concurrent = max(1, int(max_concurrent))
+            self.breaker_failure_threshold = max(1, int(breaker_failure_threshold))
+            self.breaker_cooldown = float(breaker_cooldown)
+            self.cond.notify_all()
+
+    def slot_limit(self, priority):
+        if priority == PRIORITY_BACKGROUND and self.max_concurrent > 1:
+            return self.max_concurrent - 1 # 最後の1枠はバインド/アンバインド用に空けておく
+        return self.max_concurrent
+
+    def can_start(self, ticket):
+        if self.running >= self.slot_limit(ticket[0]):
+            return False
+        # 先に並んでいて今すぐ実行できるものがあれば譲る (INTERACTIVE は必ず BACKGROUND より前に並ぶ)
+        return all(other >= ticket or self.running >= self.slot_limit(other[0]) for other in self.waiting)
+
+    def acquire(self, priority, timeout):
+        """実行枠を取る。timeout 秒以内に取れなければ False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            ticket = (priority, next(self.ticket_counter))
+            self.waiting.append(ticket)
+            try:
+                while not self.can_start(ticket):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+                self.running += 1
+                return True
+            finally:
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify_all()
+
+    def breaker_allows(self, command):
+        with self.cond:
+            breaker = self.breakers.get(command)
+            if breaker is None or breaker["opened_at"] is None:
+                return True
+            # クールダウンが明けたら1回だけ試す (失敗すればまたクールダウン)
+            if time.monotonic() - breaker["opened_at"] >= self.breaker_cooldown:
+                breaker["opened_at"] = time.monotonic()
+                return True
+            return False
+
+    def record_outcome(self, command, succeeded):
+        with self.cond:
+            breaker = self.breakers.setdefault(command, {"failures": 0, "opened_at": None})
+            if succeeded:
+                if breaker["opened_at"] is not None:
+                    log.info("usbip circuit closed", extra={"command": command})
+                breaker["failures"], breaker["opened_at"] = 0, None
+                return
+            breaker["failures"] += 1
+            if breaker["failures"] >= self.breaker_failure_threshold:
+                if breaker["opened_at"] is None:
+                    log.warning("usbip circuit opened", extra={"command": command, "failures": breaker["failures"]})
+                breaker["opened_at"] = time.monotonic()
+
+    def breaker_status(self):
+        with self.cond:
+            now = time.monotonic()
+            return {command: {"failures": breaker["failures"], "open": breaker["opened_at"] is not None,
+                              "retry_in": max(0.0, round(self.breaker_cooldown - (now - breaker["opened_at"]), 1))
+                              if breaker["opened_at"] is not None else None}
+                    for command, breaker in self.breakers.items()}
+
+    def run(self, args, priority=PRIORITY_INTERACTIVE, timeout=None, stdout_parser=None):
+        """
+        ['usbip', *args] を実行して subprocess.CompletedProcess を返す。
+        枠の待ち時間とコマンドの実行時間はそれぞれ timeout 秒まで。超えたら subprocess.TimeoutExpired。
+        BACKGROUND でサーキットが開いていれば CircuitOpenError。
+        stdout_parser を渡すと stdout を溜めずに行ごとに渡し、その戻り値を CompletedProcess.stdout にする。
+        """
+        cmd = ['usbip', *args]
+        command = args[0]
+        if priority == PRIORITY_BACKGROUND and not self.breaker_allows(command):
+            raise CircuitOpenError(f"'{' '.join(cmd)}' skipped: usbip has been failing, retrying later")
+        lane = "interactive" if priority == PRIORITY_INTERACTIVE else "background"
+        wait_started_at = time.perf_counter()
+        acquired = self.acquire(priority, timeout)
+        usbip_queue_wait_duration.observe(time.perf_counter() - wait_started_at, lane)
+        if not acquired:
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        started_at = time.perf_counter()
+        code = "error"
+        try:
+            # プロセスグループを分けておき、制限時間を超えたらグループごと kill する (usbip が子プロセスを作っても残らない)
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, start_new_session=True)
+            try:
+                if stdout_parser is None:
+                    stdout, stderr = process.communicate(timeout=timeout)
+                else:
+                    stdout, stderr = self.read_streaming(process, stdout_parser, timeout)
+            except subprocess.TimeoutExpired:
+                code = "timeout"
+                self.kill(process)
+                process.communicate()
+                log.warning("Killed usbip command after timeout", extra={"cmd": ' '.join(cmd), "timeout": timeout})
+                raise
+            code = str(process.returncode)
+            return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+        finally:
+            self.release()
+            usbip_command_duration.observe(time.perf_counter() - started_at, command)
+            usbip_command_exits.inc(command, code)
+            if priority == PRIORITY_BACKGROUND:
+                self.record_outcome(command, code == "0")
+
+    @staticmethod
+    def kill(process):
+        try: os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError: pass
+
+    def read_streaming(self, process, stdout_parser, timeout):
+        """stdout を stdout_parser に直接読ませる。stderr は別スレッドで読む (パイプが詰まらないように)"""
+        stderr_chunks = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+        stderr_reader.start()
+        timed_out = threading.Event()
+        def kill_on_deadline():
+            timed_out.set()
+            self.kill(process) # stdout が閉じるので stdout_parser の読み込みも終わる
+        watchdog = threading.Timer(timeout, kill_on_deadline) if timeout is not None else None
+        if watchdog: watchdog.start()
+        try:
+            parsed = stdout_parser(process.stdout)
+            for _ in process.stdout: pass # パーサーが途中でやめても最後まで読み切る
+            process.wait()
+        finally:
+            if watchdog: watchdog.cancel()
+        stderr_reader.join()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        return parsed, ''.join(stderr_chunks)
+
+usbip_executor = UsbipExecutor()
+
+def run_usbip(args, timeout=None, priority=PRIORITY_INTERACTIVE, stdout_parser=None):
+    """usbip コマンドを実行する (sudoers設定が前提)。実行は usbip_executor を通す"""
+    return usbip_executor.run(args, priority=priority, timeout=timeout, stdout_parser=stdout_parser)
+
+usb_names = None # usb.ids の索引 (usb_ids.UsbIdsIndex。usb.ids が見つからなければ None)
+
+def open_usb_ids_index():
+    global usb_names
+    usb_names = None
+    source_path = server_config.get("usb_ids_path") or usb_ids.find_usb_ids()
+    if not source_path:
+        log.info("usb.ids not found. Devices whose names usbip cannot resolve are shown by ID.")
+        return
+    index = usb_ids.UsbIdsIndex(source_path, server_config.get("usb_ids_index_path", "usb_ids.idx"))
+    try:
+        index.current() # 索引がなければここで作っておく
+    except (OSError, ValueError) as e:
+        log.error(f"Error building usb.ids index from {source_path}: {e}")
+        return
+    usb_names = index
+
+def resolve_usb_names(vid, pid):
+    """usb.ids の索引から "ベンダー名 : 製品名" を引く。分からなければ None"""
+    if usb_names is None:
+        return None
+    try:
+        return usb_names.describe(vid, pid)
+    except (OSError, ValueError) as e:
+        log.warning(f"Error looking up {vid}:{pid} in the usb.ids index: {e}")
+        return None
+
+def parse_usbip_list_local(output):
+    """`usbip list -l` の出力をパースし、usbip が名前を解決できなかったデバイスの説明を usb.ids の索引で補う"""
+    return parse_usbip_list_l_output(output, resolve_names=resolve_usb_names)
+
+def run_usbip_list_local():
+    """`usbip list -l` を実行してデバイスリストを返す。失敗時は None"""
+    cmd_list_local = ['usbip', 'list', '-l'] # ご提示の出力形式に合わせたコマンド
+    try:
+        # usbip list -l の実行 (sudoers設定が前提)
+        # 出力は文字列に溜めずにパーサーへ直接流す (stdout はデバイスのリストになる)
+        result_list_cmd = run_usbip(cmd_list_local[1:], timeout=float(server_config.get("usbip_list_timeout", 10.0)),
+                                    priority=PRIORITY_BACKGROUND, stdout_parser=parse_usbip_list_local)
+    except CircuitOpenError as e:
+        log.warning(str(e))
+        return None
+    except Exception as e:
+        log.error(f"Exception executing usbip list -l: {e}")
+        return None
+    if result_list_cmd.returncode != 0:
+        log.error(f"Error executing '{' '.join(cmd_list_local)}': {result_list_cmd.stderr}")
+        return None
+    devices = result_list_cmd.stdout
+    for dev in devices:
+        dev["bound"] = None # usbip list -l からはバインド状態が分からない
+    return devices
+
+def read_sysfs_attr(device_dir, name):
+    """sysfs の属性ファイルを読む。存在しない/読めない場合は None"""
+    try:
+        with open(os.path.join(device_dir, name), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def scan_sysfs_usb_devices(sysfs_root='/sys'):
+    """
+    /sys/bus/usb/devices を直接読んでデバイスリストを返す (usbip コマンド不要)。
+    /sys/bus/usb/drivers/usbip-host 配下にあるデバイスをバインド済みとみなす。失敗時は None
+    """
+    devices_dir = os.path.join(sysfs_root, 'bus', 'usb', 'devices')
+    usbip_host_dir = os.path.join(sysfs_root, 'bus', 'usb', 'drivers', 'usbip-host')
+    try:
+        entries = os.listdir(devices_dir)
+    except OSError as e:
+        log.error(f"Error scanning sysfs devices at {devices_dir}: {e}")
+        return None
+    try:
+        bound_bus_ids = set(os.listdir(usbip_host_dir))
+    except OSError:
+        bound_bus_ids = set() # usbip-host ドライバ未ロード = バインド済みデバイスなし
+
+    devices = []
+    for busid in sorted(entries):
+        # インターフェース (1-1:1.0) とルートハブ (usb1) は対象外
+        if ':' in busid or busid.startswith('usb'):
+            continue
+        device_dir = os.path.join(devices_dir, busid)
+        vid = read_sysfs_attr(device_dir, 'idVendor')
+        pid = read_sysfs_attr(device_dir, 'idProduct')
+        if not vid or not pid:
+            continue
+        if read_sysfs_attr(device_dir, 'bDeviceClass') == '09': # ハブは usbip list -l と同様に除外
+            continue
+        manufacturer = read_sysfs_attr(device_dir, 'manufacturer')
+        product = read_sysfs_attr(device_dir, 'product')
+        if manufacturer and product: description = f"{manufacturer} : {product}"
+        elif manufacturer or product: description = manufacturer or product
+        else: description = resolve_usb_names(vid, pid) or f"Device {busid} (VID:{vid} PID:{pid})"
+        devices.append({"bus_id": busid, "description": description, "vid": vid, "pid": pid,
+                        "bound": busid in bound_bus_ids})
+    return devices
+
+def load_device_inventory():
+    """設定されたバックエンドからデバイス一覧を取得し、除外フィルタを適用する。失敗時は None"""
+    backend = server_config.get("inventory_backend", "usbip")
+    if backend == "sysfs":
+        devices = scan_sysfs_usb_devices(server_config.get("sysfs_root", "/sys"))
+    else:
+        devices = run_usbip_list_local()
+    if devices is None:
+        return None
+    return apply_device_filters(devices)
+
+def apply_device_filters(devices):
+    try:
+        reload_device_filters() # server_config.json が更新されていればルールを読み直す
+    except ValueError as e:
+        log.error(f"Keeping previous device filters: {e}")
+    return device_filter.apply(devices)
+
+
+# --- ヘルパー関数 (デバイス一覧キャッシュ) ---
+def get_exported_devices_inventory():
+    """
+    キャッシュ済みのデバイス一覧を返す。TTL切れの場合はバックエンド (usbip list -l / sysfs) から取り直す。
+    同時に複数のリクエストがキャッシュミスした場合、コマンドの実行は1回だけにまとめる (single-flight)。
+    """
+    devices, flight, generation = begin_inventory_refresh()
+    if devices is not None:
+        return devices
+    if generation is None:
+        flight["event"].wait()
+        return list(flight["devices"] or [])
+    devices = None
+    try:
+        devices = load_device_inventory()
+    finally:
+        finish_inventory_refresh(flight, generation, devices)
+    return list(flight["devices"] or [])
+
+def begin_inventory_refresh(on_done=None):
+    """
+    キャッシュが新しければ (devices, None, None) を返す。そうでなければリフレッシュを始めるか、実行中のものに相乗りする。
+    戻り値: 自分が実行する場合は (None, flight, generation) で、取得後に finish_inventory_refresh を呼ぶこと。
+    相乗りの場合は (None, flight, None) で、flight["event"] (または on_done の呼び出し) を待ってから flight["devices"] を使う。
+    """
+    global inventory_refresh_in_flight
+    with inventory_cache_lock:
+        ttl = float(server_config.get("inventory_cache_ttl", 0))
+        devices = inventory_cache["devices"]
+        if devices is not None and time.monotonic() - inventory_cache["fetched_at"] < ttl:
+            inventory_cache_stats["hits"] += 1
+            return list(devices), None, None
+        flight = inventory_refresh_in_flight
+        if flight is not None:
+            inventory_cache_stats["coalesced"] += 1 # 実行中のリフレッシュに相乗り
+            if on_done is not None:
+                flight["callbacks"].append(on_done)
+            return None, flight, None
+        inventory_cache_stats["misses"] += 1
+        flight = {"event": threading.Event(), "devices": None, "callbacks": []}
+        inventory_refresh_in_flight = flight
+        return None, flight, inventory_cache["generation"]
+
+def finish_inventory_refresh(flight, generation, devices):
+    """begin_inventory_refresh で始めたリフレッシュの結果 (失敗なら None) をキャッシュに入れ、相乗りしている呼び出し元を起こす"""
+    global inventory_refresh_in_flight
+    inventory_changed = False
+    with inventory_cache_lock:
+        # 実行中に無効化された場合は結果を返すだけにして、キャッシュは新鮮扱いにしない
+        if devices is not None:
+            # まだ一覧がなかった場合 (起動直後の取得の失敗やサーキットが開いていた後) も変化として扱う。
+            # /device_status の ETag と応答キャッシュはバージョンだけを見るので、バージョンを進めないと空の一覧を返し続ける
+            inventory_changed = inventory_cache["devices"] != devices
+            inventory_cache["devices"] = devices
+            inventory_cache["fetched_at"] = time.monotonic() if inventory_cache["generation"] == generation else 0.0
+        # 取得に失敗した場合 (usbip の失敗やサーキットが開いている間) は最後に取得できた一覧を返す
+        flight["devices"] = devices if devices is not None else inventory_cache["devices"]
+        inventory_refresh_in_flight = None
+        callbacks = flight["callbacks"]
+    flight["event"].set()
+    for callback in callbacks:
+        callback()
+    if inventory_changed:
+        publish_state_change("inventory", {})
+
+# --- ヘルパー関数 (イベント配信) ---
+def publish_event(event_type, data):
+    """イベントをバックログに追加し、/events の購読者を起こす"""
+    global last_event_id
+    with event_condition:
+        last_event_id += 1
+        event = {"id": last_event_id, "type": event_type, "data": data}
+        event_backlog.append(event)
+        event_condition.notify_all()
+    for listener in event_listeners:
+        listener()
+    return event
+
+def event_id_range():
+    """戻り値: (最古のイベントID, 最新のイベントID)。保持しているイベントがなければ最古は None"""
+    if state_store is not None:
+        return state_store.event_id_range()
+    with event_condition:
+        return (event_backlog[0]["id"] if event_backlog else None), last_event_id
+
+def events_after(cursor):
+    """cursor より後のイベントを返す。バックログから溢れて取りこぼしがある場合は None"""
+    if state_store is not None:
+        oldest_id, _ = state_store.event_id_range()
+        if oldest_id is not None and cursor < oldest_id - 1:
+            return None
+        return state_store.events_after(cursor)
+    with event_condition:
+        if not event_backlog:
+            return []
+        oldest_id = event_backlog[0]["id"]
+        if cursor < oldest_id - 1:
+            return None
+        return list(itertools.islice(event_backlog, cursor - oldest_id + 1, None))
+
+def wait_for_events(cursor, timeout):
+    """新しいイベントが来るか timeout 秒経つまで待つ (sqlite バックエンドでは他ワーカーの分を定期的に確認)"""
+    with event_condition:
+        if state_store is None:
+            if last_event_id <= cursor:
+                event_condition.wait(timeout=timeout)
+        else:
+            event_condition.wait(timeout=min(timeout, EVENT_POLL_INTERVAL))
+
+def format_event_id(event_id):
+    return f"{SERVER_INSTANCE_ID}:{event_id}"
+
+def resolve_event_cursor(last_event_id_str):
+    """
+    クライアントの Last-Event-ID から再開位置を決める。
+    戻り値: (cursor, needs_resync)。再起動やバックログ溢れで取りこぼしがある場合は needs_resync=True
+    """
+    oldest_id, current_id = event_id_range()
+    if oldest_id is None:
+        oldest_id = current_id + 1
+    if not last_event_id_str:
+        return current_id, False # 新規購読: 以降のイベントのみ
+    instance_id, _, id_str = last_event_id_str.rpartition(':')
+    if instance_id != SERVER_INSTANCE_ID or not id_str.isdigit() or int(id_str) > current_id:
+        return current_id, True # 別インスタンスのID (サーバー再起動)
+    cursor = int(id_str)
+    if cursor < oldest_id - 1:
+        return current_id, True # バックログから溢れたイベントがある
+    return cursor, False
+
+def format_sse(event_type, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {format_event_id(event_id)}")
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+def invalidate_inventory_cache():
+    """バインド/アンバインドなどでデバイスの状態が変わったときにキャッシュを破棄する"""
+    with inventory_cache_lock:
+        inventory_cache["fetched_at"] = 0.0
+        inventory_cache["generation"] += 1
+        inventory_cache_stats["invalidations"] += 1
+
+# --- 整合 (アタッチ情報とカーネルの状態の突き合わせ) ---
+def read_usbip_host_status(sysfs_root='/sys'):
+    """
+    usbip-host にバインドされているデバイスの usbip_status を読む。
+    戻り値: { bus_id: "1" / "2" / "3" }。ドライバのディレクトリが読めなければ None
+    """
+    usbip_host_dir = os.path.join(sysfs_root, 'bus', 'usb', 'drivers', 'usbip-host')
+    try:
+        entries = os.listdir(usbip_host_dir)
+    except OSError:
+        return None
+    statuses = {}
+    for bus_id in entries:
+        status = read_sysfs_attr(os.path.join(usbip_host_dir, bus_id), 'usbip_status')
+        if status is not None: # bind/unbind/module などのファイルは usbip_status を持たない
+            statuses[bus_id] = status
+    return statuses
+
+def decode_proc_net_address(hex_address):
+    """/proc/net/tcp(6) の "0100007F:0CA8" 形式を (IPアドレス, ポート) にする"""
+    hex_ip, hex_port = hex_address.split(':')
+    raw = bytes.fromhex(hex_ip)
+    raw = b''.join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4)) # 4バイトごとにホストバイトオーダー (リトルエンディアン)
+    if len(raw) == 4:
+        ip = socket.inet_ntop(socket.AF_INET, raw)
+    else:
+        ip = socket.inet_ntop(socket.AF_INET6, raw)
+        if ip.startswith('::ffff:') and '.' in ip:
+            ip = ip[7:] # IPv4 射影アドレス
+    return ip, int(hex_port, 16)
+
+def read_usbip_connections(proc_root='/proc'):
+    """3240番ポートに接続中 (ESTABLISHED) のクライアントのIPアドレスの集合を返す。読めなければ None"""
+    peers = set()
+    readable = False
+    for name in ('tcp', 'tcp6'):
+        try:
+            with open(os.path.join(proc_root, 'net', name), 'r') as f:
+                next(f, None) # 見出し行
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 4 or fields[3] != '01': # 01 = ESTABLISHED
+                        continue
+                    _, local_port = decode_proc_net_address(fields[1])
+                    if local_port == USBIP_PORT:
+                        peers.add(decode_proc_net_address(fields[2])[0])
+            readable = True
+        except (OSError, ValueError):
+            continue
+    return peers if readable else None
+
+def read_kernel_attachment_state():
+    """
+    設定された方法でカーネルの状態を読む。
+    戻り値: (source, 判定関数 (bus_id, info) -> アタッチ中なら True, カーネル上はアタッチ中だが記録のない bus_id のリスト)。
+    どちらも読めなければ (None, None, [])
+    """
+    source = server_config.get("reconcile_source", "auto")
+    if source in ("auto", "sysfs"):
+        statuses = read_usbip_host_status(server_config.get("sysfs_root", "/sys"))
+        if statuses is not None:
+            used = {bus_id for bus_id, status in statuses.items() if status == USBIP_STATUS_USED}
+            return "sysfs", (lambda bus_id, info: bus_id in used), sorted(used)
+        if source == "sysfs":
+            return None, None, []
+    peers = read_usbip_connections(server_config.get("proc_root", "/proc"))
+    if peers is None:
+        return None, None, []
+    # 接続からはバスIDが分からないので、クライアントのIPアドレスで判定する
+    return "connections", (lambda bus_id, info: info.get("client_ip") in peers), []
+
+def reconcile_once():
+    """
+    アタッチ情報をカーネルの状態と1回突き合わせる。reconcile_confirmations 回続けて食い違ったアタッチ情報を
+    1回あたり reconcile_max_clears_per_pass 件まで消し (detach イベントの reason は "reconcile")、結果を reconcile_stats に残す。
+    """
+    started_at = time.monotonic()
+    source, is_attached, kernel_attached = read_kernel_attachment_state()
+    with reconcile_lock:
+        reconcile_stats["passes"] += 1
+        if source is None:
+            reconcile_stats["last_error"] = "Kernel usbip state is not readable (no usbip-host in sysfs and no /proc/net/tcp)"
+            return {}
+        attached_devices_log = get_state().attached_devices_log
+        stale = sorted(bus_id for bus_id, info in attached_devices_log.items() if not is_attached(bus_id, info))
+        unmanaged = [bus_id for bus_id in kernel_attached if bus_id not in attached_devices_log]
+        # 連続して食い違った回数。今回一致したものは数え直す
+        pending = {bus_id: reconcile_stats["pending"].get(bus_id, 0) + 1 for bus_id in stale}
+        confirmations = max(int(server_config.get("reconcile_confirmations", 2)), 1)
+        to_clear = [bus_id for bus_id in stale if pending[bus_id] >= confirmations]
+        to_clear = to_clear[:max(int(server_config.get("reconcile_max_clears_per_pass", 20)), 1)]
+        reconcile_stats.update(source=source, stale=stale, unmanaged=unmanaged, pending=pending, last_error=None,
+                               drift_count=len(stale) + len(unmanaged))
+
+    # 操作中のデバイスは飛ばす (次回また数える)
+    held = device_locks.acquire(to_clear, timeout=0, skip_busy=True) if to_clear else []
+    try:
+        removed = remove_attachments(held, reason="reconcile") if held else {}
+    finally:
+        device_locks.release(held)
+    if removed:
+        log.warning("Cleared stale attachments", extra={"bus_ids": sorted(removed), "source": source})
+        reconcile_cleared.inc(amount=len(removed))
+    if unmanaged:
+        log.info("Devices attached without an attachment record", extra={"bus_ids": unmanaged})
+    with reconcile_lock:
+        for bus_id in removed:
+            reconcile_stats["pending"].pop(bus_id, None)
+        reconcile_stats["cleared_total"] += len(removed)
+        reconcile_stats["last_reconcile_at"] = datetime.datetime.now().isoformat(timespec='seconds')
+        reconcile_stats["last_duration"] = round(time.monotonic() - started_at, 4)
+    reconcile_drift.set(len(stale), "stale")
+    reconcile_drift.set(len(unmanaged), "unmanaged")
+    return removed
+
+def restore_attachments_from_kernel(legacy_attachments=None):
+    """
+    起動時 (warm) に、保存されていたアタッチ情報をカーネルの状態と突き合わせて1回のコミットで作り直す。
+    一致したものは残し、一致しないものは消し、記録のないアタッチ中のデバイスは利用者不明として追加する。
+    カーネルの状態が読めない場合はすべて消す (cold と同じ)。戻り値: 件数の内訳
+    """
+    started_at = time.perf_counter()
+    source, is_attached, kernel_attached = read_kernel_attachment_state()
+    with state_transaction():
+        state = current_state
+        candidates = dict(legacy_attachments or {}) # 旧形式のファイルの内容は、ジャーナルにないものだけ使う
+        candidates.update(state.attached_devices_log)
+        if source is None:
+            log.warning("Kernel usbip state is not readable. Clearing previous attachments.")
+            kept = {}
+        else:
+            kept = {bus_id: info for bus_id, info in candidates.items() if is_attached(bus_id, info)}
+        removed = [bus_id for bus_id in state.attached_devices_log if bus_id not in kept]
+        recovered = {bus_id: {"client_ip": None, "username": None, "timestamp": json.dumps(str(datetime.datetime.now())),
+                              "recovered": True}
+                     for bus_id in kernel_attached if bus_id not in kept}
+        added = {bus_id: info for bus_id, info in kept.items() if bus_id not in state.attached_devices_log}
+        added.update(recovered)
+        attached_devices_log = dict(kept)
+        attached_devices_log.update(recovered)
+        journal_records = [{"op": "detach", "bus_id": bus_id} for bus_id in removed]
+        journal_records += [{"op": "attach", "bus_id": bus_id, "info": info} for bus_id, info in added.items()]
+        events = [("detach", {"bus_id": bus_id, "username": state.attached_devices_log[bus_id].get('username'), "reason": "startup"})
+                  for bus_id in removed]
+        events += [("attach", {"bus_id": bus_id, **info}) for bus_id, info in added.items()]
+        seq = commit_state(attached_devices_log=attached_devices_log, journal_records=journal_records, events=events) \
+            if journal_records else None
+    wait_for_durability(seq)
+    summary = {"source": source, "kept": len(kept), "removed": len(removed), "recovered": len(recovered),
+               "elapsed": round(time.perf_counter() - started_at, 4)}
+    log.info("Restored attachments from kernel state", extra=summary)
+    return summary
+
+def reconcile_loop():
+    while True:
+        interval = float(server_config.get("reconcile_interval", 30.0))
+        if interval <= 0:
+            return
+        time.sleep(interval)
+        try:
+            reconcile_once()
+        except Exception:
+            log.exception("Reconcile pass failed")
+
+def start_reconciler():
+    """突き合わせのスレッドをこのプロセスで1つ起動する (fork した子プロセスでは起動し直す)"""
+    global reconciler_pid
+    if reconciler_pid == os.getpid() or float(server_config.get("reconcile_interval", 30.0)) <= 0:
+        return
+    reconciler_pid = os.getpid()
+    threading.Thread(target=reconcile_loop, name="reconciler", daemon=True).start()
+
+
+# --- 受付制御 (レート制限と同時処理数の上限) ---
+# エンドポイント (URL ルール) の種類。載っていないもの (/metrics など) は制限しない
+ENDPOINT_CLASSES = {
+    '/device_status': "read", '/v2/device_status': "read", '/inventory_cache_stats': "read",
+    '/reconcile_status': "read", '/device_filters': "read", '/admission_status': "read", '/usage': "read",
+    '/events': "stream", # 接続している間は同時処理数に数えない (レート制限だけ)
+    '/register_client_user': "interactive", '/notify_attach': "interactive", '/notify_detach': "interactive",
+    '/manage_server_device_binding': "interactive",
+    '/manage_server_device_binding_batch': "expensive", '/force_detach_all_server_devices': "expensive",
+    '/reconcile': "expensive", '/device_filters/reload': "expensive",
+}
+
+class RateLimitedError(Exception):
+    """リクエストを受け付けなかった (429)。retry_after 秒後に送り直してほしい"""
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+class TokenBucketLimiter:
+    """
+    クライアントIPとエンドポイントの種類ごとのトークンバケット。
+    覚えておくバケットの数には上限があり、しばらく使われていないものから捨てる (捨てたバケットは満タンから数え直す)。
+    """
+    def __init__(self, limits, max_buckets=1024):
+        self.lock = threading.Lock()
+        self.buckets = collections.OrderedDict() # (client_ip, endpoint_class) -> [トークン数, 最後に補充した時刻]
+        self.configure(limits, max_buckets)
+
+    def configure(self, limits, max_buckets):
+        with self.lock:
+            self.limits = {endpoint_class: (max(0.001, float(limit["rate"])), max(1.0, float(limit["burst"])))
+                           for endpoint_class, limit in limits.items()}
+            self.max_buckets = max(1, int(max_buckets))
+            self.buckets.clear()
+
+    def take(self, client_ip, endpoint_class):
+        """トークンを1つ使う。使えたら 0、足りなければ次のトークンが貯まるまでの秒数を返す"""
+        limit = self.limits.get(endpoint_class)
+        if limit is None:
+            return 0.0
+        rate, burst = limit
+        now = time.monotonic()
+        key = (client_ip, endpoint_class)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now]
+                if len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                return 0.0
+            return (1.0 - bucket[0]) / rate
+
+    def client_count(self):
+        with self.lock:
+            return len(self.buckets)
+
+class AdmissionController:
+    """
+    同時に処理するリクエスト数の上限。上限に達しているとき、read はすぐに断り、
+    interactive / expensive は小さな待ち行列で空きを待つ (interactive が先。満杯か、待ちすぎたら断る)。
+    expensive は別に同時実行数を制限し、超えた分は待たせずに断る。
+    """
+    QUEUE_PRIORITIES = {"interactive": 0, "expensive": 1}
+
+    def __init__(self, max_in_flight=32, max_expensive=1, queue_size=8, queue_timeout=5.0, retry_after=2):
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.expensive_in_flight = 0
+        self.waiting = [] # 空きを待っている (priority, 受付順)。小さいほど先
+        self.ticket_counter = itertools.count()
+        self.configure(max_in_flight, max_expensive, queue_size, queue_timeout, retry_after)
+
+    def configure(self, max_in_flight, max_expensive, queue_size, queue_timeout, retry_after):
+        with self.cond:
+            self.max_in_flight = max(1, int(max_in_flight))
+            self.max_expensive = max(1, int(max_expensive))
+            self.queue_size = max(0, int(queue_size))
+            self.queue_timeout = float(queue_timeout)
+            self.retry_after = float(retry_after)
+            self.cond.notify_all()
+
+    def check_expensive(self, endpoint_class):
+        if endpoint_class == "expensive" and self.expensive_in_flight >= self.max_expensive:
+            raise RateLimitedError("Another long-running operation is in progress", self.retry_after, "expensive_busy")
+
+    def try_enter(self, endpoint_class):
+        """待たずに処理を始められれば数えて True、待ち行列に並ぶ必要があれば False。断るときは RateLimitedError"""
+        with self.cond:
+            self.check_expensive(endpoint_class)
+            if self.in_flight < self.max_in_flight and not self.waiting:
+                self.start(endpoint_class)
+                return True
+            if endpoint_class not in self.QUEUE_PRIORITIES:
+                raise RateLimitedError("Server is busy", self.retry_after, "overload")
+            if len(self.waiting) >= self.queue_size:
+                raise RateLimitedError("Server is busy (queue full)", self.retry_after, "queue_full")
+            return False
+
+    def enter(self, endpoint_class, timeout=None):
+        """
+        処理を始めてよければ数えて戻る。断るときは RateLimitedError。終わったら leave を呼ぶこと。
+        timeout は待ち行列で待つ上限 (秒。省略すると queue_timeout)
+        """
+        with self.cond:
+            if self.try_enter(endpoint_class):
+                return
+            ticket = (self.QUEUE_PRIORITIES[endpoint_class], next(self.ticket_counter))
+            self.waiting.append(ticket)
+            deadline = time.monotonic() + (self.queue_timeout if timeout is None else timeout)
+            try:
+                while self.in_flight >= self.max_in_flight or min(self.waiting) != ticket:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RateLimitedError("Server is busy (queue timeout)", self.retry_after, "queue_timeout")
+                    self.cond.wait(remaining)
+                self.check_expensive(endpoint_class) # 待っている間に別の expensive が始まっていれば断る
+                self.start(endpoint_class)
+            finally:
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+
+    def start(self, endpoint_class):
+        self.in_flight += 1
+        if endpoint_class == "expensive":
+            self.expensive_in_flight += 1
+
+    def leave(self, endpoint_class):
+        with self.cond:
+            self.in_flight -= 1
+            if endpoint_class == "expensive":
+                self.expensive_in_flight -= 1
+            self.cond.notify_all()
+
+    def status(self):
+        with self.cond:
+            return {"in_flight": self.in_flight, "max_in_flight": self.max_in_flight,
+                    "expensive_in_flight": self.expensive_in_flight, "max_expensive": self.max_expensive,
+                    "queued": len(self.waiting), "queue_size": self.queue_size}
+
+rate_limiter = TokenBucketLimiter(DEFAULT_SERVER_CONFIG["rate_limits"])
+admission = AdmissionController()
+
+def check_rate_limit(client_ip, endpoint):
+    """
+    リクエストのレート制限を確認する (Flask と server_asgi.py で共通)。超えていれば RateLimitedError。
+    同時処理数に数えるリクエストならエンドポイントの種類を返す (呼び出し側で admission.enter / leave する)
+    """
+    endpoint_class = ENDPOINT_CLASSES.get(endpoint)
+    if endpoint_class is None or not server_config.get("admission_control_enabled", True):
+        return None
+    if client_ip not in server_config.get("rate_limit_exempt_ips", ()):
+        retry_after = rate_limiter.take(client_ip, endpoint_class)
+        if retry_after > 0:
+            raise RateLimitedError(f"Too many {endpoint_class} requests from {client_ip}", retry_after, "rate_limit")
+    return endpoint_class if endpoint_class != "stream" else None
+
+def rate_limited_reply(endpoint, client_ip, error):
+    """429 の応答JSONとヘッダ。Retry-After は秒数 (切り上げ)"""
+    endpoint_class = ENDPOINT_CLASSES.get(endpoint)
+    retry_after = max(1, math.ceil(error.retry_after))
+    http_requests_rejected.inc(endpoint_class, error.reason)
+    log.debug("Rejected request", extra={"endpoint": endpoint, "client_ip": client_ip, "reason": error.reason, "retry_after": retry_after})
+    return {"error": str(error), "reason": error.reason, "retry_after": retry_after}, {'Retry-After': str(retry_after)}
+
+
+# --- API エンドポイント ---
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+    http_requests_in_flight.inc()
+    if reconciler_pid != os.getpid():
+        start_reconciler() # gunicorn --preload などで fork した後の最初のリクエスト
+
+@app.before_request
+def admit_request():
+    endpoint = request.url_rule.rule if request.url_rule is not None else None
+    try:
+        endpoint_class = check_rate_limit(request.remote_addr, endpoint)
+        if endpoint_class is not None:
+            admission.enter(endpoint_class) # 混雑時は interactive / expensive だけ待ち行列で待つ
+            g.admitted_class = endpoint_class
+    except RateLimitedError as e:
+        body, headers = rate_limited_reply(endpoint, request.remote_addr, e)
+        return jsonify(body), 429, headers
+
+@app.after_request
+def record_request_duration(response):
+    started_at = g.get("request_started_at")
+    if started_at is not None:
+        # ラベルは URL ルール (例: /device_status) にして、bus_id などで種類が増えないようにする
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        http_request_duration.observe(time.perf_counter() - started_at, endpoint, request.method, str(response.status_code))
+    return response
+
+@app.teardown_request
+def finish_request(exc):
+    if g.pop("request_started_at", None) is not None:
+        http_requests_in_flight.dec()
+    admitted_class = g.pop("admitted_class", None)
+    if admitted_class is not None:
+        admission.leave(admitted_class)
+
+@app.route('/register_client_user', methods=['POST']) # ユーザー情報登録用 (旧register_client)
+def register_client_user():
+    data = request.json
+    ip_address = data.get('ip_address')
+    username = data.get('username')
+    if ip_address and username:
+        set_client_user(ip_address, username)
+        log.info("Client user registered/updated", extra={"client_ip": ip_address, "username": username})
+        return jsonify({"message": "Client user info registered/updated"}), 200
+    return jsonify({"error": "Missing IP or username"}), 400
+
+# 旧 unregister_client は、ユーザー情報からは削除しない方針に変更も可
+# (ユーザー名は保持し、アタッチ情報だけクリアする)
+# もしユーザー情報自体を消すならこのままでも良いが、今回はアタッチ情報で制御
+
+@app.route('/notify_attach', methods=['POST'])
+def notify_attach():
+    data = request.json
+    client_ip = data.get('client_ip')
+    username = data.get('username') # クライアントから申告されたユーザー名
+    attached_bus_id = data.get('attached_bus_id')
+    
+    if not (client_ip and username and attached_bus_id):
+        return jsonify({"error": "Missing client_ip, username, or attached_bus_id"}), 400
+
+    # ユーザー情報の更新/確認とアタッチ情報の記録は1回のコミットで行う
+    try:
+        with device_locks.hold([attached_bus_id], timeout=float(server_config.get("device_lock_timeout", 20.0))):
+            add_attachment(attached_bus_id, client_ip, username)
+    except TimeoutError as e:
+        return jsonify({"error": str(e)}), 409
+    log.info("Device attached", extra={"bus_id": attached_bus_id, "username": username, "client_ip": client_ip})
+    return jsonify({"message": f"Attachment of {attached_bus_id} by {username} logged"}), 200
+
+
+@app.route('/notify_detach', methods=['POST'])
+def notify_detach():
+    data = request.json
+    # client_ip = data.get('client_ip') # 通知元確認用
+    detached_bus_id = data.get('detached_bus_id')
+
+    if not detached_bus_id:
+        return jsonify({"error": "Missing detached_bus_id"}), 400
+
+    try:
+        with device_locks.hold([detached_bus_id], timeout=float(server_config.get("device_lock_timeout", 20.0))):
+            removed = remove_attachments([detached_bus_id]) # 削除しつつ情報を取得
+    except TimeoutError as e:
+        return jsonify({"error": str(e)}), 409
+    if removed:
+        detached_info = removed[detached_bus_id]
+        log.info("Device detached", extra={"bus_id": detached_bus_id, "username": detached_info.get('username')})
+        return jsonify({"message": f"Detachment of {detached_bus_id} logged"}), 200
+    else:
+        log.info("Detachment notification for non-logged bus_id", extra={"bus_id": detached_bus_id})
+        return jsonify({"message": f"Detachment of {detached_bus_id} (not found in log) noted"}), 200
+
+
+def build_device_status_body(exported_devices_list_from_cmd, state):
+    """/device_status の応答JSONを状態スナップショットから組み立て、直列化したバイト列を返す"""
+    attached_devices_log = state.attached_devices_log
+    final_device_list = []
+    for dev_from_cmd in exported_devices_list_from_cmd:
+        bus_id = dev_from_cmd["bus_id"]
+        status_text = "Available"
+        user_info_str = "" # 誰が使っているかの文字列
+
+        if bus_id in attached_devices_log:
+            attach_info = attached_devices_log[bus_id]
+            user_info_str = f"{attach_info.get('username') or 'Unknown'} ({attach_info.get('client_ip') or 'N/A'})" # 起動時に復元した利用者不明のアタッチは None
+            status_text = f"In use by: {user_info_str}"
+        
+        final_device_list.append({
+            "bus_id": bus_id,
+            "description": dev_from_cmd["description"],
+            "vid": dev_from_cmd["vid"],
+            "pid": dev_from_cmd["pid"],
+            "status": status_text, # サーバーが判断したステータス
+            "bound": dev_from_cmd.get("bound"), # usbip-host へのバインド状態 (sysfsバックエンド時のみ。不明ならNone)
+            "user_info_if_attached": user_info_str if bus_id in attached_devices_log else None
+        })
+    
+    # attached_devices_detailed は、このアプリケーションが管理するアタッチ情報そのもの
+    # サーバーのusbip portに依存しない
+    current_attachments_for_client_api = []
+    for bus_id, info in attached_devices_log.items():
+        current_attachments_for_client_api.append({
+            "bus_id": bus_id,
+            "client_ip": info.get("client_ip"),
+            "username": info.get("username"),
+            "timestamp": info.get("timestamp")
+            # description は exported_devices_list_from_cmd から引く必要がある
+        })
+
+
+    response_data = {
+        "exported_devices_list": final_device_list, # これがメインのリスト
+        # "attached_devices_log_for_debug": attached_devices_log # デバッグ用に生のログを返すこともできる
+        "current_attachments_managed_by_app": current_attachments_for_client_api, # アプリ管理のアタッチ情報
+        "app_managed_attachments": dict(attached_devices_log)   # アプリが管理するアタッチ情報
+    }
+    app_logging.debug_payload(log, "device_status", "[device_status] Built response", response_data)
+    return json.dumps(response_data).encode('utf-8')
+
+def render_device_status(state, exported_devices_list_from_cmd, if_none_match):
+    """
+    /device_status の応答を (ステータスコード, 本文, ヘッダ) で返す (server_asgi.py と共通)。
+    state はデバイス一覧より先に読んだスナップショット (get_state())。
+    if_none_match(etag) はリクエストの If-None-Match にその ETag が含まれていれば True を返す関数
+    """
+    global device_status_body_cache
+    # バージョンと状態は同じスナップショットから読むので常に一致する。
+    # デバイス一覧はその後に読むので、一覧がバージョンより古くなることはない
+    # (逆に先に読むと、間にリフレッシュが終わったとき古い一覧を新しいバージョンでキャッシュしてしまう)
+    version = state.version
+    etag = f"{SERVER_INSTANCE_ID}-{version}"
+    if if_none_match(etag):
+        return 304, b'', {'ETag': f'"{etag}"'}
+
+    cached_version, body = device_status_body_cache
+    if cached_version != version:
+        body = build_device_status_body(exported_devices_list_from_cmd, state)
+        # 作っている間にバージョンが進んでいればキャッシュしない
+        if (cached_version is None or version > cached_version) and current_state.version == version:
+            device_status_body_cache = (version, body)
+    return 200, body, {'Content-Type': 'application/json', 'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+
+@app.route('/device_status', methods=['GET'])
+def device_status():
+    log.debug("[device_status] Request received.")
+    state = get_state() # デバイス一覧より先に読む (render_device_status を参照)
+    # デバイス一覧はキャッシュ経由で取得 (TTL切れ時のみ usbip list -l / sysfs を読む)
+    exported_devices_list_from_cmd = get_exported_devices_inventory()
+    status, body, headers = render_device_status(state, exported_devices_list_from_cmd, request.if_none_match.contains)
+    return Response(body, status=status, headers=headers)
+
+def build_device_status_v2_rows(exported_devices_list_from_cmd, state):
+    """
+    /v2/device_status の行を作る (bus_id でソート)。アタッチ情報は行の中に1回だけ持つ。
+    アタッチ情報はあるがデバイス一覧にないデバイスも、description / vid / pid を None にして含める。
+    """
+    attached_devices_log = state.attached_devices_log
+    rows = {}
+    for dev in exported_devices_list_from_cmd:
+        rows[dev["bus_id"]] = [dev["bus_id"], dev["description"], dev["vid"], dev["pid"], dev.get("bound"), False, None, None, None]
+    for bus_id, info in attached_devices_log.items():
+        row = rows.setdefault(bus_id, [bus_id, None, None, None, None, False, None, None, None])
+        row[5:] = [True, info.get("username"), info.get("client_ip"), info.get("timestamp")]
+    bus_ids = sorted(rows)
+    return [rows[bus_id] for bus_id in bus_ids], bus_ids
+
+def get_device_status_v2_rows(exported_devices_list_from_cmd, state):
+    """状態のバージョンごとに1回だけ行を作り、(行, bus_id のリスト) を返す。state はデバイス一覧より先に読んだもの"""
+    global device_status_v2_rows_cache
+    cached_version, rows, bus_ids = device_status_v2_rows_cache
+    if cached_version != state.version:
+        rows, bus_ids = build_device_status_v2_rows(exported_devices_list_from_cmd, state)
+        # 作っている間にバージョンが進んでいればキャッシュしない
+        if (cached_version is None or state.version > cached_version) and current_state.version == state.version:
+            device_status_v2_rows_cache = (state.version, rows, bus_ids)
+    return rows, bus_ids
+
+def encode_cursor(bus_id):
+    return base64.urlsafe_b64encode(bus_id.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+
+def parse_device_status_v2_query(args):
+    """
+    クエリパラメータを解釈する。不正な値は ValueError。
+      fields=bus_id,vid,...  返す列 (省略時は全部)
+      limit=N / cursor=...   ページング (cursor は前のページの next_cursor)
+      state=attached|available, vid=, pid=, bus_id_prefix=, q= (説明文の部分一致), username=  絞り込み
+    """
+    fields = [field for field in args.get("fields", "").split(",") if field] or list(DEVICE_STATUS_V2_FIELDS)
+    unknown = [field for field in fields if field not in DEVICE_STATUS_V2_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    try:
+        limit = int(args.get("limit", DEVICE_STATUS_V2_DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if not 1 <= limit <= DEVICE_STATUS_V2_MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {DEVICE_STATUS_V2_MAX_LIMIT}")
+    try:
+        after = decode_cursor(args["cursor"]) if args.get("cursor") else None
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    state_filter = args.get("state")
+    if state_filter not in (None, "attached", "available"):
+        raise ValueError("state must be 'attached' or 'available'")
+    conditions = [] # (列の位置, 行の値を判定する関数)
+    if state_filter:
+        conditions.append((5, lambda attached: attached == (state_filter == "attached")))
+    for field, index in (("vid", 2), ("pid", 3), ("username", 6)):
+        if args.get(field):
+            expected = args[field].lower()
+            conditions.append((index, lambda value, expected=expected: value is not None and value.lower() == expected))
+    if args.get("bus_id_prefix"):
+        conditions.append((0, lambda bus_id, prefix=args["bus_id_prefix"]: bus_id.startswith(prefix)))
+    if args.get("q"):
+        conditions.append((1, lambda description, text=args["q"].lower(): description is not None and text in description.lower()))
+    return fields, limit, after, conditions
+
+def build_device_status_v2_payload(rows, bus_ids, version, fields, limit, after, conditions):
+    """絞り込みとページングをして、選んだ列だけの応答データを作る"""
+    start = bisect.bisect_right(bus_ids, after) if after is not None else 0
+    indexes = [DEVICE_STATUS_V2_FIELDS.index(field) for field in fields]
+    page = []
+    next_cursor = None
+    last_bus_id = None # カーソルは返した最後の行の bus_id (bus_id 列を選ばなくても使えるように行から取る)
+    for row in itertools.islice(rows, start, None):
+        if all(check(row[index]) for index, check in conditions):
+            if len(page) == limit:
+                next_cursor = encode_cursor(last_bus_id)
+                break
+            page.append([row[index] for index in indexes])
+            last_bus_id = row[0]
+    return {"version": version, "fields": fields, "devices": page, "next_cursor": next_cursor}
+
+def encode_device_status_v2(payload, mimetype, use_gzip):
+    """応答データを JSON または MessagePack にし、必要なら gzip で圧縮する"""
+    if mimetype == MSGPACK_MIMETYPE:
+        body = msgpack.packb(payload, use_bin_type=True)
+    else:
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    if use_gzip and len(body) >= DEVICE_STATUS_V2_GZIP_MIN_SIZE:
+        return gzip.compress(body, compresslevel=5), True
+    return body, False
+
+def render_device_status_v2(query, query_string, mimetype, use_gzip, state, exported_devices_list_from_cmd, if_none_match):
+    """
+    /v2/device_status の応答を (ステータスコード, 本文, ヘッダ) で返す (server_asgi.py と共通)。
+    query は parse_device_status_v2_query の戻り値、query_string は応答キャッシュのキー。
+    state はデバイス一覧より先に読んだスナップショット (render_device_status と同じ理由)
+    """
+    global device_status_v2_body_cache
+    # 同じURLでも形式と圧縮で本文が変わるので、ETag にも含める
+    etag = f"{SERVER_INSTANCE_ID}-{state.version}-{'m' if mimetype == MSGPACK_MIMETYPE else 'j'}{'z' if use_gzip else ''}"
+    if if_none_match(etag):
+        return 304, b'', {'ETag': f'"{etag}"'}
+
+    cached_version, bodies = device_status_v2_body_cache
+    if cached_version != state.version:
+        bodies = {}
+        if cached_version is None or state.version > cached_version:
+            device_status_v2_body_cache = (state.version, bodies)
+    cache_key = (query_string, mimetype, use_gzip)
+    cached = bodies.get(cache_key)
+    if cached is None:
+        rows, bus_ids = get_device_status_v2_rows(exported_devices_list_from_cmd, state)
+        payload = build_device_status_v2_payload(rows, bus_ids, state.version, *query)
+        cached = encode_device_status_v2(payload, mimetype, use_gzip)
+        if len(bodies) < 256 and current_state.version == state.version: # クエリの組み合わせが多すぎるときはキャッシュしない
+            bodies[cache_key] = cached
+    body, compressed = cached
+    headers = {'Content-Type': mimetype, 'ETag': f'"{etag}"', 'Cache-Control': 'no-cache', 'Vary': 'Accept, Accept-Encoding'}
+    if compressed:
+        headers['Content-Encoding'] = 'gzip'
+    return 200, body, headers
+
+@app.route('/v2/device_status', methods=['GET'])
+def device_status_v2():
+    """
+    /device_status の正規化版。デバイス1台を1行で返し、列の選択・絞り込み・カーソルによるページングができる。
+    Accept: application/msgpack で MessagePack (msgpack がインストールされている場合)、Accept-Encoding: gzip で gzip 圧縮。
+    """
+    try:
+        query = parse_device_status_v2_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    mimetype = 'application/json'
+    if msgpack is not None and request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+        mimetype = MSGPACK_MIMETYPE
+    use_gzip = request.accept_encodings['gzip'] > 0
+    state = get_state() # デバイス一覧より先に読む (render_device_status を参照)
+    exported_devices_list_from_cmd = get_exported_devices_inventory()
+    status, body, headers = render_device_status_v2(query, request.query_string, mimetype, use_gzip,
+                                                    state, exported_devices_list_from_cmd, request.if_none_match.contains)
+    return Response(body, status=status, headers=headers)
+
+@app.route('/manage_server_device_binding', methods=['POST'])
+def manage_server_device_binding():
+    data = request.json
+    action = data.get('action') if isinstance(data, dict) else None # "bind" or "unbind"
+    bus_id = data.get('bus_id') if isinstance(data, dict) else None
+
+    # bus_id は文字列に限る (数値や null はロックの並べ替えや usbip の引数で例外になる)
+    if action not in ["bind", "unbind"] or not isinstance(bus_id, str) or not bus_id:
+        return jsonify({"error": "Missing or invalid action or bus_id"}), 400
+
+    cmd = ['usbip', action, '-b', bus_id]
+    try:
+        # 同じデバイスへの操作が終わるまで待つ (コマンドの実行からアタッチ情報の削除までを1つの操作にする)
+        held = device_locks.acquire([bus_id], timeout=float(server_config.get("device_lock_timeout", 20.0)))
+    except TimeoutError as e:
+        return jsonify({"error": str(e)}), 409
+    try:
+        log.info("Executing server command", extra={"cmd": ' '.join(cmd)})
+        # sudoers設定が前提
+        result = run_usbip(cmd[1:], timeout=float(server_config.get("usbip_bind_timeout", 15.0)))
+        body, status_code = apply_binding_result(action, bus_id, result)
+        return jsonify(body), status_code
+    except subprocess.TimeoutExpired:
+        error_message = f"Server device {action} for {bus_id} timed out and was cancelled."
+        log.error(error_message)
+        return jsonify({"error": error_message}), 504
+    except Exception as e:
+        error_message = f"Exception during server device {action} for {bus_id}: {e}"
+        log.exception(error_message)
+        return jsonify({"error": error_message}), 500
+    finally:
+        device_locks.release(held)
+
+def apply_binding_result(action, bus_id, result):
+    """usbip bind/unbind の結果を状態に反映し、(応答JSON, ステータスコード) を返す (server_asgi.py と共通)"""
+    if result.returncode == 0:
+        message = f"Device {bus_id} {action} successful."
+        cleared_attachment = False
+        if action == "unbind":
+            # アンバインド成功時、もしこのデバイスがアタッチログにあれば削除
+            removed = remove_attachments([bus_id], reason="unbind")
+            if removed:
+                detached_info = removed[bus_id]
+                message += f" Cleared attachment log for {bus_id} (was used by {detached_info.get('username')})."
+                cleared_attachment = True
+                log.info(f"Unbind cleared attachment log for {bus_id}")
+        invalidate_inventory_cache() # バインド状態が変わったのでデバイス一覧を取り直す
+        publish_state_change(action, {"bus_id": bus_id, "cleared_attachment": cleared_attachment})
+        log.info(message)
+        return {"message": message, "stdout": result.stdout, "stderr": result.stderr}, 200
+    error_message = f"Failed to {action} device {bus_id}."
+    log.error(error_message, extra={"returncode": result.returncode, "stderr": result.stderr or result.stdout})
+    return {"error": error_message, "stdout": result.stdout, "stderr": result.stderr}, 500
+
+
+def run_binding_command(action, bus_id, timeout):
+    """一括バインド/アンバインドの1件分。usbip bind/unbind を制限時間付きで実行し、結果を辞書で返す"""
+    cmd = ['usbip', action, '-b', bus_id]
+    result_info = {"action": action, "bus_id": bus_id}
+    try:
+        log.debug("Executing server command", extra={"cmd": ' '.join(cmd)})
+        # sudoers設定が前提
+        result = run_usbip(cmd[1:], timeout=timeout)
+        if result.returncode == 0:
+            result_info.update({"status": "ok", "message": f"Device {bus_id} {action} successful."})
+        else:
+            result_info.update({"status": "failed", "message": f"Failed to {action} device {bus_id}.",
+                                "stderr": result.stderr or result.stdout})
+    except subprocess.TimeoutExpired:
+        result_info.update({"status": "timeout", "message": f"{action} of {bus_id} did not finish within {timeout:.0f}s and was killed."})
+    except Exception as e:
+        result_info.update({"status": "failed", "message": f"Exception during server device {action} for {bus_id}: {e}"})
+        log.exception(result_info["message"])
+    log.log(logging.INFO if result_info["status"] == "ok" else logging.WARNING, result_info["message"],
+            extra={"bus_id": bus_id, "action": action, "status": result_info["status"]})
+    return result_info
+
+@app.route('/manage_server_device_binding_batch', methods=['POST'])
+def manage_server_device_binding_batch():
+    """複数デバイスのバインド/アンバインドを1リクエストで実行する。
+    リクエスト: {"operations": [{"action": "bind" | "unbind", "bus_id": "1-1.2"}, ...]}"""
+    data = request.json or {}
+    operations = data.get('operations') if isinstance(data, dict) else None
+    max_operations = int(server_config.get("binding_batch_max_operations", 100))
+
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "Missing or invalid operations list"}), 400
+    if len(operations) > max_operations:
+        return jsonify({"error": f"Too many operations ({len(operations)} > {max_operations})"}), 400
+    seen_bus_ids = set()
+    for op in operations:
+        # bus_id は文字列に限る (数値や null はロックの並べ替えや usbip の引数で例外になる)
+        if not isinstance(op, dict) or op.get('action') not in ["bind", "unbind"] or not isinstance(op.get('bus_id'), str) or not op['bus_id']:
+            return jsonify({"error": f"Missing or invalid action or bus_id in operation: {op}"}), 400
+        if op['bus_id'] in seen_bus_ids: # 同じデバイスへの操作が並列に走らないようにする
+            return jsonify({"error": f"Duplicate bus_id in operations: {op['bus_id']}"}), 400
+        seen_bus_ids.add(op['bus_id'])
+
+    log.info("Received batch binding request", extra={"operations": len(operations)})
+    max_workers = max(1, int(server_config.get("binding_batch_max_workers", 4)))
+    timeout = float(server_config.get("binding_command_timeout", 10.0))
+    try:
+        # 対象のデバイスのロックをまとめて取り、アタッチ情報の削除まで持ったままにする
+        held = device_locks.acquire(seen_bus_ids, timeout=float(server_config.get("device_lock_timeout", 20.0)))
+    except TimeoutError as e:
+        return jsonify({"error": str(e)}), 409
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(operations)),
+                                                   thread_name_prefix="binding-batch") as executor:
+            results = list(executor.map(lambda op: run_binding_command(op['action'], op['bus_id'], timeout), operations))
+
+        # アンバインドできたデバイスのアタッチ情報はまとめて1回のコミットで削除
+        unbound_bus_ids = [r["bus_id"] for r in results if r["action"] == "unbind" and r["status"] == "ok"]
+        removed = remove_attachments(unbound_bus_ids, reason="unbind")
+    finally:
+        device_locks.release(held)
+    for r in results:
+        if r["status"] != "ok":
+            continue
+        r["cleared_attachment"] = r["bus_id"] in removed
+        if r["cleared_attachment"]:
+            r["message"] += f" Cleared attachment log for {r['bus_id']} (was used by {removed[r['bus_id']].get('username')})."
+        publish_state_change(r["action"], {"bus_id": r["bus_id"], "cleared_attachment": r["cleared_attachment"]})
+    succeeded = sum(1 for r in results if r["status"] == "ok")
+    if succeeded:
+        invalidate_inventory_cache() # バインド状態が変わったのでデバイス一覧を取り直す
+
+    message = f"Batch binding finished. Success: {succeeded}, Failed: {len(results) - succeeded}."
+    log.info(message)
+    return jsonify({"message": message, "results": results}), 200 if succeeded == len(results) else 207
+
+def force_unbind_device(bus_id, timeout):
+    """全デバイス強制デタッチの1台分。usbip unbind を制限時間付きで実行し、結果を辞書で返す"""
+    cmd = ['usbip', 'unbind', '-b', bus_id] # アンバインドで強制的に切断
+    started_at = time.monotonic()
+    result_info = {"bus_id": bus_id}
+    try:
+        log.debug("Attempting to unbind (force detach) device", extra={"bus_id": bus_id})
+        # sudoers設定が前提。制限時間を超えたらプロセスを kill する
+        result = run_usbip(cmd[1:], timeout=timeout)
+        if result.returncode == 0:
+            result_info.update({"status": "unbound", "message": f"Unbound {bus_id}."})
+        else:
+            result_info.update({"status": "failed", "message": f"Failed to unbind {bus_id}: {result.stderr or result.stdout}"})
+    except subprocess.TimeoutExpired:
+        result_info.update({"status": "timeout", "message": f"Unbinding {bus_id} did not finish within {timeout:.0f}s and was killed."})
+    except Exception as e:
+        result_info.update({"status": "failed", "message": f"Exception unbinding {bus_id}: {e}"})
+        log.exception(result_info["message"])
+    result_info["elapsed"] = round(time.monotonic() - started_at, 3)
+    log.log(logging.INFO if result_info["status"] == "unbound" else logging.WARNING, result_info["message"],
+            extra={"bus_id": bus_id, "status": result_info["status"], "elapsed": result_info["elapsed"]})
+    return result_info
+
+def finish_force_unbinds(bus_ids):
+    """
+    アンバインドできたデバイスのアタッチ情報をまとめて削除し (他リクエストで既に消えていれば対象外)、
+    unbind イベントを1回のコミットで配信してデバイス一覧のキャッシュを破棄する。戻り値: { bus_id: 削除した情報 }
+    """
+    if not bus_ids:
+        return {}
+    removed = remove_attachments(bus_ids, reason="force_detach_all")
+    for bus_id, detached_info in removed.items():
+        log.info("Cleared attachment log", extra={"bus_id": bus_id, "username": detached_info.get('username')})
+    # イベントはアタッチ情報を削除してから配信する (購読者が受け取った時点で状態にも反映されているように)
+    with state_transaction():
+        commit_state(events=[("unbind", {"bus_id": bus_id, "cleared_attachment": bus_id in removed, "reason": "force_detach_all"})
+                             for bus_id in bus_ids])
+    invalidate_inventory_cache()
+    return removed
+
+def finish_late_force_unbind(future, bus_id):
+    """全体の制限時間を過ぎてから終わった usbip unbind の後始末。持っていたロックを返す"""
+    try:
+        if not future.cancelled() and future.result()["status"] == "unbound":
+            finish_force_unbinds([bus_id])
+    except Exception:
+        log.exception("Failed to clear attachment after late unbind", extra={"bus_id": bus_id})
+    finally:
+        device_locks.release([bus_id])
+
+@app.route('/force_detach_all_server_devices', methods=['POST'])
+def force_detach_all_server_devices():
+    log.info("Received request to force detach all server devices.")
+    
+    # 開始時点のスナップショットに載っているデバイスが対象
+    bus_ids_to_detach = list(get_state().attached_devices_log.keys())
+
+    if not bus_ids_to_detach:
+        return jsonify({"message": "No devices were attached according to the log. Nothing to detach."}), 200
+
+    # usbip unbind は上限付きのスレッドプールで並列に実行する。
+    # 1台ごとの制限時間と全体の制限時間があり、所要時間は一番遅いデバイスで決まる
+    max_workers = max(1, int(server_config.get("force_detach_max_workers", 8)))
+    device_timeout = float(server_config.get("force_detach_device_timeout", 10.0))
+    overall_timeout = float(server_config.get("force_detach_overall_timeout", 20.0))
+    started_at = time.monotonic()
+    # 対象のデバイスのロックを取る。別の操作が終わらないデバイスは飛ばして busy とする
+    held = device_locks.acquire(bus_ids_to_detach, timeout=min(float(server_config.get("device_lock_timeout", 20.0)), overall_timeout / 2),
+                                skip_busy=True)
+    results = [{"bus_id": bus_id, "status": "busy", "message": f"{bus_id} is busy with another operation and was skipped."}
+               for bus_id in bus_ids_to_detach if bus_id not in held]
+    futures = {}
+    if held:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(held)), thread_name_prefix="force-detach")
+        futures = {executor.submit(force_unbind_device, bus_id, device_timeout): bus_id for bus_id in held}
+        done, not_done = concurrent.futures.wait(futures, timeout=max(0.0, overall_timeout - (time.monotonic() - started_at)))
+        executor.shutdown(wait=False, cancel_futures=True) # 未着手のものは取り消す (実行中のものは各自の制限時間で終わる)
+        for future, bus_id in futures.items():
+            if future in done:
+                results.append(future.result())
+            else:
+                results.append({"bus_id": bus_id, "status": "timeout",
+                                "message": f"Force detach deadline ({overall_timeout:.0f}s) exceeded before {bus_id} finished."})
+
+    unbound_bus_ids = [r["bus_id"] for r in results if r["status"] == "unbound"]
+    try:
+        finish_force_unbinds(unbound_bus_ids)
+    finally:
+        # 終わったデバイスのロックはここで返す。まだ usbip unbind が動いているものは終わったときに
+        # (アンバインドできていればアタッチ情報の削除とイベントの配信をしてから) 返す
+        for future, bus_id in futures.items():
+            if future.done():
+                device_locks.release([bus_id])
+            else:
+                future.add_done_callback(lambda f, bus_id=bus_id: finish_late_force_unbind(f, bus_id))
+    detached_count = len(unbound_bus_ids)
+
+    errors = [{r["bus_id"]: r["message"]} for r in results if r["status"] != "unbound"]
+    if not errors:
+        return jsonify({"message": f"Successfully forced detach for {detached_count} device(s).", "results": results}), 200
+    else:
+        return jsonify({
+            "message": f"Forced detach attempted. Success: {detached_count}. Errors occurred for some devices.",
+            "errors": errors,
+            "results": results # デバイスごとの結果 (status: unbound / failed / timeout / busy)
+        }), 207 # Multi-Status
+
+@app.route('/events', methods=['GET'])
+def event_stream():
+    """
+    状態変化を Server-Sent Events で配信する。
+    イベント種別: attach, detach, bind, unbind, inventory (デバイス一覧の変化), resync (取りこぼしあり。全体を取り直すこと)
+    再接続時は Last-Event-ID ヘッダ (または ?last_event_id=) で続きから受信できる。
+    """
+    last_event_id_str = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    heartbeat_interval = float(server_config.get("event_heartbeat_interval", 15.0))
+
+    def generate():
+        cursor, needs_resync = resolve_event_cursor(last_event_id_str)
+        yield "retry: 3000\n\n"
+        if needs_resync:
+            yield format_sse("resync", {"version": get_state_version()}, cursor)
+        last_sent_at = time.monotonic()
+        while True:
+            pending = events_after(cursor)
+            if pending is None:
+                # 送信が追いつかずバックログから溢れた
+                _, cursor = event_id_range()
+                pending = [{"id": cursor, "type": "resync", "data": {"version": get_state_version()}}]
+            if pending:
+                for event in pending:
+                    yield format_sse(event["type"], event["data"], event["id"])
+                    cursor = event["id"]
+                last_sent_at = time.monotonic()
+                continue
+            idle_time = time.monotonic() - last_sent_at
+            if idle_time >= heartbeat_interval:
+                yield ": keepalive\n\n"
+                last_sent_at = time.monotonic()
+                idle_time = 0.0
+            wait_for_events(cursor, max(heartbeat_interval - idle_time, 0.01))
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/inventory_cache_stats', methods=['GET'])
+def get_inventory_cache_stats():
+    """デバイス一覧キャッシュのヒット/ミス数 (TTL調整用)"""
+    with inventory_cache_lock:
+        stats = dict(inventory_cache_stats)
+        stats["ttl"] = float(server_config.get("inventory_cache_ttl", 0))
+        stats["cached_devices"] = len(inventory_cache["devices"]) if inventory_cache["devices"] is not None else None
+    stats["usbip_circuit"] = usbip_executor.breaker_status()
+    return jsonify(stats)
+
+@app.route('/reconcile_status', methods=['GET'])
+def get_reconcile_status():
+    """最後の突き合わせの時刻・所要時間と、食い違っているアタッチ情報の数"""
+    with reconcile_lock:
+        stats = dict(reconcile_stats, pending=dict(reconcile_stats["pending"]))
+    stats["interval"] = float(server_config.get("reconcile_interval", 30.0))
+    return jsonify(stats)
+
+@app.route('/reconcile', methods=['POST'])
+def reconcile_now():
+    """今すぐ突き合わせを1回行う (食い違いの確認回数は通常と同じく数える)"""
+    removed = reconcile_once()
+    with reconcile_lock:
+        stats = dict(reconcile_stats, pending=dict(reconcile_stats["pending"]))
+    return jsonify(dict(stats, cleared=sorted(removed)))
+
+@app.route('/admission_status', methods=['GET'])
+def get_admission_status():
+    """同時処理数・待ち行列の状況と、レート制限の設定"""
+    return jsonify(dict(admission.status(), enabled=bool(server_config.get("admission_control_enabled", True)),
+                        rate_limits=server_config.get("rate_limits"), tracked_clients=rate_limiter.client_count(),
+                        device_locks=device_locks.status()))
+
+USAGE_TIME_MAX = datetime.datetime(9999, 12, 31).timestamp() # /usage で指定できる時刻の上限 (これより後は datetime で表せない)
+
+def parse_time_param(value, default):
+    """UNIX 秒または ISO 8601 (タイムゾーンなしはサーバーのローカル時刻) を UNIX 秒にする。読めないか範囲外なら ValueError"""
+    if not value:
+        return default
+    try:
+        timestamp = float(value)
+    except ValueError:
+        timestamp = datetime.datetime.fromisoformat(value).timestamp()
+    # nan / inf や datetime で表せない時刻は、集計や応答の isoformat で例外 (500) になるので断る
+    if not (math.isfinite(timestamp) and 0 <= timestamp <= USAGE_TIME_MAX):
+        raise ValueError(f"time out of range: {value}")
+    return timestamp
+
+@app.route('/usage', methods=['GET'])
+def get_usage():
+    """
+    デバイスごとの利用状況 (使用時間・使用率・アタッチ回数・利用者)。使用率の高い順。
+    集計済みの1時間/1日単位の値とアタッチ中のデバイスだけから答える (生の履歴は読まない)。
+    クエリ: from / to (UNIX 秒または ISO 8601。既定は直近7日)、resolution ("hour" / "day"。既定は2日以内なら hour)、bus_id (複数可)
+    """
+    if usage_store is None:
+        return jsonify({"error": "Usage history is disabled"}), 404
+    try:
+        range_end = parse_time_param(request.args.get('to'), time.time())
+        range_start = parse_time_param(request.args.get('from'), max(0.0, range_end - 7 * 86400))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid time range: {e}"}), 400
+    if range_start >= range_end:
+        return jsonify({"error": "'from' must be earlier than 'to'"}), 400
+    resolution = request.args.get('resolution') or ("hour" if range_end - range_start <= 2 * 86400 else "day")
+    if resolution not in usage_history.RESOLUTIONS:
+        return jsonify({"error": f"Unknown resolution: {resolution} (use 'hour' or 'day')"}), 400
+    bus_ids = {bus_id for value in request.args.getlist('bus_id') for bus_id in value.split(',') if bus_id}
+    open_sessions = []
+    for bus_id, info in get_state().attached_devices_log.items():
+        started_at = attachment_started_at(info)
+        if started_at is not None:
+            open_sessions.append((bus_id, info.get("username"), started_at))
+    devices = usage_store.query(range_start, range_end, resolution, bus_ids or None, open_sessions)
+    return jsonify({
+        "from": datetime.datetime.fromtimestamp(range_start).isoformat(),
+        "to": datetime.datetime.fromtimestamp(range_end).isoformat(),
+        "resolution": resolution,
+        "retained_from": datetime.datetime.fromtimestamp(usage_store.retained_from(resolution)).isoformat(), # これより前は集計が残っていない
+        "devices": devices,
+    })
+
+@app.route('/device_filters', methods=['GET'])
+def get_device_filters():
+    """デバイスフィルタのルールとルールごとのヒット数"""
+    return jsonify({"rules": device_filter.stats()})
+
+@app.route('/device_filters/reload', methods=['POST'])
+def reload_device_filters_endpoint():
+    """server_config.json の device_filters を今すぐ読み直す (ファイルの更新は次のデバイス一覧の取得時にも自動で反映される)"""
+    try:
+        reload_device_filters(force=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    invalidate_inventory_cache() # 新しいルールでデバイス一覧を作り直す
+    return jsonify({"message": "Device filters reloaded.", "rules": device_filter.stats()}), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 形式のメトリクス (リクエスト/usbip コマンド/状態の保存と読み込みの所要時間など)"""
+    return Response(metrics.render(), mimetype=app_metrics.MetricsRegistry.CONTENT_TYPE)
+
+# --- アプリケーション起動時の処理 ---
+def init_server(config_overrides=None):
+    """
+    設定と状態を読み込み、前回のアタッチ情報をカーネルの状態に合わせる (startup_mode が "cold" ならクリアする)。
+    ワーカーを起動する前に1回だけ呼ぶ
+    """
+    # --- 旧形式のアタッチ情報ファイルは内容を読んでから削除する ---
+    attach_log_path = ATTACHED_DEVICES_LOG_FILE
+    legacy_attachments = {}
+    if os.path.exists(attach_log_path):
+        legacy_attachments = load_legacy_json_dict(attach_log_path)
+        try:
+            log.info(f"Removing legacy attachment log: {attach_log_path}")
+            os.remove(attach_log_path)
+        except OSError as e:
+            log.error(f"Error removing legacy attachment log file: {e}")
+            # ファイルがロックされているなどの理由で削除に失敗した場合でも、
+            # アプリの起動は続行する。ただし、ログにはエラーを残す。
+
+    load_server_config()
+    if config_overrides:
+        server_config.update(config_overrides) # コマンドライン引数を優先
+    load_persisted_state()
+    open_usage_history()
+    open_usb_ids_index()
+    if server_config.get("startup_mode", "warm") == "warm":
+        restore_attachments_from_kernel(legacy_attachments) # 再起動をまたいでアタッチ中のデバイスの利用者を引き継ぐ
+    else:
+        previous_attachments = list(get_state().attached_devices_log.keys())
+        if previous_attachments:
+            log.info(f"Clearing previous attachment log ({len(previous_attachments)} entries).")
+            remove_attachments(previous_attachments, reason="startup")
+        else:
+            log.info("No previous attachments found. Starting fresh.")
+    if os.geteuid() != 0: # rootチェック
+        log.warning("Server not running as root. 'usbip' commands might require sudo privileges.")
+
+def create_app():
+    """
+    WSGIサーバー用のエントリポイント (例: gunicorn -w 4 --preload 'server_app:create_app()')。
+    複数ワーカーで動かす場合は server_config.json で "state_backend": "sqlite" を指定すること。
+    """
+    init_server()
+    return app
+
+def run_worker_pool(host, port, workers):
+    """
+    待ち受けソケットを作ってから workers 個のプロセスを fork し、各プロセスで同じソケットを accept する。
+    状態は sqlite ストアで共有する。突き合わせ (reconciler) はワーカー0だけで行う。
+    """
+    global reconciler_pid
+    from werkzeug.serving import make_server
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((host, port))
+    listen_socket.listen(128)
+    listen_socket.set_inheritable(True)
+
+    worker_pids = []
+    for worker_index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if state_journal is not None: # --workers 1 はジャーナルのまま動かす
+                state_journal.start_writer()
+            if worker_index == 0:
+                start_reconciler()
+            else:
+                reconciler_pid = os.getpid() # 最初のリクエストで start_request_timer が起動しないようにする (状態は共有なので1つで足りる)
+            server = make_server(host, port, app, threaded=True, fd=listen_socket.fileno())
+            log.info(f"Worker {worker_index} (pid {os.getpid()}) serving on {host}:{port}")
+            try:
+                server.serve_forever()
+            finally:
+                app_logging.shutdown_logging() # os._exit では atexit が動かないのでキューを書き出しておく
+                os._exit(0)
+        worker_pids.append(pid)
+
+    def stop_workers(signum, frame):
+        for pid in worker_pids:
+            try: os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError: pass
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    log.info(f"Started {workers} worker(s) on {host}:{port}: {worker_pids}")
+    for pid in worker_pids:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="USB/IP device sharing server")
+    parser.add_argument('--workers', type=int, help="number of worker processes (overrides server_config.json)")
+    parser.add_argument('--port', type=int, help="listen port (overrides server_config.json)")
+    args = parser.parse_args()
+
+    overrides = {}
+    if args.workers: overrides["workers"] = args.workers
+    if args.port: overrides["port"] = args.port
+    load_server_config()
+    workers = int(overrides.get("workers", server_config.get("workers", 1)))
+    if workers > 1 and server_config.get("state_backend", "journal") != "sqlite":
+        log.info("Multiple workers require the sqlite state backend. Switching state_backend to 'sqlite'.")
+        overrides["state_backend"] = "sqlite"
+
+    config = dict(server_config, **overrides)
+    host, port = config.get("host", "0.0.0.0"), int(config.get("port", 5000))
+    if args.workers or workers > 1: # --workers 指定時は本番向けのワーカープロセスで起動
+        init_server(overrides)
+        run_worker_pool(host, port, workers)
+    else:
+        # debug=True のリローダーは、ファイルを監視する親プロセスと実際に待ち受ける子プロセスでこのスクリプトを2回実行する。
+        # 状態の読み込み・アタッチ情報の復元と照合は子プロセスでだけ行う
+        # (親の状態は古いままなので、同じジャーナルと利用履歴に誤った記録を書いてしまう)
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            init_server(overrides)
+            start_reconciler()
+        app.run(host=host, port=port, debug=True)
@@ -0,0 +1,400 @@
+# server_asgi.py
+# server_app.py を asyncio (ASGI) で動かすモード。1プロセスで数百の /device_status や /events の同時接続を待ち受ける。
+#   - /device_status, /v2/device_status, /events, /manage_server_device_binding はイベントループ上で処理し、
+#     usbip コマンドは asyncio.create_subprocess_exec で実行する (待っている間スレッドを使わない)
+#   - それ以外のエンドポイントは server_app の Flask アプリを WSGI として同じプロセスで動かす (少数のスレッドで処理)
+#   - 状態・デバイス一覧キャッシュ・ジャーナル・イベント・メトリクス・usbip の実行枠は server_app のものを共有する。
+#     状態の保存 (fsync 待ち) はイベントループの外のスレッドで行う
+#
+# 必要なライブラリ: starlette, uvicorn, a2wsgi
+# 起動: python server_asgi.py [--port 5000]
+#       (ほかの ASGI サーバーでは 'server_asgi:create_app' を factory として使う。例: uvicorn --factory server_asgi:create_app)
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import subprocess
+import time
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+import uvicorn
+
+import server_app
+from server_app import CircuitOpenError, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, UsbipExecutor
+
+event_waiters = set() # /events の購読者が新しいイベントを待っている Future (イベントループのスレッドだけが触る)
+# 空きを待つスレッドは既定のスレッドプール (asyncio.to_thread) とは別にする。待っているスレッドで既定のプールが埋まると、
+# 枠を持っているリクエストが後始末 (状態の保存) のスレッドを取れず、枠が空かなくなる。大きさは build_asgi_app で server_config から決める
+usbip_slot_waiters = None # usbip_executor の実行枠を待つスレッド
+admission_waiters = None # 受付の待ち行列で待つスレッド
+device_lock_waiters = None # デバイスロックを待つスレッド。ロックを持っているリクエストはアタッチ情報の削除を asyncio.to_thread で行ってから返す
+
+def configure_waiter_pools():
+    """
+    空きを待つスレッドのプールを作る。受付を通ったリクエストしか実行枠やロックを待たないので max_concurrent_requests 本、
+    受付の待ち行列で待てるのは interactive_queue_size 件までなのでその本数あれば足りる
+    """
+    global usbip_slot_waiters, admission_waiters, device_lock_waiters
+    max_requests = max(1, int(server_app.server_config.get("max_concurrent_requests", 32)))
+    queue_size = max(1, int(server_app.server_config.get("interactive_queue_size", 8)))
+    for pool in (usbip_slot_waiters, admission_waiters, device_lock_waiters):
+        if pool is not None:
+            pool.shutdown(wait=False)
+    usbip_slot_waiters = concurrent.futures.ThreadPoolExecutor(max_workers=max_requests, thread_name_prefix="usbip-slot-wait")
+    admission_waiters = concurrent.futures.ThreadPoolExecutor(max_workers=queue_size, thread_name_prefix="admission-wait")
+    device_lock_waiters = concurrent.futures.ThreadPoolExecutor(max_workers=max_requests, thread_name_prefix="device-lock-wait")
+
+async def run_blocking_wait(pool, wait, timeout, on_late_success):
+    """
+    wait(残り秒数) を pool のスレッドで呼び、結果を返す。pool のスレッドが空くまでの時間も timeout (None なら無制限) に含める。
+    待っている間にリクエストがキャンセル (クライアントが切断) されたら、あとで取れたものを on_late_success(結果) ですぐ返す
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    future = asyncio.get_running_loop().run_in_executor(
+        pool, lambda: wait(None if deadline is None else max(0.0, deadline - time.monotonic())))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(lambda f: not f.cancelled() and f.exception() is None and on_late_success(f.result()))
+        raise
+
+
+# --- usbip コマンド (asyncio) ---
+async def acquire_usbip_slot(priority, timeout):
+    """usbip_executor の実行枠を取る。空いていればその場で取り、空いていなければ usbip_slot_waiters のスレッドで待つ"""
+    executor = server_app.usbip_executor
+    if executor.acquire(priority, 0):
+        return True
+    return await run_blocking_wait(usbip_slot_waiters, lambda remaining: executor.acquire(priority, remaining), timeout,
+                                   lambda acquired: acquired and executor.release())
+
+async def run_usbip_async(args, priority=PRIORITY_INTERACTIVE, timeout=None, stdout_parser=None):
+    """
+    UsbipExecutor.run の asyncio 版。同じ実行枠・サーキットブレーカー・メトリクスを使う。
+    制限時間を超えたら (またはリクエストがキャンセルされたら) プロセスグループごと終了させる。
+    """
+    executor = server_app.usbip_executor
+    cmd = ['usbip', *args]
+    command = args[0]
+    if priority == PRIORITY_BACKGROUND and not executor.breaker_allows(command):
+        raise CircuitOpenError(f"'{' '.join(cmd)}' skipped: usbip has been failing, retrying later")
+    lane = "interactive" if priority == PRIORITY_INTERACTIVE else "background"
+    wait_started_at = time.perf_counter()
+    acquired = await acquire_usbip_slot(priority, timeout)
+    server_app.usbip_queue_wait_duration.observe(time.perf_counter() - wait_started_at, lane)
+    if not acquired:
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    started_at = time.perf_counter()
+    code = "error"
+    try:
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                       start_new_session=True)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            code = "timeout" if isinstance(e, asyncio.TimeoutError) else "cancelled"
+            UsbipExecutor.kill(process)
+            await asyncio.shield(process.wait())
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            server_app.log.warning("Killed usbip command after timeout", extra={"cmd": ' '.join(cmd), "timeout": timeout})
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        code = str(process.returncode)
+        stdout_text = stdout.decode('utf-8', errors='replace')
+        return subprocess.CompletedProcess(cmd, process.returncode,
+                                           stdout_parser(stdout_text) if stdout_parser else stdout_text,
+                                           stderr.decode('utf-8', errors='replace'))
+    finally:
+        executor.release()
+        server_app.usbip_command_duration.observe(time.perf_counter() - started_at, command)
+        server_app.usbip_command_exits.inc(command, code)
+        if priority == PRIORITY_BACKGROUND:
+            executor.record_outcome(command, code == "0")
+
+async def run_usbip_list_local_async():
+    """server_app.run_usbip_list_local の asyncio 版。失敗時は None"""
+    try:
+        result = await run_usbip_async(['list', '-l'], priority=PRIORITY_BACKGROUND,
+                                       timeout=float(server_app.server_config.get("usbip_list_timeout", 10.0)),
+                                       stdout_parser=server_app.parse_usbip_list_local)
+    except CircuitOpenError as e:
+        server_app.log.warning(str(e))
+        return None
+    except Exception as e:
+        server_app.log.error(f"Exception executing usbip list -l: {e}")
+        return None
+    if result.returncode != 0:
+        server_app.log.error(f"Error executing 'usbip list -l': {result.stderr}")
+        return None
+    for dev in result.stdout:
+        dev["bound"] = None # usbip list -l からはバインド状態が分からない
+    return result.stdout
+
+async def load_device_inventory_async():
+    if server_app.server_config.get("inventory_backend", "usbip") == "sysfs":
+        return await asyncio.to_thread(server_app.load_device_inventory) # ファイルの読み込みだけなのでスレッドで
+    devices = await run_usbip_list_local_async()
+    return server_app.apply_device_filters(devices) if devices is not None else None
+
+async def get_exported_devices_inventory_async():
+    """server_app.get_exported_devices_inventory の asyncio 版。キャッシュと single-flight は Flask 側と共有する"""
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    devices, flight, generation = server_app.begin_inventory_refresh(
+        on_done=lambda: loop.call_soon_threadsafe(set_future_done, done))
+    if devices is not None:
+        return devices
+    if generation is None:
+        await done # 実行中のリフレッシュ (Flask 側のスレッドの場合もある) を待つ
+        return list(flight["devices"] or [])
+    devices = None
+    try:
+        devices = await load_device_inventory_async()
+    finally:
+        server_app.finish_inventory_refresh(flight, generation, devices)
+    return list(flight["devices"] or [])
+
+def set_future_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+# --- イベント配信 (asyncio) ---
+def wake_event_waiters():
+    """publish_event から (call_soon_threadsafe 経由で) 呼ばれ、/events の購読者を起こす"""
+    for future in event_waiters:
+        set_future_done(future)
+    event_waiters.clear()
+
+async def wait_for_events_async(cursor, timeout):
+    """server_app.wait_for_events の asyncio 版。sqlite バックエンドでは他ワーカーの分を定期的に確認する"""
+    future = asyncio.get_running_loop().create_future()
+    event_waiters.add(future)
+    try:
+        if server_app.state_store is None:
+            if server_app.last_event_id > cursor:
+                return
+        else:
+            timeout = min(timeout, server_app.EVENT_POLL_INTERVAL)
+        await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        event_waiters.discard(future)
+
+
+# --- リクエストの補助 ---
+def if_none_match_checker(request):
+    """If-None-Match ヘッダに ETag が含まれているかを返す関数を作る (werkzeug の if_none_match.contains 相当)"""
+    header = request.headers.get('if-none-match')
+    if not header:
+        return lambda etag: False
+    tags = {tag.strip().removeprefix('W/').strip('"') for tag in header.split(',')}
+    return lambda etag: '*' in tags or etag in tags
+
+def header_quality(header, value):
+    """Accept / Accept-Encoding ヘッダで value に付いている q 値 (一番具体的に一致したもの)。一致しなければ 0"""
+    best_specificity, best_quality = -1, 0.0
+    major = value.split('/')[0]
+    for item in header.split(','):
+        token, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try: quality = float(param[2:])
+                except ValueError: quality = 0.0
+        if token == value: specificity = 2
+        elif token == f"{major}/*": specificity = 1
+        elif token in ('*/*', '*'): specificity = 0
+        else: continue
+        if specificity > best_specificity:
+            best_specificity, best_quality = specificity, quality
+    return best_quality
+
+async def enter_admission(endpoint_class):
+    """server_app.admission.enter の asyncio 版。すぐに受け付けられなければ admission_waiters のスレッドで待ち行列に並ぶ"""
+    admission = server_app.admission
+    if admission.try_enter(endpoint_class): # read は待たない (空きがなければその場で RateLimitedError)
+        return
+    await run_blocking_wait(admission_waiters, lambda remaining: admission.enter(endpoint_class, remaining), admission.queue_timeout,
+                            lambda result: admission.leave(endpoint_class))
+
+async def acquire_device_locks(bus_ids, timeout):
+    """server_app.device_locks.acquire の asyncio 版。空いていればその場で取り、空いていなければ device_lock_waiters のスレッドで待つ"""
+    device_locks = server_app.device_locks
+    try:
+        return device_locks.acquire(bus_ids, timeout=0)
+    except TimeoutError:
+        pass
+    return await run_blocking_wait(device_lock_waiters, lambda remaining: device_locks.acquire(bus_ids, remaining), timeout,
+                                   device_locks.release)
+
+def timed(endpoint):
+    """Flask の before_request / after_request と同じ受付制御とメトリクスの記録を行う"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            started_at = time.perf_counter()
+            server_app.http_requests_in_flight.inc()
+            status = "500"
+            client_ip = request.client.host if request.client else None
+            try:
+                try:
+                    endpoint_class = server_app.check_rate_limit(client_ip, endpoint)
+                    if endpoint_class is not None:
+                        await enter_admission(endpoint_class)
+                except server_app.RateLimitedError as e:
+                    body, headers = server_app.rate_limited_reply(endpoint, client_ip, e)
+                    status = "429"
+                    return JSONResponse(body, status_code=429, headers=headers)
+                try:
+                    response = await handler(request)
+                finally:
+                    if endpoint_class is not None:
+                        server_app.admission.leave(endpoint_class)
+                status = str(response.status_code)
+                return response
+            finally:
+                server_app.http_requests_in_flight.dec()
+                server_app.http_request_duration.observe(time.perf_counter() - started_at, endpoint, request.method, status)
+        return wrapper
+    return decorator
+
+
+# --- API エンドポイント (asyncio) ---
+@timed('/device_status')
+async def device_status(request):
+    state = server_app.get_state() # デバイス一覧より先に読む (server_app.render_device_status を参照)
+    exported_devices_list_from_cmd = await get_exported_devices_inventory_async()
+    status, body, headers = server_app.render_device_status(state, exported_devices_list_from_cmd, if_none_match_checker(request))
+    return Response(body, status_code=status, headers=headers)
+
+@timed('/v2/device_status')
+async def device_status_v2(request):
+    try:
+        query = server_app.parse_device_status_v2_query(request.query_params)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    mimetype = 'application/json'
+    accept = request.headers.get('accept')
+    if server_app.msgpack is not None and accept and \
+            header_quality(accept, server_app.MSGPACK_MIMETYPE) > header_quality(accept, 'application/json'):
+        mimetype = server_app.MSGPACK_MIMETYPE
+    use_gzip = header_quality(request.headers.get('accept-encoding', ''), 'gzip') > 0
+    state = server_app.get_state() # デバイス一覧より先に読む (server_app.render_device_status を参照)
+    exported_devices_list_from_cmd = await get_exported_devices_inventory_async()
+    status, body, headers = server_app.render_device_status_v2(query, request.scope.get('query_string', b''), mimetype, use_gzip,
+                                                               state, exported_devices_list_from_cmd, if_none_match_checker(request))
+    return Response(body, status_code=status, headers=headers)
+
+@timed('/manage_server_device_binding')
+async def manage_server_device_binding(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return JSONResponse({"error": "Invalid JSON body"}, status_code=400)
+    action = data.get('action') if isinstance(data, dict) else None
+    bus_id = data.get('bus_id') if isinstance(data, dict) else None
+    # bus_id は文字列に限る (数値や null はロックの並べ替えや usbip の引数で例外になる)
+    if action not in ["bind", "unbind"] or not isinstance(bus_id, str) or not bus_id:
+        return JSONResponse({"error": "Missing or invalid action or bus_id"}, status_code=400)
+    try:
+        held = await acquire_device_locks([bus_id], float(server_app.server_config.get("device_lock_timeout", 20.0)))
+    except TimeoutError as e:
+        return JSONResponse({"error": str(e)}, status_code=409)
+    try:
+        server_app.log.info("Executing server command", extra={"cmd": f"usbip {action} -b {bus_id}"})
+        result = await run_usbip_async([action, '-b', bus_id], timeout=float(server_app.server_config.get("usbip_bind_timeout", 15.0)))
+        # アタッチ情報の削除は永続化 (fsync) を待つので、イベントループの外で行う
+        body, status_code = await asyncio.to_thread(server_app.apply_binding_result, action, bus_id, result)
+        return JSONResponse(body, status_code=status_code)
+    except subprocess.TimeoutExpired:
+        error_message = f"Server device {action} for {bus_id} timed out and was cancelled."
+        server_app.log.error(error_message)
+        return JSONResponse({"error": error_message}, status_code=504)
+    except Exception as e:
+        error_message = f"Exception during server device {action} for {bus_id}: {e}"
+        server_app.log.exception(error_message)
+        return JSONResponse({"error": error_message}, status_code=500)
+    finally:
+        server_app.device_locks.release(held)
+
+@timed('/events')
+async def event_stream(request):
+    """server_app.event_stream と同じ Server-Sent Events。購読者1人あたりのスレッドは使わない"""
+    last_event_id_str = request.headers.get('last-event-id') or request.query_params.get('last_event_id')
+    heartbeat_interval = float(server_app.server_config.get("event_heartbeat_interval", 15.0))
+
+    async def generate():
+        cursor, needs_resync = server_app.resolve_event_cursor(last_event_id_str)
+        yield "retry: 3000\n\n"
+        if needs_resync:
+            yield server_app.format_sse("resync", {"version": server_app.get_state_version()}, cursor)
+        last_sent_at = time.monotonic()
+        while True:
+            pending = server_app.events_after(cursor)
+            if pending is None:
+                # 送信が追いつかずバックログから溢れた
+                _, cursor = server_app.event_id_range()
+                pending = [{"id": cursor, "type": "resync", "data": {"version": server_app.get_state_version()}}]
+            if pending:
+                for event in pending:
+                    yield server_app.format_sse(event["type"], event["data"], event["id"])
+                    cursor = event["id"]
+                last_sent_at = time.monotonic()
+                continue
+            idle_time = time.monotonic() - last_sent_at
+            if idle_time >= heartbeat_interval:
+                yield ": keepalive\n\n"
+                last_sent_at = time.monotonic()
+                idle_time = 0.0
+            await wait_for_events_async(cursor, max(heartbeat_interval - idle_time, 0.01))
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# --- アプリケーション ---
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    loop = asyncio.get_running_loop()
+    def listener():
+        loop.call_soon_threadsafe(wake_event_waiters)
+    server_app.event_listeners.append(listener)
+    server_app.start_reconciler()
+    try:
+        yield
+    finally:
+        server_app.event_listeners.remove(listener)
+
+def build_asgi_app():
+    """init_server 済みの server_app から ASGI アプリを作る"""
+    wsgi_threads = int(server_app.server_config.get("asgi_wsgi_threads", 8))
+    configure_waiter_pools()
+    return Starlette(routes=[
+        Route('/device_status', device_status, methods=['GET']),
+        Route('/v2/device_status', device_status_v2, methods=['GET']),
+        Route('/manage_server_device_binding', manage_server_device_binding, methods=['POST']),
+        Route('/events', event_stream, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(server_app.app, workers=wsgi_threads)), # 残りのエンドポイントは Flask で処理
+    ], lifespan=lifespan)
+
+def create_app():
+    """ASGI サーバー用のエントリポイント (factory)。状態の保存先は1プロセス前提 (journal)"""
+    server_app.init_server()
+    return build_asgi_app()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="USB/IP device sharing server (asyncio / ASGI mode)")
+    parser.add_argument('--port', type=int, help="listen port (overrides server_config.json)")
+    args = parser.parse_args()
+
+    server_app.init_server({"port": args.port} if args.port else None)
+    host, port = server_app.server_config.get("host", "0.0.0.0"), int(server_app.server_config.get("port", 5000))
+    server_app.log.info(f"Serving (asyncio) on {host}:{port}")
+    uvicorn.run(build_asgi_app(), host=host, port=port, log_level="warning", access_log=False, backlog=2048)
@@ -0,0 +1,242 @@
+# stress_device_locks.py
+# デバイスごとの操作ロック (server_app.device_locks) のストレステスト。
+# 複数のスレッドから少数のデバイスにバインド/アンバインド、アタッチ/デタッチ通知、一括バインド、全デバイス強制デタッチを
+# ランダムに送り、次を確認する:
+#   1. 同じデバイスの usbip コマンドが重なって実行されていない (偽の usbip が実行中の印のファイルで検出する)
+#   2. 別のデバイスの usbip コマンドは並列に実行されている
+#   3. デバイスごとの操作の結果が線形化可能 (どれかの逐次実行の順番で、すべての応答と最後の状態を説明できる)
+# 偽の usbip はバインド状態をファイルに持ち、読んでから書くまでの間に待つ (重なって実行されると更新が失われる)。
+# server_app の Flask アプリを同じプロセスで動かす (サーバーは起動しない)。--no-locks でロックを外すと違反が検出される。
+#
+# 使い方: python stress_device_locks.py [--clients 8] [--devices 6] [--ops-per-client 100] [--latency 0.01 0.04] [--no-locks]
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FAKE_USBIP = '''#!/bin/sh
+# ストレステスト用の偽 usbip。bind/unbind はバインド状態をファイルで持ち、読んでから書くまでの間に待つ
+STATE_DIR="{state_dir}"
+if [ "$1" = "bind" ] || [ "$1" = "unbind" ]; then
+    action="$1"; bus_id="$3"
+    marker="$STATE_DIR/$bus_id.running"
+    if ! mkdir "$marker" 2>/dev/null; then
+        echo "$action $bus_id overlapped another command on the same device" >> "$STATE_DIR/violations"
+        marker=""
+    fi
+    started_at=$(date +%s.%N)
+    bound=0; [ -e "$STATE_DIR/$bus_id.bound" ] && bound=1
+    sleep "$(awk -v seed=$$ 'BEGIN {{ srand(seed); printf "%.3f", {min_latency} + rand() * ({max_latency} - {min_latency}) }}')"
+    ok=false
+    if [ "$action" = "bind" ] && [ $bound -eq 0 ]; then ok=true; : > "$STATE_DIR/$bus_id.bound"; fi
+    if [ "$action" = "unbind" ] && [ $bound -eq 1 ]; then ok=true; rm -f "$STATE_DIR/$bus_id.bound"; fi
+    echo "[$started_at, $(date +%s.%N), \\"$action\\", \\"$bus_id\\", $ok]" >> "$STATE_DIR/commands"
+    [ -n "$marker" ] && rmdir "$marker"
+    if [ "$ok" = true ]; then
+        echo "usbip: info: $action device on busid $bus_id: complete"
+        exit 0
+    fi
+    echo "usbip: error: device on busid $bus_id is already in the requested state" >&2
+    exit 1
+fi
+exit 0 # list -l などは空の一覧
+'''
+
+
+def write_fake_usbip(bin_dir, state_dir, min_latency, max_latency):
+    path = os.path.join(bin_dir, 'usbip')
+    with open(path, 'w') as f:
+        f.write(FAKE_USBIP.format(state_dir=state_dir, min_latency=min_latency, max_latency=max_latency))
+    os.chmod(path, 0o755)
+
+
+# --- 負荷 ---
+def client_loop(client_id, bus_ids, ops, history, history_lock):
+    """1クライアント分。操作の開始/応答の時刻と結果を、デバイスごとの履歴に追加する"""
+    import server_app
+    client = server_app.app.test_client()
+    rng = random.Random(client_id)
+    username = f"user{client_id}"
+
+    def record(bus_id, entry):
+        with history_lock:
+            history[bus_id].append(entry)
+
+    for _ in range(ops):
+        kind = rng.choices(["bind", "unbind", "attach", "detach", "batch", "force"], weights=[25, 25, 20, 20, 7, 3])[0]
+        invoked_at = time.monotonic()
+        if kind in ("bind", "unbind"):
+            bus_id = rng.choice(bus_ids)
+            response = client.post('/manage_server_device_binding', json={"action": kind, "bus_id": bus_id})
+            body = response.get_json()
+            record(bus_id, {"op": kind, "invoke": invoked_at, "response": time.monotonic(), "ok": response.status_code == 200,
+                            "cleared": "Cleared attachment log" in body.get("message", "") if response.status_code == 200 else None})
+        elif kind == "attach":
+            bus_id = rng.choice(bus_ids)
+            client.post('/notify_attach', json={"client_ip": f"10.0.0.{client_id + 1}", "username": username, "attached_bus_id": bus_id})
+            record(bus_id, {"op": "attach", "invoke": invoked_at, "response": time.monotonic(), "user": username})
+        elif kind == "detach":
+            bus_id = rng.choice(bus_ids)
+            response = client.post('/notify_detach', json={"detached_bus_id": bus_id})
+            record(bus_id, {"op": "detach", "invoke": invoked_at, "response": time.monotonic(),
+                            "found": "not found in log" not in response.get_json()["message"]})
+        elif kind == "batch":
+            targets = rng.sample(bus_ids, rng.randint(2, min(3, len(bus_ids))))
+            operations = [{"action": rng.choice(["bind", "unbind"]), "bus_id": bus_id} for bus_id in targets]
+            response = client.post('/manage_server_device_binding_batch', json={"operations": operations})
+            responded_at = time.monotonic()
+            for r in response.get_json()["results"]:
+                record(r["bus_id"], {"op": r["action"], "invoke": invoked_at, "response": responded_at, "ok": r["status"] == "ok",
+                                     "cleared": r.get("cleared_attachment") if r["status"] == "ok" else None})
+        else:
+            response = client.post('/force_detach_all_server_devices', json={})
+            responded_at = time.monotonic()
+            for r in response.get_json().get("results", []):
+                if r["status"] in ("unbound", "failed"): # busy / timeout は何もしていない (または結果が分からない)
+                    record(r["bus_id"], {"op": "unbind", "invoke": invoked_at, "response": responded_at,
+                                         "ok": r["status"] == "unbound", "cleared": None})
+
+
+# --- 線形化可能性の検査 (Wing & Gong の探索をデバイスごとに行う) ---
+def apply_op(state, op):
+    """デバイス1台のモデル (バインド済みか, アタッチしているユーザー) に操作を適用する。結果が矛盾すれば None"""
+    bound, attached = state
+    kind = op["op"]
+    if kind == "bind":
+        if op["ok"] != (not bound):
+            return None
+        return (True, attached) if op["ok"] else state
+    if kind == "unbind":
+        if op["ok"] != bound:
+            return None
+        if not op["ok"]:
+            return state
+        if op["cleared"] is not None and op["cleared"] != (attached is not None):
+            return None
+        return (False, None)
+    if kind == "attach":
+        return (bound, op["user"])
+    if op["found"] != (attached is not None): # detach
+        return None
+    return (bound, None)
+
+def is_linearizable(ops, initial_state, final_state):
+    ops = sorted(ops, key=lambda op: op["invoke"])
+    full = (1 << len(ops)) - 1
+    visited = set()
+    stack = [(0, initial_state)]
+    while stack:
+        done, state = stack.pop()
+        if done == full:
+            if state == final_state:
+                return True
+            continue
+        if (done, state) in visited:
+            continue
+        visited.add((done, state))
+        pending = [i for i in range(len(ops)) if not done & (1 << i)]
+        earliest_response = min(ops[i]["response"] for i in pending)
+        # 次に線形化できるのは、まだ終わっていないどの操作の応答よりも前に始まった操作だけ
+        for i in pending:
+            if ops[i]["invoke"] > earliest_response:
+                continue
+            next_state = apply_op(state, ops[i])
+            if next_state is not None:
+                stack.append((done | (1 << i), next_state))
+    return False
+
+def max_overlap(intervals):
+    points = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals], key=lambda p: (p[0], p[1]))
+    current = best = 0
+    for _, delta in points:
+        current += delta
+        best = max(best, current)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress per-device operation locks and check the results are linearizable")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent client threads")
+    parser.add_argument('--devices', type=int, default=6)
+    parser.add_argument('--ops-per-client', type=int, default=100)
+    parser.add_argument('--latency', type=float, nargs=2, default=[0.01, 0.04], metavar=("MIN", "MAX"),
+                        help="fake usbip bind/unbind latency range (seconds)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-locks', action='store_true', help="disable device locks to confirm the checks catch violations")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    work_dir = tempfile.mkdtemp(prefix='usbip_stress_locks_')
+    bin_dir, state_dir = os.path.join(work_dir, 'bin'), os.path.join(work_dir, 'state')
+    os.makedirs(bin_dir)
+    os.makedirs(state_dir)
+    write_fake_usbip(bin_dir, state_dir, *args.latency)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.chdir(work_dir)
+    with open('server_config.json', 'w') as f:
+        json.dump({"log_level": "ERROR", "reconcile_interval": 0, "startup_mode": "cold", "admission_control_enabled": False,
+                   "usbip_max_concurrent": args.clients * 2, "force_detach_overall_timeout": 60.0, "device_lock_timeout": 60.0}, f)
+    sys.path.insert(0, BENCH_DIR)
+    import server_app
+    server_app.init_server()
+    if args.no_locks:
+        class UnlockedTable(server_app.DeviceLockTable):
+            def acquire(self, bus_ids, timeout=None, skip_busy=False):
+                return sorted(set(bus_ids))
+            def release(self, bus_ids):
+                pass
+        server_app.device_locks = UnlockedTable()
+
+    bus_ids = [f"1-1.{i + 1}" for i in range(args.devices)]
+    history = {bus_id: [] for bus_id in bus_ids}
+    history_lock = threading.Lock()
+    started_at = time.monotonic()
+    threads = [threading.Thread(target=client_loop, args=(i, bus_ids, args.ops_per_client, history, history_lock))
+               for i in range(args.clients)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.monotonic() - started_at
+
+    # 偽の usbip の記録: 同じデバイスで重なった実行と、別のデバイスとの並列度
+    violations = []
+    if os.path.exists(os.path.join(state_dir, 'violations')):
+        with open(os.path.join(state_dir, 'violations')) as f:
+            violations = f.read().splitlines()
+    with open(os.path.join(state_dir, 'commands')) as f:
+        commands = [json.loads(line) for line in f]
+    parallelism = max_overlap([(c[0], c[1]) for c in commands])
+
+    attachments = server_app.get_state().attached_devices_log
+    failed_devices = []
+    for bus_id in bus_ids:
+        final_state = (os.path.exists(os.path.join(state_dir, bus_id + '.bound')),
+                       attachments[bus_id]["username"] if bus_id in attachments else None)
+        if not is_linearizable(history[bus_id], (False, None), final_state):
+            failed_devices.append(bus_id)
+
+    total_ops = sum(len(ops) for ops in history.values())
+    print(f"{args.clients} clients, {args.devices} devices, {total_ops} device operations in {elapsed:.1f}s "
+          f"({total_ops / elapsed:.0f} ops/s), locks {'disabled' if args.no_locks else 'enabled'}")
+    print(f"usbip commands: {len(commands)}, max parallel: {parallelism}, "
+          f"overlaps on the same device: {len(violations)}")
+    print(f"device lock waits: {server_app.device_locks.contended}")
+    for bus_id in bus_ids:
+        print(f"  {bus_id}: {len(history[bus_id])} operations, {'linearizable' if bus_id not in failed_devices else 'NOT linearizable'}")
+    ok = not violations and not failed_devices and parallelism > 1
+    if parallelism <= 1:
+        print("FAIL: operations on different devices did not run in parallel")
+    print("PASS" if ok else "FAIL")
+    os.chdir(BENCH_DIR)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
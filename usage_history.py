@@ -0,0 +1,212 @@
+# usage_history.py
+# デバイスの利用履歴 (アタッチしていた区間) の記録と集計。
+#   - 区間は追記専用のバイナリファイルに1件ずつ書く (開始・終了の UNIX 秒、バスID、ユーザー名。1件 20〜40 バイト程度)
+#   - デバイスごとに1時間単位と1日単位の集計 (使用秒数・アタッチ回数・利用者) をメモリに持ち、保持期間を過ぎたものは捨てる
+#   - 集計はファイルのどこまで反映したかと一緒にスナップショットに保存し、起動時はその続きだけを読む
+#   - 複数のワーカープロセスが同じファイルに追記しても、問い合わせの前に末尾の未反映分を読むので集計はそろう
+# 問い合わせ (query) は集計だけを見る (生の履歴は読まない)。
+
+import datetime
+import json
+import os
+import struct
+import threading
+import time
+
+RECORD_HEADER = struct.Struct('<IIBB') # 開始, 終了 (UNIX 秒), バスIDの長さ, ユーザー名の長さ。続けて UTF-8 のバスIDとユーザー名
+HOUR = 3600
+PRUNE_INTERVAL = 600 # 保持期間を過ぎた集計を捨てる間隔 (秒)
+
+
+def hour_start(t):
+    return int(t) // HOUR * HOUR
+
+def next_hour(start):
+    return start + HOUR
+
+def day_start(t):
+    """t を含む日 (サーバーのローカル時刻) の 0 時の UNIX 秒"""
+    d = datetime.date.fromtimestamp(t)
+    return int(time.mktime((d.year, d.month, d.day, 0, 0, 0, 0, 0, -1)))
+
+def next_day(start):
+    d = datetime.date.fromtimestamp(start) + datetime.timedelta(days=1)
+    return int(time.mktime((d.year, d.month, d.day, 0, 0, 0, 0, 0, -1)))
+
+RESOLUTIONS = {"hour": (hour_start, next_hour), "day": (day_start, next_day)}
+
+
+def encode_record(bus_id, username, started_at, ended_at):
+    bus_id_bytes = bus_id.encode('utf-8')[:255]
+    username_bytes = (username or "").encode('utf-8')[:255]
+    return RECORD_HEADER.pack(int(started_at), int(ended_at), len(bus_id_bytes), len(username_bytes)) + bus_id_bytes + username_bytes
+
+def decode_records(data):
+    """完全なレコードだけを読む。戻り値: ([(bus_id, username, 開始, 終了), ...], 読んだバイト数)"""
+    records = []
+    position = 0
+    while position + RECORD_HEADER.size <= len(data):
+        started_at, ended_at, bus_id_length, username_length = RECORD_HEADER.unpack_from(data, position)
+        end = position + RECORD_HEADER.size + bus_id_length + username_length
+        if end > len(data):
+            break # 書き込み途中
+        bus_id = data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + bus_id_length].decode('utf-8', 'replace')
+        username = data[end - username_length:end].decode('utf-8', 'replace')
+        records.append((bus_id, username, started_at, ended_at))
+        position = end
+    return records, position
+
+def add_interval(buckets, resolution, bus_id, username, started_at, ended_at, oldest=0):
+    """
+    区間を bucket ごとに分けて buckets[bus_id][bucket の開始] = [使用秒数, アタッチ回数, 利用者の集合] に足す。
+    アタッチ回数は区間が始まった bucket にだけ数える。oldest より前の bucket には足さない
+    """
+    bucket_start, next_bucket = RESOLUTIONS[resolution]
+    t = started_at
+    first = True
+    while first or t < ended_at:
+        start = bucket_start(t)
+        segment_end = min(ended_at, next_bucket(start))
+        if start >= oldest:
+            entry = buckets.setdefault(bus_id, {}).setdefault(start, [0, 0, set()])
+            entry[0] += max(0, segment_end - t)
+            if first:
+                entry[1] += 1
+            entry[2].add(username or "") # 利用者不明 (起動時に復元したアタッチ) は "" で持ち、利用者の一覧には出さない
+        first = False
+        t = segment_end
+
+
+class UsageHistory:
+    """利用履歴の追記ファイルと、デバイスごとの1時間/1日単位の集計"""
+    def __init__(self, history_path, snapshot_path, hourly_retention_days=14, daily_retention_days=400, snapshot_every=500):
+        self.history_path = history_path
+        self.snapshot_path = snapshot_path
+        self.retention = {"hour": hourly_retention_days * 86400, "day": daily_retention_days * 86400}
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()
+        self.buckets = {"hour": {}, "day": {}} # resolution -> bus_id -> bucket の開始 -> [使用秒数, アタッチ回数, 利用者の集合]
+        self.offset = 0 # 集計に反映済みの履歴ファイルのバイト数
+        self.records_since_snapshot = 0
+        self.last_pruned_at = 0
+
+    def load(self):
+        """スナップショットを読み、その後に追記された分だけを反映する"""
+        with self.lock:
+            if os.path.exists(self.snapshot_path):
+                try:
+                    with open(self.snapshot_path, 'r') as f:
+                        snapshot = json.load(f)
+                    history_size = os.path.getsize(self.history_path) if os.path.exists(self.history_path) else 0
+                    if snapshot["offset"] <= history_size: # 履歴ファイルが作り直されていたらスナップショットは使わない
+                        self.offset = snapshot["offset"]
+                        for resolution in self.buckets:
+                            self.buckets[resolution] = {
+                                bus_id: {start: [seconds, sessions, set(users)] for start, seconds, sessions, users in entries}
+                                for bus_id, entries in snapshot[resolution].items()}
+                except (OSError, ValueError, KeyError, TypeError):
+                    self.offset = 0
+                    self.buckets = {"hour": {}, "day": {}}
+            self._catch_up()
+
+    def record(self, bus_id, username, started_at, ended_at):
+        """アタッチしていた区間を追記する (1回の write で書くので、複数プロセスから追記しても混ざらない)"""
+        data = encode_record(bus_id, username, started_at, max(started_at, ended_at))
+        fd = os.open(self.history_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        with self.lock:
+            self._catch_up()
+
+    def _catch_up(self):
+        """lock を保持して呼ぶ。履歴ファイルの未反映分 (他のプロセスが追記したものも) を集計に反映する"""
+        try:
+            if os.path.getsize(self.history_path) <= self.offset:
+                return
+            with open(self.history_path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        records, consumed = decode_records(data)
+        now = time.time()
+        oldest = {resolution: now - retention for resolution, retention in self.retention.items()}
+        for bus_id, username, started_at, ended_at in records:
+            for resolution, buckets in self.buckets.items():
+                add_interval(buckets, resolution, bus_id, username, started_at, ended_at, RESOLUTIONS[resolution][0](oldest[resolution]))
+        self.offset += consumed
+        self.records_since_snapshot += len(records)
+        if now - self.last_pruned_at >= PRUNE_INTERVAL:
+            self._prune(oldest)
+            self.last_pruned_at = now
+        if self.records_since_snapshot >= self.snapshot_every:
+            self._save_snapshot()
+
+    def _prune(self, oldest):
+        for resolution, buckets in self.buckets.items():
+            cutoff = RESOLUTIONS[resolution][0](oldest[resolution])
+            for bus_id in list(buckets):
+                device_buckets = buckets[bus_id]
+                for start in [start for start in device_buckets if start < cutoff]:
+                    del device_buckets[start]
+                if not device_buckets:
+                    del buckets[bus_id]
+
+    def _save_snapshot(self):
+        snapshot = {"offset": self.offset}
+        for resolution, buckets in self.buckets.items():
+            snapshot[resolution] = {bus_id: [[start, seconds, sessions, sorted(users)]
+                                             for start, (seconds, sessions, users) in sorted(device_buckets.items())]
+                                    for bus_id, device_buckets in buckets.items()}
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.snapshot_path)
+        self.records_since_snapshot = 0
+
+    def retained_from(self, resolution):
+        return RESOLUTIONS[resolution][0](time.time() - self.retention[resolution])
+
+    def query(self, range_start, range_end, resolution, bus_ids=None, open_sessions=()):
+        """
+        range_start〜range_end (bucket の境界にそろえる) のデバイスごとの利用状況。使用率の高い順。
+        open_sessions: まだアタッチ中の [(bus_id, username, 開始), ...] (現在時刻までの分を足す。集計には残さない)
+        """
+        bucket_start, _ = RESOLUTIONS[resolution]
+        range_start = bucket_start(range_start)
+        now = time.time()
+        ongoing = {}
+        for bus_id, username, started_at in open_sessions:
+            add_interval(ongoing, resolution, bus_id, username, int(started_at), int(now), range_start)
+        with self.lock:
+            self._catch_up()
+            merged = {}
+            for source in (self.buckets[resolution], ongoing):
+                for bus_id, device_buckets in source.items():
+                    if bus_ids and bus_id not in bus_ids:
+                        continue
+                    for start, (seconds, sessions, users) in device_buckets.items():
+                        if range_start <= start < range_end:
+                            entry = merged.setdefault(bus_id, {}).setdefault(start, [0, 0, set()])
+                            entry[0] += seconds
+                            entry[1] += sessions
+                            entry[2] |= users
+        range_seconds = max(1, min(range_end, now) - range_start)
+        devices = []
+        for bus_id, device_buckets in merged.items():
+            used_seconds = sum(entry[0] for entry in device_buckets.values())
+            devices.append({
+                "bus_id": bus_id,
+                "used_seconds": used_seconds,
+                "utilization": round(min(1.0, used_seconds / range_seconds), 4),
+                "sessions": sum(entry[1] for entry in device_buckets.values()),
+                "users": sorted(set().union(*(entry[2] for entry in device_buckets.values())) - {""}),
+                "buckets": [{"start": datetime.datetime.fromtimestamp(start).isoformat(), "used_seconds": seconds,
+                             "utilization": round(min(1.0, seconds / max(1, min(RESOLUTIONS[resolution][1](start), now) - start)), 4),
+                             "sessions": sessions, "users": len(users - {""})}
+                            for start, (seconds, sessions, users) in sorted(device_buckets.items())],
+            })
+        devices.sort(key=lambda device: (-device["utilization"], device["bus_id"]))
+        return devices
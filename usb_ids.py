@@ -0,0 +1,159 @@
+# usb_ids.py
+# usb.ids (USB のベンダー/製品名の一覧。usbutils / hwdata に入っている約 1 MB のテキスト) のバイナリ索引。
+# usbip が名前を解決できなかったデバイス ("Device 1-1.2 (VID:.. PID:..)" や "unknown vendor : unknown product") の説明を埋めるのに使う。
+#   - 索引はベンダーID順・(ベンダーID, 製品ID) 順に並べた固定長の表と、名前の文字列をつなげたもの
+#   - mmap して二分探索するので、1回の検索は O(log n) で、読み込むのは触れたページだけ (常駐メモリはほぼ増えない)
+#   - 索引には元の usb.ids の更新時刻とサイズを記録しておき、元のファイルが変わっていたら作り直す
+#
+# 索引の形式 (リトルエンディアン):
+#   ヘッダ: マジック "USBIDX1\0", 元ファイルの更新時刻 (ns), 元ファイルのサイズ, ベンダー数, 製品数
+#   ベンダー表: (ベンダーID, 名前の位置, 名前の長さ) × ベンダー数
+#   製品表: ((ベンダーID << 16) | 製品ID, 名前の位置, 名前の長さ) × 製品数
+#   名前: UTF-8 の文字列をつなげたもの (位置はここの先頭から)
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+USB_IDS_PATHS = ("/usr/share/hwdata/usb.ids", "/usr/share/misc/usb.ids", "/usr/share/usb.ids", "/var/lib/usbutils/usb.ids")
+MAGIC = b"USBIDX1\0"
+HEADER = struct.Struct('<8sqqII')
+VENDOR_ENTRY = struct.Struct('<HIH')
+PRODUCT_ENTRY = struct.Struct('<IIH')
+
+
+def find_usb_ids():
+    """よくある場所にある usb.ids のパス。見つからなければ None"""
+    for path in USB_IDS_PATHS:
+        if os.path.exists(path):
+            return path
+    return None
+
+def parse_usb_ids(lines):
+    """usb.ids の行から ({vid: 名前}, {(vid, pid): 名前}) を作る。ベンダー一覧の後のクラスなどの節は読み飛ばす"""
+    vendors = {}
+    products = {}
+    vendor = None
+    for line in lines:
+        if not line or line[0] == '#' or line.isspace():
+            continue
+        if line[0] == '\t':
+            if vendor is not None and line[1] != '\t': # タブ2つはインターフェース
+                try:
+                    products[(vendor, int(line[1:5], 16))] = line[5:].strip()
+                except ValueError:
+                    pass
+            continue
+        try:
+            vendor = int(line[:4], 16) if line[4:6] == '  ' else None
+        except ValueError:
+            vendor = None # "C 00  ..." などの別の節
+        if vendor is not None:
+            vendors[vendor] = line[6:].strip()
+    return vendors, products
+
+def build_index(source_path, index_path):
+    """usb.ids から索引を作る (一時ファイルに書いてから置き換えるので、読んでいる他のプロセスには影響しない)"""
+    stat = os.stat(source_path)
+    with open(source_path, 'r', encoding='utf-8', errors='replace') as f:
+        vendors, products = parse_usb_ids(f)
+    names = bytearray()
+    def add_name(name):
+        encoded = name.encode('utf-8')[:0xFFFF]
+        offset = len(names)
+        names.extend(encoded)
+        return offset, len(encoded)
+    vendor_table = b''.join(VENDOR_ENTRY.pack(vid, *add_name(name)) for vid, name in sorted(vendors.items()))
+    product_table = b''.join(PRODUCT_ENTRY.pack((vid << 16) | pid, *add_name(name)) for (vid, pid), name in sorted(products.items()))
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, stat.st_mtime_ns, stat.st_size, len(vendors), len(products)))
+        f.write(vendor_table)
+        f.write(product_table)
+        f.write(names)
+    os.replace(tmp_path, index_path)
+
+
+class MappedIndex:
+    """mmap した索引1つ分"""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.source_mtime_ns, self.source_size, self.vendor_count, self.product_count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a usb.ids index")
+        self.product_table = HEADER.size + self.vendor_count * VENDOR_ENTRY.size
+        self.names = self.product_table + self.product_count * PRODUCT_ENTRY.size
+
+    def search(self, table, count, entry, key):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            found_key, offset, length = entry.unpack_from(self.mm, table + middle * entry.size)
+            if found_key < key:
+                low = middle + 1
+            elif found_key > key:
+                high = middle
+            else:
+                return self.mm[self.names + offset:self.names + offset + length].decode('utf-8', 'replace')
+        return None
+
+    def lookup(self, vid, pid):
+        return (self.search(HEADER.size, self.vendor_count, VENDOR_ENTRY, vid),
+                self.search(self.product_table, self.product_count, PRODUCT_ENTRY, (vid << 16) | pid))
+
+
+class UsbIdsIndex:
+    """usb.ids の索引を必要なときに作り/作り直し、ベンダー名と製品名を引く"""
+    def __init__(self, source_path, index_path, check_interval=60.0):
+        self.source_path = source_path
+        self.index_path = index_path
+        self.check_interval = check_interval # 元のファイルが変わったかを確かめる間隔 (秒)
+        self.lock = threading.Lock()
+        self.index = None
+        self.checked_at = None
+
+    def current(self):
+        """使える索引 (なければ None)。check_interval ごとに元のファイルと比べ、変わっていれば作り直す"""
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return self.index
+        with self.lock:
+            if self.checked_at is not None and now - self.checked_at < self.check_interval:
+                return self.index
+            self.checked_at = now
+            try:
+                stat = os.stat(self.source_path)
+            except OSError:
+                stat = None # 元のファイルがなくなっても、作ってある索引はそのまま使う
+            index = self.index
+            if index is None and os.path.exists(self.index_path):
+                try:
+                    index = MappedIndex(self.index_path)
+                except (OSError, ValueError, struct.error):
+                    index = None
+            if stat is not None and (index is None or (index.source_mtime_ns, index.source_size) != (stat.st_mtime_ns, stat.st_size)):
+                build_index(self.source_path, self.index_path)
+                index = MappedIndex(self.index_path)
+            # 前の索引は閉じない (検索中のスレッドがあるかもしれない。参照がなくなれば閉じられる)
+            self.index = index
+            return index
+
+    def lookup(self, vid, pid):
+        """(ベンダー名, 製品名)。vid / pid は 16 進の文字列。分からないものは None"""
+        index = self.current()
+        if index is None:
+            return None, None
+        try:
+            return index.lookup(int(vid, 16), int(pid, 16))
+        except ValueError:
+            return None, None
+
+    def describe(self, vid, pid):
+        """usbip と同じ "ベンダー名 : 製品名" の形式の説明。ベンダーが分からなければ None"""
+        vendor, product = self.lookup(vid, pid)
+        if vendor is None:
+            return None
+        return f"{vendor} : {product or 'unknown product'}"
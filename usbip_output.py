@@ -0,0 +1,128 @@
+# usbip_output.py
+# usbip コマンドの出力のパーサー (server_app.py / client_gui.py 共通)。
+# 行を1回だけ走査し、デバイス1件分がそろうたびに返すので、subprocess の stdout を直接渡して読みながら処理できる。
+#
+# 対応している `usbip list -l` の出力形式:
+#    - busid 1-1.2 (0424:ec00)                                     (usbip-utils 2.0 以降)
+#      Standard Microsystems Corp. : SMSC9512/9514 Fast Ethernet Adapter (0424:ec00)
+#
+#    busid 1-1.2 (0424:ec00)                                        (先頭の "-" なし)
+#    busid=1-1.2#usbid=0424:ec00#                                   (`usbip list -p -l` のパース用形式)
+#  改行が CRLF の出力 (usbip-win など) もそのまま扱える。
+
+import re
+
+_BUSID_LINE = re.compile(r'(?:-\s*)?busid\s+([\w.-]+)\s*\((\w{4}):(\w{4})\)')
+_PARSABLE_LINE = re.compile(r'busid=([\w.-]+)#usbid=(\w{4}):(\w{4})#')
+_REMOTE_DEVICE_LINE = re.compile(r'([\w.-]+)\s*:')
+
+
+def _is_word(text):
+    return text.replace('_', '0').isalnum()
+
+def _split_trailing_ids(line):
+    """'説明 (vvvv:pppp)' を (説明, vid, pid) に分ける。末尾に ID がなければ None"""
+    if len(line) >= 11 and line[-1] == ')' and line[-6] == ':' and line[-11] == '(':
+        vid, pid = line[-10:-6], line[-5:-1]
+        if _is_word(vid) and _is_word(pid):
+            return line[:-11].rstrip(), vid, pid
+    return None
+
+def _default_description(bus_id, vid, pid):
+    return f"Device {bus_id} (VID:{vid} PID:{pid})"
+
+def _has_unresolved_name(record):
+    """usbip が名前を解決できなかったデバイスか (説明行がない、または "unknown vendor" / "unknown product")"""
+    description = record["description"]
+    return ("unknown vendor" in description or "unknown product" in description
+            or description == _default_description(record["bus_id"], record["vid"], record["pid"]))
+
+
+def iter_usbip_list_l_records(lines):
+    """
+    `usbip list -l` の出力 (行のイテラブル。ファイルや Popen.stdout も可) から
+    {"bus_id", "description", "vid", "pid"} を1件ずつ返すジェネレーター。
+    busid 行の次の行を説明行として扱い、説明行の末尾の (vid:pid) を優先する。
+    """
+    pending = None # busid 行を読んで説明行を待っているデバイス
+    for raw_line in lines:
+        line = raw_line.strip()
+        if not line:
+            if pending is not None:
+                yield pending
+                pending = None
+            continue
+        first = line[0]
+        if first == '-' or first == 'b':
+            match = _BUSID_LINE.match(line)
+            if match:
+                if pending is not None:
+                    yield pending # 説明行のないデバイス
+                bus_id, vid, pid = match.groups()
+                pending = {"bus_id": bus_id, "description": _default_description(bus_id, vid, pid), "vid": vid, "pid": pid}
+                continue
+            match = _PARSABLE_LINE.match(line)
+            if match:
+                if pending is not None:
+                    yield pending
+                    pending = None
+                bus_id, vid, pid = match.groups()
+                yield {"bus_id": bus_id, "description": _default_description(bus_id, vid, pid), "vid": vid, "pid": pid}
+                continue
+        if pending is None:
+            continue # 見出しなど、デバイスに属さない行
+        split = _split_trailing_ids(line)
+        if split is None:
+            pending["description"] = line
+        else:
+            description, pending["vid"], pending["pid"] = split
+            if description:
+                pending["description"] = description
+        yield pending
+        pending = None
+    if pending is not None:
+        yield pending
+
+def parse_usbip_list_l_output(output, resolve_names=None):
+    """
+    `usbip list -l` の出力 (文字列または行のイテラブル) をデバイスのリストにする。
+    resolve_names(vid, pid) を渡すと、usbip が名前を解決できなかったデバイスの説明をその戻り値にする (None なら元のまま)
+    """
+    if isinstance(output, str):
+        output = output.split('\n')
+    devices = list(iter_usbip_list_l_records(output))
+    if resolve_names is not None:
+        for dev in devices:
+            if _has_unresolved_name(dev):
+                dev["description"] = resolve_names(dev["vid"], dev["pid"]) or dev["description"]
+    return devices
+
+
+def iter_remote_list_bus_ids(lines):
+    """
+    `usbip list -r <host>` の出力から、エクスポートされている (バインド済みの) バスIDを1件ずつ返す。
+    出力形式例:
+        Exportable USB devices
+        ======================
+         - 192.168.2.123
+              1-1.5: Shanghai Jujo Electronics Co., Ltd : unknown product (6a75:9801)
+                   : /sys/devices/platform/soc/3f980000.usb/usb1/1-1/1-1.5
+                   : (Defined at Interface level) (00/00/00)
+    """
+    parsing_devices = False
+    for raw_line in lines:
+        line = raw_line.strip()
+        if not parsing_devices:
+            parsing_devices = line.startswith("Exportable USB devices")
+            continue
+        if not line or line[0] == ':' or line[0] == '=':
+            continue # 区切り線、デバイスの詳細行
+        match = _REMOTE_DEVICE_LINE.match(line)
+        if match:
+            yield match.group(1)
+
+def parse_remote_list_output(output):
+    """`usbip list -r` の出力 (文字列または行のイテラブル) をバインド済みバスIDのセットにする"""
+    if isinstance(output, str):
+        output = output.split('\n')
+    return set(iter_remote_list_bus_ids(output))